@@ -0,0 +1,298 @@
+# This Python file uses the following encoding: utf-8
+# ATS9360_NPT.py driver for The aquisition board Alzar ATS9360
+# Etienne Dumur <etienne.dumur@neel.cnrs.fr> 2015
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+    Benchmark of the acquisition and treatment pipeline on a simulated board.
+    Each processor of DataTreatment is run in each mode on the records of a
+    SyntheticSignal, through the same processes, shared memory ring and
+    result slot as a measurement of ATS9360_NPT, and the end-to-end
+    throughput is reported in MS/s with the stage of the pipeline limiting
+    it.
+
+    Usage, from the ATS9360 directory:
+        python Benchmark.py [--samples 1024] [--sequences 2] [--averaging 2000]
+                            [--workers 1] [--trigger-rate None]
+"""
+
+from __future__ import division
+import argparse
+import ctypes
+import multiprocessing as mp
+
+import atsapi as ats
+import DataTreatment as dt
+from BufferPlanner import BufferPlanner
+from DataAcquisition import DataAcquisition
+from ResultSlot import ResultSlot
+from RunParameters import RunConfig, RunState, RunParameters
+from SharedRing import SharedRing
+from SimulatedBoard import SimulatedBackend, SyntheticSignal
+from StageTimer import StageTimer, monotonic
+
+
+
+def get_parameters(mode, samplerate, samplesPerRecord, nb_sequence, plan,
+                   records_per_average, stage_timing):
+    """
+        Return the RunParameters of a measurement on the simulated board, the
+        clock being external to give any samplerate.
+    """
+
+    config = RunConfig(
+        # Clock parameters
+        samplerate   = samplerate,
+        clock_source = 'external',
+        clock_edge   = 'rising',
+
+        # Trigger parameters
+        trigger_range = 1,
+        trigger_slope = 'positive',
+        trigger_level = 0.5,
+        trigger_delay = 0.,
+
+        # Acquisition parameters
+        samplesPerRecord        = samplesPerRecord,
+        records_per_buffer      = plan.records_per_buffer,
+        records_per_average     = records_per_average,
+        footer_samples          = 0,
+        samples_per_timestamp   = 8,
+        stage_timing            = stage_timing,
+        nb_buffer_allocated     = plan.nb_buffer_allocated,
+        buffers_per_acquisition = plan.buffers_per_acquisition,
+        nb_sequence             = nb_sequence,
+
+        # The whole averaging is acquired
+        error_target  = None,
+        snr_target    = None,
+        min_averaging = 0,
+
+        # Correspondence between user parameters and board command
+        allow_samplerates    = {},
+        allow_clock_edges    = {'rising' : ats.CLOCK_EDGE_RISING},
+        allow_clock_sources  = {'external' : ats.EXTERNAL_CLOCK_10MHz_REF},
+        allow_trigger_ranges = {1 : ats.ETR_1V},
+        allow_trigger_slopes = {'positive' : ats.TRIGGER_SLOPE_POSITIVE},
+
+        # Mode of the digitizer
+        mode = mode)
+
+    return RunParameters(config, RunState())
+
+
+
+def run(processor, mode='CHANNEL_A', samplerate=1e3, samplesPerRecord=1024,
+        nb_sequence=2, averaging=2000, records_per_average=1, signal=None,
+        nb_workers=1, nb_ring_slots=32, stage_timing=True):
+    """
+        Run a measurement on the simulated board and return its end-to-end
+        throughput.
+
+        Input:
+            - processor (obj instance): Instance of class coming from the
+              file DataTreatment.
+            - mode (str): "CHANNEL_AB", "CHANNEL_A", "CHANNEL_B" or
+              "FPGA_AVERAGE".
+            - samplerate (float): in [MS/s].
+            - samplesPerRecord (int): must be a multiple of 128.
+            - nb_sequence (int)
+            - averaging (int)
+            - records_per_average (int): records co-added by the board in
+              FPGA_AVERAGE mode, must divide the averaging.
+            - signal (SyntheticSignal): if None, a 50 MHz tone.
+            - nb_workers (int): number of treatment processes.
+            - nb_ring_slots (int)
+            - stage_timing (bool): if True, the stages of the treatment are
+              timed for each sequence, which slows down the short sequences.
+
+        Output:
+            - rate (float): samples acquired and treated per second, in
+              [MS/s], all channels and the records co-added by the board
+              included.
+            - elapsed (float): duration of the measurement in [s], from the
+              start of the processes to the end of the treatment.
+            - message (str): information given by the processes.
+            - stage_statistics (dict): timing of the stages of the pipeline,
+              see StageTimer.statistics.
+    """
+
+    if mode == 'CHANNEL_AB':
+        nb_channels = 2
+    else:
+        nb_channels = 1
+
+    if mode == 'FPGA_AVERAGE':
+        sample_type      = ctypes.c_uint32
+        bytes_per_sample = 4
+    else:
+        sample_type         = ctypes.c_uint16
+        bytes_per_sample    = 2
+        records_per_average = 1
+
+    plan = BufferPlanner().plan(samplesPerRecord, nb_channels, nb_sequence,
+                                averaging//records_per_average,
+                                bytes_per_sample)
+
+    parameters = get_parameters(mode, samplerate, samplesPerRecord,
+                                nb_sequence, plan, records_per_average,
+                                stage_timing)
+
+    unit_buffers = processor.sequence_aligned_buffers(plan.records_per_buffer,
+                                                      nb_sequence)
+
+    ring = SharedRing(nb_ring_slots,
+                      plan.records_per_buffer*samplesPerRecord*nb_channels,
+                      sample_type, nb_readers=nb_workers,
+                      unit_buffers=unit_buffers)
+
+    nb_records  = plan.buffers_per_acquisition*plan.records_per_buffer
+    result_slot = ResultSlot(processor.result_bytes(samplesPerRecord,
+                                                    nb_channels, nb_sequence,
+                                                    nb_records) + 2**20)
+
+    if nb_workers == 1:
+
+        workers = [mp.Process(target = processor.treat_data,
+                              args   = (ring, result_slot, parameters))]
+    else:
+
+        queue_partial = mp.Queue()
+
+        workers = [mp.Process(target = processor.treat_shard,
+                              args   = (ring, reader, nb_workers,
+                                        unit_buffers, queue_partial,
+                                        parameters))
+                   for reader in range(nb_workers)]
+
+        workers.append(mp.Process(target = processor.reduce_data,
+                                  args   = (queue_partial, result_slot,
+                                            nb_workers, unit_buffers,
+                                            parameters)))
+
+    # The simulated clock does not need to settle
+    acquisition = DataAcquisition(SimulatedBackend(signal))
+    acquisition.clock_settling_time = 0.
+    workers.append(mp.Process(target = acquisition.get_data,
+                              args   = (ring, parameters)))
+
+    start = monotonic()
+
+    for worker in workers:
+        worker.start()
+
+    for worker in workers:
+        worker.join()
+
+    elapsed = monotonic() - start
+
+    ring.close()
+    result_slot.close()
+
+    samples = nb_records*records_per_average*samplesPerRecord*nb_channels
+
+    return samples/elapsed/1e6, elapsed, parameters['message'],\
+           parameters['stage_statistics']
+
+
+
+def processors(samplerate, samplesPerRecord, nb_sequence, frequency):
+    """
+        Return the processors of the benchmark as (name, factory), the
+        factory building a new processor at each run.
+    """
+
+    acquisition_time = samplesPerRecord/(samplerate*1e6)
+    arguments = (acquisition_time, samplerate*1e6, frequency*1e6)
+
+    return [('Average',                   lambda: dt.Average()),
+            ('Average integer',           lambda: dt.Average(integer=True)),
+            ('Average_time',              lambda: dt.Average_time()),
+            ('Average_time integer',      lambda: dt.Average_time(integer=True)),
+            ('AmplitudePhase',            lambda: dt.AmplitudePhase(*arguments)),
+            ('RealImag',                  lambda: dt.RealImag(*arguments)),
+            ('AmplitudePhasePerSequence', lambda: dt.AmplitudePhasePerSequence(*(arguments + (nb_sequence,)))),
+            ('RealImagPerSequence',       lambda: dt.RealImagPerSequence(*arguments))]
+
+
+
+def benchmark(modes=('CHANNEL_A', 'CHANNEL_AB', 'FPGA_AVERAGE'),
+              samplerate=1e3, samplesPerRecord=1024, nb_sequence=2,
+              averaging=2000, records_per_average=16, nb_workers=1,
+              trigger_rate=None, frequency=50., stage_timing=True):
+    """
+        Run every processor in every mode and print the throughputs.
+
+        Output:
+            - results (list): (processor, mode, rate in [MS/s], elapsed in [s],
+              stage_statistics)
+    """
+
+    signal = SyntheticSignal(tones=((frequency, 0.1, 0.),), noise=0.01,
+                             jitter=0.1, trigger_rate=trigger_rate)
+
+    results = []
+
+    print '%-28s %-14s %12s %10s  %s' % ('processor', 'mode', 'MS/s', 'sec',
+                                        'limited by')
+
+    for name, factory in processors(samplerate, samplesPerRecord, nb_sequence,
+                                    frequency):
+        for mode in modes:
+
+            rate, elapsed, message, statistics = run(factory(), mode,
+                                                     samplerate,
+                                                     samplesPerRecord,
+                                                     nb_sequence, averaging,
+                                                     records_per_average,
+                                                     signal, nb_workers,
+                                                     stage_timing=stage_timing)
+
+            print '%-28s %-14s %12.1f %10.3f  %s'\
+                  % (name, mode, rate, elapsed,
+                     StageTimer.limiting_stage(statistics))
+            results.append((name, mode, rate, elapsed, statistics))
+
+    return results
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark of the treatment '
+                                     'pipeline on a simulated ATS9360')
+    parser.add_argument('--samplerate', type=float, default=1e3,
+                        help='in MS/s')
+    parser.add_argument('--samples', type=int, default=1024,
+                        help='samples per record')
+    parser.add_argument('--sequences', type=int, default=2)
+    parser.add_argument('--averaging', type=int, default=2000)
+    parser.add_argument('--records-per-average', type=int, default=16,
+                        help='records co-added in FPGA_AVERAGE mode')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--trigger-rate', type=float, default=None,
+                        help='in Hz, as fast as possible by default')
+    parser.add_argument('--no-stage-timing', action='store_true',
+                        help='do not time the treatment of each sequence')
+    parser.add_argument('--modes', nargs='+',
+                        default=['CHANNEL_A', 'CHANNEL_AB', 'FPGA_AVERAGE'])
+
+    arguments = parser.parse_args()
+
+    benchmark(arguments.modes, arguments.samplerate, arguments.samples,
+              arguments.sequences, arguments.averaging,
+              arguments.records_per_average, arguments.workers,
+              arguments.trigger_rate, stage_timing=not arguments.no_stage_timing)
@@ -0,0 +1,216 @@
+# This Python file uses the following encoding: utf-8
+# ATS9360_NPT.py driver for The aquisition board Alzar ATS9360
+# Etienne Dumur <etienne.dumur@neel.cnrs.fr> 2015
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import numpy as np
+from fractions import gcd
+
+
+class BufferPlan(object):
+    """
+        Geometry of the DMA buffers of a measurement, as chosen by the
+        BufferPlanner.
+    """
+
+
+
+    def __init__(self, samplesPerRecord, nb_channels, bytes_per_sample,
+                 nb_sequence, averaging, records_per_buffer,
+                 buffers_per_acquisition, nb_buffer_allocated):
+
+        self.samplesPerRecord        = samplesPerRecord
+        self.nb_channels             = nb_channels
+        self.nb_sequence             = nb_sequence
+        self.averaging               = averaging
+        self.records_per_buffer      = records_per_buffer
+        self.buffers_per_acquisition = buffers_per_acquisition
+        self.nb_buffer_allocated     = nb_buffer_allocated
+
+        self.record_bytes = samplesPerRecord*nb_channels*bytes_per_sample
+        self.buffer_bytes = self.record_bytes*records_per_buffer
+        self.total_bytes  = self.buffer_bytes*buffers_per_acquisition
+
+        # A buffer containing whole sequences is treated without copy, a
+        # buffer containing a part of a sequence without leftover is only
+        # copied once
+        self.aligned = records_per_buffer%nb_sequence == 0\
+                       or nb_sequence%records_per_buffer == 0
+
+
+
+    def report(self, samplerate, trigger_rate=None, nb_ring_slots=0):
+        """
+            Return a description of the geometry, with the expected memory
+            use and throughput.
+
+            Input:
+                - samplerate (float): samplerate of the board in [MS/s].
+                - trigger_rate (float): repetition rate of the trigger in
+                  [Hz]. If None, the throughput is given for records
+                  following each other without dead time, which is an upper
+                  bound.
+                - nb_ring_slots (int): number of slots of the shared memory
+                  ring between the acquisition and the treatment.
+
+            Output:
+                - report (str)
+        """
+
+        record_time = self.samplesPerRecord/(samplerate*1e6)
+
+        if trigger_rate is None:
+            records_per_sec = 1./record_time
+            rate = 'at most'
+        else:
+            records_per_sec = min(float(trigger_rate), 1./record_time)
+            rate = 'at %g Hz of trigger' % trigger_rate
+
+        bytes_per_sec   = records_per_sec*self.record_bytes
+        buffers_per_sec = records_per_sec/self.records_per_buffer
+
+        if self.records_per_buffer%self.nb_sequence == 0:
+            alignment = 'whole sequences per buffer'
+        elif self.aligned:
+            alignment = 'whole buffers per sequence'
+        else:
+            alignment = 'sequences straddling buffers'
+
+        message  = 'Buffer of %i records, %f Mbytes (%s)\n'\
+                   % (self.records_per_buffer, self.buffer_bytes/1024**2.,
+                      alignment)
+        message += '%i buffers per acquisition, %i sequences averaged %i times\n'\
+                   % (self.buffers_per_acquisition, self.nb_sequence,
+                      self.averaging)
+        message += 'DMA memory: %i buffers, %f Mbytes\n'\
+                   % (self.nb_buffer_allocated,
+                      self.nb_buffer_allocated*self.buffer_bytes/1024**2.)
+        message += 'Ring memory: %i slots, %f Mbytes\n'\
+                   % (nb_ring_slots, nb_ring_slots*self.buffer_bytes/1024**2.)
+        message += 'Expected throughput %s: %f Mbytes per sec (%f buffers per sec)\n'\
+                   % (rate, bytes_per_sec/1024**2., buffers_per_sec)
+        message += 'Expected acquisition: %f Mbytes in %f sec\n'\
+                   % (self.total_bytes/1024**2.,
+                      self.buffers_per_acquisition*self.records_per_buffer\
+                      /records_per_sec)
+
+        return message
+
+
+
+class BufferPlanner(object):
+    """
+        Choose the number of records per buffer, of buffers per acquisition
+        and of DMA buffers allocated.
+        Buffers are looked for between a quarter and twice the targeted size,
+        large enough for the DMA to be efficient.
+        Among them, we keep the ones giving the requested averaging within
+        averaging_tolerance, then the ones whose boundaries match the
+        sequences, then the smallest excess of averaging and the closest to
+        the targeted size.
+        Smaller buffers are only used when no buffer of the targeted size
+        gives the requested averaging, the largest possible then.
+    """
+
+    # Relative excess of averaging accepted to keep large buffers
+    averaging_tolerance = 0.01
+
+
+
+    def __init__(self, buffer_bytes=4*2**20, dma_bytes=32*2**20,
+                 min_buffers=4, max_buffers=16):
+        """
+            Input:
+                - buffer_bytes (int): targeted size of a buffer in bytes.
+                - dma_bytes (int): targeted memory of the DMA buffers allocated
+                  in bytes.
+                - min_buffers, max_buffers (int): bounds of the number of DMA
+                  buffers allocated.
+        """
+
+        self.buffer_bytes = int(buffer_bytes)
+        self.dma_bytes    = int(dma_bytes)
+        self.min_buffers  = int(min_buffers)
+        self.max_buffers  = int(max_buffers)
+
+
+
+    def plan(self, samplesPerRecord, nb_channels, nb_sequence, averaging,
+             bytes_per_sample=2):
+        """
+            Return the BufferPlan of a measurement.
+
+            Input:
+                - samplesPerRecord (int): number of samples of a record per
+                  channel.
+                - nb_channels (int): number of channels in a record.
+                - nb_sequence (int): number of records of a sequence.
+                - averaging (int): number of times a sequence is acquired.
+                - bytes_per_sample (int)
+
+            Output:
+                - plan (BufferPlan)
+        """
+
+        record_bytes = samplesPerRecord*nb_channels*bytes_per_sample
+        nb_records   = nb_sequence*averaging
+
+        # The records per buffer are kept even, as the driver always did.
+        # Only an acquisition of an odd number of records, the remaining
+        # averaging of the FPGA_AVERAGE mode being odd, takes any number
+        # since an even buffer would then acquire records beyond the
+        # averaging.
+        step = 2 if nb_records%2 == 0 else 1
+
+        max_records = max(step, min(2*self.buffer_bytes//record_bytes, nb_records))
+        min_records = max(1, min(self.buffer_bytes//4//record_bytes, max_records))
+        target      = max(1, self.buffer_bytes//record_bytes)
+
+        tolerance = self.averaging_tolerance*averaging
+
+        best = None
+        for records_per_buffer in range(step, max_records + 1, step):
+
+            # Smallest number of buffers containing whole sequences
+            unit_buffers   = nb_sequence//gcd(records_per_buffer, nb_sequence)
+            unit_sequences = unit_buffers*records_per_buffer//nb_sequence
+
+            nb_units = -(-averaging//unit_sequences)
+
+            excess = nb_units*unit_sequences - averaging
+
+            score = (excess > tolerance,
+                     max(min_records - records_per_buffer, 0),
+                     records_per_buffer%nb_sequence != 0\
+                     and nb_sequence%records_per_buffer != 0,
+                     excess,
+                     abs(np.log(float(records_per_buffer)/target)))
+
+            if best is None or score < best[0]:
+                best = (score, records_per_buffer, nb_units*unit_buffers,
+                        nb_units*unit_sequences)
+
+        score, records_per_buffer, buffers_per_acquisition, averaging = best
+
+        buffer_bytes        = record_bytes*records_per_buffer
+        nb_buffer_allocated = min(max(self.dma_bytes//buffer_bytes,
+                                      self.min_buffers),
+                                  self.max_buffers,
+                                  buffers_per_acquisition)
+
+        return BufferPlan(samplesPerRecord, nb_channels, bytes_per_sample,
+                          nb_sequence, averaging, records_per_buffer,
+                          buffers_per_acquisition, nb_buffer_allocated)
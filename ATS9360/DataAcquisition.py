@@ -17,10 +17,14 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 from __future__ import division
+import copy
 import ctypes
 import numpy as np
 import time
 import atsapi as ats
+from RunParameters import RunParameters
+from NPTFooters import FooterMonitor
+from StageTimer import StageTimer, monotonic
 
 windowType = ats.DSP_WINDOW_HAMMING
 
@@ -33,6 +37,39 @@ class DataAcquisition(object):
 
 
 
+    def __init__(self, backend=ats, systemId=1, boardId=1):
+        """
+            Input:
+                - backend: module or object providing the Board and DMABuffer
+                  classes, atsapi for the real board or a SimulatedBackend.
+                - systemId (int): board system identifier of the board.
+                - boardId (int): identifier of the board in its system.
+        """
+
+        self.backend  = backend
+        self.systemId = systemId
+        self.boardId  = boardId
+
+        # Time given to the board to settle once its clock is set, in s
+        self.clock_settling_time = 0.5
+
+
+
+    def for_board(self, systemId, boardId):
+        """
+            Return the acquisition of another board, with the same backend
+            and settings.
+        """
+
+        acquisition          = copy.copy(self)
+        acquisition.systemId = systemId
+        acquisition.boardId  = boardId
+        acquisition.board    = None
+
+        return acquisition
+
+
+
     def set_clock(self, board, parameters):
         '''Set the clock of the board.
             The method uses all clock attribut to set the clock.
@@ -180,6 +217,17 @@ class DataAcquisition(object):
         preTriggerSamples     = 0
         postTriggerSamples    = parameters['samplesPerRecord']
 
+        # With NPT footers, each record gets room for its footer after the
+        # samples given to the treatment
+        footerSamples         = parameters['footer_samples']
+        postTriggerSamples   += footerSamples
+
+        if footerSamples and parameters['mode'] not in ('CHANNEL_AB',
+                                                        'CHANNEL_A',
+                                                        'CHANNEL_B'):
+            raise ValueError('The record footers are not available in %s mode'\
+                             % parameters['mode'])
+
         # Select the number of records per DMA buffer.
         recordsPerBuffer      = parameters['records_per_buffer']
 
@@ -200,6 +248,10 @@ class DataAcquisition(object):
             # Only channel A is used when on-FPGA FFT is active
             channels              = ats.CHANNEL_A
             channelCount          = 1
+        elif parameters['mode']== 'FPGA_AVERAGE':
+            # Only channel A is used when on-FPGA record averaging is active
+            channels              = ats.CHANNEL_A
+            channelCount          = 1
         elif parameters['mode']== 'CHANNEL_AB':
             # For two active channels
             channels              = ats.CHANNEL_A | ats.CHANNEL_B
@@ -214,11 +266,19 @@ class DataAcquisition(object):
             channelCount          = 1
         else:
             raise ValueError('mode of the digitizer must be "CHANNEL_AB" or \
-                            "CHANNEL_A" or "CHANNEL_B" or "FFT"')
+                            "CHANNEL_A" or "CHANNEL_B" or "FFT" or \
+                            "FPGA_AVERAGE"')
 
         # Compute the number of samples per record
         samplesPerRecord = preTriggerSamples + postTriggerSamples
 
+        # The record averaging of a previous measurement is switched off
+        if parameters['mode'] != 'FPGA_AVERAGE' and self.record_average:
+            board.configureRecordAverage(ats.CRA_MODE_DISABLE,
+                                         samplesPerRecord, 1,
+                                         ats.CRA_OPTION_UNSIGNED)
+            self.record_average = False
+
         #Configure the FFT module
         if parameters['mode'] == 'FFT':
             fftLength_samples = 1
@@ -251,6 +311,21 @@ class DataAcquisition(object):
             # parameters['samplesPerRecord'] = bytesPerRecord/bytesPerSample
 
 
+        elif parameters['mode'] == 'FPGA_AVERAGE':
+
+            # The board co-adds records_per_average consecutive records, the
+            # records of a buffer are the sums, one 32 bits unsigned integer
+            # per sample
+            board.configureRecordAverage(ats.CRA_MODE_ENABLE_FPGA_AVE,
+                                         samplesPerRecord,
+                                         parameters['records_per_average'],
+                                         ats.CRA_OPTION_UNSIGNED)
+            self.record_average = True
+
+            bytesPerSample   = 4
+            bytesPerRecord   = bytesPerSample * samplesPerRecord
+            bytesPerBuffer   = bytesPerRecord * recordsPerBuffer
+
         else:
 
             # Compute the number of bytes per record and per buffer
@@ -260,7 +335,7 @@ class DataAcquisition(object):
             bytesPerRecord   = bytesPerSample * samplesPerRecord
             bytesPerBuffer   = bytesPerRecord * recordsPerBuffer * channelCount
             # change made by Remy the 2018/06/21
-            parameters['samplesPerRecord'] = int(bytesPerRecord/bytesPerSample)
+            parameters['samplesPerRecord'] = int(bytesPerRecord/bytesPerSample) - footerSamples
             # before it was:
             # parameters['samplesPerRecord'] = bytesPerRecord/bytesPerSample
 
@@ -273,12 +348,14 @@ class DataAcquisition(object):
 
         # Allocate DMA buffers
         sample_type = ctypes.c_uint8
-        if bytesPerSample > 1:
+        if bytesPerSample > 2:
+            sample_type = ctypes.c_uint32
+        elif bytesPerSample > 1:
             sample_type = ctypes.c_uint16
 
         buffers = []
         for i in range(bufferCount):
-            buffers.append(ats.DMABuffer(sample_type, bytesPerBuffer))
+            buffers.append(self.backend.DMABuffer(sample_type, bytesPerBuffer))
 
 
         board.setRecordSize(preTriggerSamples, postTriggerSamples)
@@ -286,51 +363,70 @@ class DataAcquisition(object):
         # Prepate the board to work in the asynchroneous mode of acquisition
         recordsPerAcquisition = recordsPerBuffer * buffersPerAcquisition
 
+        # The arguments of beforeAsyncRead are kept to arm the board again
+        # for the next measurement
         if parameters['mode'] == 'FFT':
             admaFlags = ats.ADMA_EXTERNAL_STARTCAPTURE| ats.ADMA_NPT | ats.ADMA_DSP
-            board.beforeAsyncRead(channels,
-                                0,
-                                bytesPerRecord,
-                                recordsPerBuffer,
-                                0x7FFFFFFF,
-                                admaFlags)
-        elif parameters['mode'] == 'CHANNEL_AB':
-            board.beforeAsyncRead(channels,
-                                -preTriggerSamples,
-                                samplesPerRecord,
-                                recordsPerBuffer,
-                                recordsPerAcquisition,
-                                ats.ADMA_EXTERNAL_STARTCAPTURE \
-                                | ats.ADMA_NPT | ats.ADMA_FIFO_ONLY_STREAMING)
-        elif parameters['mode'] == 'CHANNEL_A':
-             board.beforeAsyncRead(channels,
-                                -preTriggerSamples,
-                                samplesPerRecord,
-                                recordsPerBuffer,
-                                recordsPerAcquisition,
-                                ats.ADMA_EXTERNAL_STARTCAPTURE \
-                                | ats.ADMA_NPT | ats.ADMA_FIFO_ONLY_STREAMING)
-        elif parameters['mode'] == 'CHANNEL_B':
-             board.beforeAsyncRead(channels,
-                                -preTriggerSamples,
-                                samplesPerRecord,
-                                recordsPerBuffer,
-                                recordsPerAcquisition,
-                                ats.ADMA_EXTERNAL_STARTCAPTURE \
-                                | ats.ADMA_NPT | ats.ADMA_FIFO_ONLY_STREAMING)
+            self.async_read = (channels,
+                               0,
+                               bytesPerRecord,
+                               recordsPerBuffer,
+                               0x7FFFFFFF,
+                               admaFlags)
+        elif parameters['mode'] == 'FPGA_AVERAGE':
+            # recordsPerBuffer and recordsPerAcquisition count the averaged
+            # records given by the board
+            self.async_read = (channels,
+                               0,
+                               samplesPerRecord,
+                               recordsPerBuffer,
+                               recordsPerAcquisition,
+                               ats.ADMA_EXTERNAL_STARTCAPTURE | ats.ADMA_NPT)
+        else:
+            admaFlags = ats.ADMA_EXTERNAL_STARTCAPTURE | ats.ADMA_NPT \
+                        | ats.ADMA_FIFO_ONLY_STREAMING
+            if footerSamples:
+                admaFlags |= ats.ADMA_ENABLE_RECORD_FOOTERS
+
+            self.async_read = (channels,
+                               -preTriggerSamples,
+                               samplesPerRecord,
+                               recordsPerBuffer,
+                               recordsPerAcquisition,
+                               admaFlags)
+
+        # Layout of the buffers given to the footer extraction, a record
+        # holding all the channels
+        if footerSamples:
+            self.footer_layout = (recordsPerBuffer,
+                                  bytesPerRecord * channelCount,
+                                  bytesPerBuffer)
+        else:
+            self.footer_layout = None
+
+        self.arm_acquisition(board, buffers)
+
+        return buffers
 
 
+
+    def arm_acquisition(self, board, buffers):
+        """
+            Prepare the board for a new asynchroneous acquisition with the
+            buffers already allocated.
+        """
+
+        board.beforeAsyncRead(*self.async_read)
+
         # Put the buffers previously created in the list of available buffers
         for buff in buffers:
             board.postAsyncBuffer(buff.addr, buff.size_bytes)
 
-        return buffers
-
 
 
-    def data_acquisition(self, board, queue_data, parameters, buffers):
+    def data_acquisition(self, board, ring, parameters, buffers):
         """
-            Acquire data and put them in the FIFO queue_data buffer memory.
+            Acquire data and write them in the slots of the shared memory ring.
 
             Output buffersCompleted (int): Number of emptied buffer.
         """
@@ -341,7 +437,23 @@ class DataAcquisition(object):
         postTriggerSamples    = parameters['samplesPerRecord']
         samplesPerRecord      = preTriggerSamples + postTriggerSamples
 
-        start = time.clock() # Keep track of when acquisition started
+        # The footers of each buffer are checked before it is given to the
+        # treatment
+        if self.footer_layout is not None:
+            monitor = FooterMonitor(*(self.footer_layout\
+                                      + (parameters['samplerate'],
+                                         parameters['samples_per_timestamp'])))
+        else:
+            monitor = None
+
+        # Each buffer is timed by stage with a monotonic clock
+        timer = StageTimer()
+
+        # The boards of a measurement start together, for their records to
+        # follow the same triggers
+        parameters.wait_boards()
+
+        start = monotonic() # Keep track of when acquisition started
         board.startCapture() # Start the acquisition
 
         message = 'Attempt to capture %d buffers\n' % buffersPerAcquisition
@@ -353,33 +465,38 @@ class DataAcquisition(object):
         while buffersCompleted < buffersPerAcquisition and parameters['measuring']:
 
             buff = buffers[buffersCompleted % len(buffers)]
+
+            wait = monotonic()
             if parameters['mode'] == 'FFT':
                 board.dspGetBuffer(buff.addr, timeout_ms=5000)
             else:
                 board.waitAsyncBufferComplete(buff.addr, timeout_ms=5000)
+            acquired = timer.lap('dma_wait', wait)
 
             buffersCompleted += 1
             bytesTransferred += buff.size_bytes
 
-            if parameters['mode'] == 'FFT':
-                queue_data.put(np.copy(buff.buffer))
-            elif parameters['mode'] == 'CHANNEL_AB':
-                queue_data[0].put(np.copy(buff.buffer[0::2]))
-                queue_data[1].put(np.copy(buff.buffer[1::2]))
-            elif parameters['mode'] == 'CHANNEL_A':
-                queue_data.put(np.copy(buff.buffer))
-            elif parameters['mode'] == 'CHANNEL_B':
-                queue_data.put(np.copy(buff.buffer))
+            if monitor is not None:
+                monitor.update(monitor.extract(buff))
+                parameters['trigger_statistics'] = monitor.statistics()
+
+            # The DMA buffer is written in place in a slot of the ring, only
+            # the index of the slot is sent to the treatment.
+            # In CHANNEL_AB mode, the samples stay interleaved, the
+            # deinterleaving is done by the treatment through a view.
+            ring.put(buff.buffer, acquired, timer)
 
             # Add the buffer to the end of the list of available buffers.
             board.postAsyncBuffer(buff.addr, buff.size_bytes)
 
         # Compute the total transfer time, and display performance information.
-        transferTime_sec = time.clock() - start
+        transferTime_sec = monotonic() - start
+        parameters['capture_time'] = transferTime_sec
         message += 'Capture completed in %f sec\n' % transferTime_sec
         buffersPerSec      = 0
         bytesPerSec        = 0
         recordsPerSec      = 0
+        samplePerSec       = 0
         samplesTransferred = samplesPerRecord*recordsPerBuffer*buffersCompleted*2
         if transferTime_sec > 0:
             buffersPerSec = buffersCompleted / transferTime_sec
@@ -392,67 +509,191 @@ class DataAcquisition(object):
         message += 'Transferred %d bytes (%f Mbytes per sec)\n' % (bytesTransferred, bytesPerSec/1024**2.)
         message += 'Transferred %d samples (%f MS per sec)\n' % (samplesTransferred, samplePerSec/1e6)
 
-        parameters['message'] = message
+        if monitor is not None:
+            message += monitor.report()
+
+        parameters.add_message(message)
+        parameters.add_stage_timer(timer)
 
         return buffersCompleted
 
 
 
-    def get_data(self, queue_data, parameters):
+    # Parameters needed by each step of the configuration of the board
+    clock_parameters   = ('samplerate', 'clock_source', 'clock_edge')
+    trigger_parameters = ('samplerate', 'trigger_range', 'trigger_slope',
+                          'trigger_level', 'trigger_delay')
+    buffer_parameters  = ('samplesPerRecord', 'records_per_buffer',
+                          'nb_buffer_allocated', 'buffers_per_acquisition',
+                          'mode', 'records_per_average', 'footer_samples')
+
+
+
+    def _changed(self, names, parameters):
+        """
+            Return True if one of the parameters differs from the one set on
+            the board.
         """
-            Method allowing the transfert of data from the board to the computer.
-            The board is instanced following the parameters input and data are
-            transfert to the queue_data memory buffer.
 
-            Input:
-                - queue_data_cha: FIFO memory buffer instance from the
-                               multiprocess library.
-                - queue_data_chb: FIFO memory buffer instance from the
-                               multiprocess library.
-                - parameters: Dictionnary with all board parameters instance
-                              from multiprocess library
+        for name in names:
+            if name not in self.settings or self.settings[name] != parameters[name]:
+                return True
+
+        return False
+
+
+
+    def configure(self, parameters):
+        """
+            Set the board for a measurement and return it.
+            The board instanced by a previous measurement is kept, only the
+            parameters which changed since are set again on it.
         """
 
         # We instance a board object
         # All the parameters of the measurement will be set on this instance
-        board = ats.Board(systemId = 1, boardId = 1)
+        if getattr(self, 'board', None) is None:
 
-        # We set the clock
-        self.set_clock(board, parameters)
+            self.board    = self.backend.Board(systemId = self.systemId,
+                                               boardId  = self.boardId)
+            self.settings = {}
 
-        # We set the two inputs (chanel A and B)
-        self.set_input_control(board)
+            # The record averaging is off on a new board
+            self.record_average = False
+
+            # We set the two inputs (chanel A and B)
+            self.set_input_control(self.board)
+
+        board    = self.board
+        settings = dict((name, parameters[name]) for name in self.clock_parameters\
+                        + self.trigger_parameters + self.buffer_parameters)
+
+        # We set the clock
+        clock_changed = self._changed(self.clock_parameters, parameters)
+        if clock_changed:
+            self.set_clock(board, parameters)
 
         # We set the trigger
-        self.set_trigger(board, parameters)
+        if self._changed(self.trigger_parameters, parameters):
+            self.set_trigger(board, parameters)
+
+        # We prepare the acquisition, the DMA buffers are only allocated again
+        # if their size changed. The FFT module is always set.
+        if parameters['mode'] == 'FFT' or self._changed(self.buffer_parameters, parameters):
+
+            self.buffers = self.prepare_acquisition(board, parameters)
+            self.samplesPerRecord = parameters['samplesPerRecord']
+        else:
+
+            parameters['samplesPerRecord'] = self.samplesPerRecord
+            self.arm_acquisition(board, self.buffers)
 
-        # We prepare the acquisition
-        buffers = self.prepare_acquisition(board, parameters)
+        self.settings = settings
 
         # We wait a little to let the time to the board to initialize itself
-        time.sleep(0.5)
+        if clock_changed:
+            time.sleep(self.clock_settling_time)
 
-        # We launch the data acquisition
-        parameters['measured_buffers'] = self.data_acquisition(board,
-                                                               queue_data,
-                                                               parameters, buffers)
+        return board
 
-        # We stop the transfer.
-        if parameters['mode'] == 'FFT' :
-            board.dspAbortCapture()
-        else:
-            board.abortAsyncRead()
+
+
+    def acquire(self, ring, parameters):
+        """
+            Acquire the buffers of a measurement.
+            Whatever happens, the readers of the ring are informed of the end
+            of the measurement.
+        """
+
+        try:
+            try:
+                board = self.configure(parameters)
+            except:
+                # The other boards of the measurement do not wait for this one
+                parameters['measuring'] = False
+                raise
+
+            # We launch the data acquisition
+            try:
+                parameters['measured_buffers'] = self.data_acquisition(board,
+                                                                       ring,
+                                                                       parameters,
+                                                                       self.buffers)
+            finally:
+
+                # We stop the transfer.
+                if parameters['mode'] == 'FFT' :
+                    board.dspAbortCapture()
+                else:
+                    board.abortAsyncRead()
+        finally:
+
+            # The treatment stops once it reaches the end of the buffers
+            ring.end()
 
         # We inform the parent process that the board is properly "closed"
         parameters['safe_acquisition'] = True
 
-        # Once the board is "close" properly, we close the FIFO memory
-        if parameters['mode'] == 'FFT' :
-            queue_data.close()
-        if parameters['mode'] == 'CHANNEL_AB' :
-            queue_data[0].close()
-            queue_data[1].close()
-        if parameters['mode'] == 'CHANNEL_A' :
-            queue_data.close()
-        if parameters['mode'] == 'CHANNEL_B' :
-            queue_data.close()
+
+
+    def get_data(self, ring, parameters):
+        """
+            Method allowing the transfert of data from the board to the computer.
+            The board is instanced following the parameters input and data are
+            transfert to the slots of the shared memory ring.
+
+            Input:
+                - ring: SharedRing instance receiving the acquired buffers.
+                - parameters: RunParameters with all board parameters
+        """
+
+        self.board = None
+        self.acquire(ring, parameters)
+
+        # Once the board is "close" properly, we close the shared memory ring
+        ring.close()
+
+
+
+    def serve(self, ring, control, done, state):
+        """
+            Loop of a persistent acquisition process.
+            The board stays configured and the DMA buffers allocated from one
+            measurement to the other.
+
+            Input:
+                - ring: SharedRing instance receiving the acquired buffers of
+                        all the measurements.
+                - control: Queue of commands, either
+                           ('run', config, nb_readers, unit_buffers) to
+                           acquire a measurement, or ('stop',).
+                - done: Event set at the end of each measurement.
+                - state: RunState shared with the treatment of every
+                         measurement.
+        """
+
+        self.board = None
+
+        while True:
+
+            command = control.get()
+
+            if command[0] == 'stop':
+                break
+
+            command, config, nb_readers, unit_buffers = command
+            parameters = RunParameters(config, state)
+
+            ring.configure(nb_readers, unit_buffers)
+
+            try:
+                self.acquire(ring, parameters)
+            except:
+                # The board is set from scratch at the next measurement
+                self.board = None
+                raise
+            finally:
+                done.set()
+
+        ring.close()
+        control.close()
@@ -16,217 +16,1724 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
+import copy
 import numpy as np
 import time
 import multiprocessing as mp
 import scipy.signal as scisig
+from StageTimer import StageTimer, TimedQueue, monotonic
+from ReferenceCache import reference_cache, oscillations, butter, cheby2,\
+                           pulse_envelope
+
+class VoltConverter(object):
+    """
+        Transform the raw data coming from the board in V.
+        The arrays used for the conversion are allocated once and reused for
+        every buffer having the same shape.
+    """
+
+    # Parameters of the board (are fixed).
+    bitshift         = 4  # Sould be int
+    bits_per_sample  = 12 # Sould be int
+    inputRange_volts = 400e-3 # Fixed for the ats9360
+
+
+
+    def __init__(self, dtype=np.float64, records_per_average=1):
+        """
+            Input:
+                - dtype (numpy type): type of the data in V. np.float32
+                  halves the memory bandwidth of the conversion.
+                - records_per_average (int): number of records co-added by
+                  the board in FPGA_AVERAGE mode. The data are then sums of
+                  12-bit sample codes instead of 16-bit samples.
+        """
+
+        self.dtype               = np.dtype(dtype)
+        self.records_per_average = int(records_per_average)
+
+        # AlazarTech digitizers are calibrated as follows
+        # codeZero  = (1 << (bits_per_sample - 1)) - 0.5
+        # codeRange = (1 << (bits_per_sample - 1)) - 0.5
+        # The calcul is inputRange_volts*(data - codeZero) / codeRange
+        # which we write scale*data - offset.
+        codeZero  = (1 << (self.bits_per_sample - 1)) - 0.5
+        codeRange = (1 << (self.bits_per_sample - 1)) - 0.5
+
+        self.scale  = self.dtype.type(self.inputRange_volts/codeRange)
+        self.offset = self.dtype.type(self.inputRange_volts*codeZero/codeRange)
+
+        # Scale of the data given by the board, the 4 low bits of the 16-bit
+        # samples being always zero, or the sums being of records_per_average
+        # codes
+        if self.records_per_average > 1:
+            self.shift      = 0
+            self.data_scale = self.inputRange_volts/codeRange\
+                              /self.records_per_average
+        else:
+            self.shift      = self.bitshift
+            self.data_scale = self.inputRange_volts/codeRange/2.**self.bitshift
+
+        self.scale = self.dtype.type(self.scale/self.records_per_average)
+
+        self._codes = None
+        self._volts = None
+
+
+
+    def __call__(self, data):
+        """
+            Return the data in V.
+            The returned array is overwritten by the next conversion.
+        """
+
+        if self._volts is None or self._volts.shape != data.shape:
+
+            self._codes = np.empty(data.shape, dtype=data.dtype)
+            self._volts = np.empty(data.shape, dtype=self.dtype)
+
+        # Right-shift 16-bit sample value by 4 to get 12-bit sample code
+        if self.shift:
+            np.right_shift(data, self.shift, out=self._codes)
+            codes = self._codes
+        else:
+            codes = data
+
+        np.multiply(codes, self.scale, out=self._volts)
+        np.subtract(self._volts, self.offset, out=self._volts)
+
+        return self._volts
+
+
+
+class Demodulator(object):
+    """
+        Project records on a set of reference waveforms with a single matrix
+        product.
+        The conversion in V is folded in the reference matrix so that the raw
+        data coming from the board are demodulated directly. It relies on the
+        4 low bits of the ats9360 samples being always zero, or on the data
+        being sums of sample codes in FPGA_AVERAGE mode.
+    """
+
+
+
+    def __init__(self, references, key=None):
+        """
+            Input:
+                - references (iterable of 1D arrays): reference waveforms of
+                  same length, cos and sin of the demodulation for instance.
+                - key (tuple): if given, key describing the references in the
+                  reference cache, the weights are then shared with the
+                  demodulators of same key.
+        """
+
+        if key is None:
+            self.references, self.weights, self.offsets = self._weights_of(references)
+        else:
+            self.references, self.weights, self.offsets =\
+                reference_cache.get(('demodulator',) + tuple(key),
+                                    lambda: self._weights_of(references))
+
+        self.nb_points = self.references.shape[1]
+
+        self._weights = {}
+        self._scratch = None
+        self._result  = None
+
+
+
+    @staticmethod
+    def _weights_of(references):
+        """
+            Return the references as a 2D array, the weights and the offsets
+            of the demodulation.
+        """
+
+        references = np.atleast_2d(np.asarray(references, dtype=np.float64))
+        nb_points  = references.shape[1]
+
+        converter = VoltConverter()
+
+        # mean((scale*data/2**bitshift - offset)*ref) is written
+        # data.weights - offsets
+        weights = references.T*converter.data_scale/nb_points
+        offsets = converter.offset*references.mean(axis=1)
+
+        return references, weights, offsets
+
+
+
+    def __call__(self, data, dtype=np.float64, records_per_average=1):
+        """
+            Return the projection of each record on each reference, in V, as
+            an array (records, references).
+            The returned array is overwritten by the next demodulation.
+            records_per_average is the number of records co-added by the
+            board in FPGA_AVERAGE mode.
+        """
+
+        dtype = np.dtype(dtype)
+        key   = (dtype, records_per_average)
+
+        if key not in self._weights:
+
+            weights = self.weights
+            if records_per_average > 1:
+                converter = VoltConverter(records_per_average=records_per_average)
+                weights   = self.references.T*converter.data_scale/self.nb_points
+
+            self._weights[key] = (weights.astype(dtype),
+                                  self.offsets.astype(dtype))
+
+        weights, offsets = self._weights[key]
+
+        shape = (data.shape[0], self.nb_points)
+        if self._scratch is None or self._scratch.shape != shape\
+           or self._scratch.dtype != dtype:
+
+            self._scratch = np.empty(shape, dtype=dtype)
+            self._result  = np.empty((shape[0], weights.shape[1]), dtype=dtype)
+
+        # The copy gives a contiguous array to the matrix product even for the
+        # interleaved channels
+        np.copyto(self._scratch, data[:,:self.nb_points], casting='unsafe')
+
+        np.dot(self._scratch, weights, out=self._result)
+        np.subtract(self._result, offsets, out=self._result)
+
+        return self._result
+
+
+
+class DecimatingFilter(object):
+    """
+        Low-pass filter of records computed at a reduced rate.
+        The records are first decimated by a CIC filter, a cascade of
+        cic_order boxcars of the decimation length of which only one sample
+        every decimation samples is kept. They are then filtered by
+        second-order sections designed for the reduced rate.
+        The CIC filter is computed in polyphase form, each kept sample being
+        a product of the cic_order last blocks of decimation samples with
+        the phases of the impulse response, so that the whole treatment
+        costs a few operations per sample.
+    """
+
+    # Ratio between the reduced Nyquist frequency and the cutoff frequency,
+    # so that the CIC droop and aliasing stay negligible in the pass band
+    oversampling = 10
+
+
+
+    def __init__(self, sos, decimation=1, cic_order=3):
+        """
+            Input:
+                - sos (array): second-order sections of the filter at the
+                  reduced rate.
+                - decimation (int): ratio between the sample rate of the
+                  records and the one of the filtered records.
+                - cic_order (int): number of boxcars of the CIC filter.
+        """
+
+        self.sos        = sos
+        self.decimation = int(decimation)
+        self.cic_order  = int(cic_order)
+
+        if self.decimation < 1 or self.cic_order < 1:
+            raise ValueError('The decimation and the CIC order must be '
+                             'positive integers')
+
+        # Impulse response of the boxcars, each one adding decimation - 1
+        # samples to the response
+        response = np.ones(self.decimation)/self.decimation
+        for stage in range(self.cic_order - 1):
+            total = np.cumsum(np.append(response, np.zeros(self.decimation - 1)))
+            response = np.copy(total)
+            response[self.decimation:] -= total[:-self.decimation]
+            response /= self.decimation
+
+        response = np.append(response, np.zeros(self.cic_order - 1))
+
+        # phases[m, p] weights the sample p of the block m blocks before the
+        # kept sample
+        self.phases = response.reshape(self.cic_order, self.decimation)[:, ::-1]
+
+
+
+    @classmethod
+    def decimation_for(cls, cutoff, nb_points):
+        """
+            Return the largest decimation keeping the cutoff frequency well
+            below the reduced Nyquist frequency.
+
+            Input:
+                - cutoff (float): cutoff frequency over the Nyquist frequency
+                  of the records, as given to scipy.signal.
+                - nb_points (int): number of samples of a record.
+        """
+
+        return int(max(1, min(1./(cls.oversampling*cutoff), nb_points)))
+
+
+
+    def __call__(self, data):
+        """
+            Return the filtered records, one every decimation samples, as an
+            array (records, samples//decimation).
+        """
+
+        decimation = self.decimation
+
+        if decimation > 1:
+
+            nb_blocks = data.shape[1]//decimation
+            blocks    = data[:, :nb_blocks*decimation].reshape(data.shape[0],
+                                                               nb_blocks,
+                                                               decimation)
+
+            # The blocks before the start of a record are zero
+            data = np.dot(blocks, self.phases[0])
+            for m in range(1, min(self.cic_order, nb_blocks)):
+                data[:, m:] += np.dot(blocks[:, :-m], self.phases[m])
+
+        return scisig.sosfilt(self.sos, data, axis=1)
+
+
+
+class SequenceAssembler(object):
+    """
+        Cut a stream of buffers in sequences of nb_sequence records.
+        The records of a sequence spanning several buffers are copied in an
+        array allocated once, filled through a write cursor. The sequences
+        fully contained in a buffer are given as views of the buffer.
+    """
+
+
+
+    def __init__(self, nb_sequence):
+
+        self.nb_sequence = int(nb_sequence)
+        self.cursor      = 0
+        self.stored      = None
+
+
+
+    def reset(self):
+        """
+            Forget the records stored so far.
+        """
+
+        self.cursor = 0
+
+
+
+    def sequences(self, data):
+        """
+            Iterate over the complete sequences available after the buffer
+            data, records along the first axis.
+            A yielded sequence is only valid until the next iteration.
+        """
+
+        if self.stored is None:
+            self.stored = np.empty((self.nb_sequence,) + data.shape[1:],
+                                   dtype=data.dtype)
+
+        start = 0
+
+        # We first complete the sequence started in the previous buffers
+        if self.cursor:
+
+            nb_records = min(self.nb_sequence - self.cursor, data.shape[0])
+
+            self.stored[self.cursor:self.cursor + nb_records] = data[:nb_records]
+            self.cursor += nb_records
+            start        = nb_records
+
+            if self.cursor < self.nb_sequence:
+                return
+
+            self.cursor = 0
+            yield self.stored
+
+        # Next the sequences fully contained in the buffer
+        while start + self.nb_sequence <= data.shape[0]:
+
+            yield data[start:start + self.nb_sequence]
+            start += self.nb_sequence
+
+        # The records left are stored for the next buffer, they are copied
+        # since the slot of the ring is released after the treatment
+        nb_records = data.shape[0] - start
+        self.stored[:nb_records] = data[start:]
+        self.cursor = nb_records
+
+
+
+class Accumulator(object):
+    """
+        Running mean and standard deviation of a stream of data.
+        The count, the mean and the sum of squared deviations from the mean
+        are updated in place (Welford and Chan et al. method), so that long
+        averages cost no new allocation and give the pooled standard
+        deviation of all the data added so far.
+    """
+
+
+
+    def __init__(self):
+
+        self.count = 0
+        self.mean  = None
+        self.m2    = None
+
+
+
+    def __getstate__(self):
+
+        # Only the statistics travel between processes, the working arrays
+        # are allocated again where needed
+        return {'count' : self.count,
+                'mean'  : self.mean,
+                'm2'    : self.m2}
+
+
+
+    def __setstate__(self, state):
+
+        self.__init__()
+        self.merge_state(state['count'], state['mean'], state['m2'])
+
+
+
+    def reset(self):
+        """
+            Forget all the data added so far.
+            The arrays already allocated are kept and zeroed.
+        """
+
+        self.count = 0
+
+        if self.mean is not None:
+            self.mean.fill(0.)
+            self.m2.fill(0.)
+
+
+
+    def _allocate(self, shape):
+
+        self.mean = np.zeros(shape)
+        self.m2   = np.zeros(shape)
+
+        # Working arrays reused by every update
+        self._batch_mean = np.zeros(shape)
+        self._batch_m2   = np.zeros(shape)
+        self._delta      = np.zeros(shape)
+        self._step       = np.zeros(shape)
+
+
+
+    def _combine(self, count, mean, m2):
+        """
+            Combine the statistics (count, mean, m2) of a set of data with the
+            current ones.
+        """
+
+        if self.mean is None:
+            self._allocate(np.shape(mean))
+
+        total = self.count + count
+
+        np.subtract(mean, self.mean, out=self._delta)
+
+        np.multiply(self._delta, count/float(total), out=self._step)
+        self.mean += self._step
+
+        self._delta *= self._delta
+        self._delta *= self.count*count/float(total)
+        self.m2 += m2
+        self.m2 += self._delta
+
+        self.count = total
+
+
+
+    def add(self, value):
+        """
+            Add a single observation, scalar or array.
+        """
+
+        if self.mean is None:
+            self._allocate(np.shape(value))
+
+        self.count += 1
+
+        np.subtract(value, self.mean, out=self._delta)
+
+        np.multiply(self._delta, 1./self.count, out=self._step)
+        self.mean += self._step
+
+        np.subtract(value, self.mean, out=self._step)
+        self._step *= self._delta
+        self.m2 += self._step
+
+
+
+    def update(self, values):
+        """
+            Add a batch of observations stacked along the first axis.
+        """
+
+        count = values.shape[0]
+
+        if count == 0:
+            return
+
+        if self.mean is None:
+            self._allocate(values.shape[1:])
+
+        # Mean of the batch, then sum of the squared deviations from it.
+        # Subtracting the mean of a sum of squares would lose the precision
+        # of data with a large offset
+        np.sum(values, axis=0, dtype=np.float64, out=self._batch_mean)
+        self._batch_mean /= count
+
+        deviations = np.subtract(values, self._batch_mean, dtype=np.float64)
+        np.einsum('i...,i...->...', deviations, deviations,
+                  out=self._batch_m2)
+
+        self._combine(count, self._batch_mean, self._batch_m2)
+
+
+
+    def merge(self, other):
+        """
+            Add all the data of another accumulator.
+        """
+
+        self.merge_state(other.count, other.mean, other.m2)
+
+
+
+    def merge_state(self, count, mean, m2):
+        """
+            Add all the data summarized by their count, mean and sum of
+            squared deviations from the mean.
+        """
+
+        if count == 0:
+            return
+
+        self._combine(count, mean, m2)
+
+
+
+    @staticmethod
+    def _copy(data):
+
+        # Scalar statistics are returned as float, as the previous averaging
+        if np.ndim(data) == 0:
+            return data[()]
+
+        return np.copy(data)
+
+
+
+    def get_mean(self):
+        """
+            Return a copy of the current mean.
+        """
+
+        return self._copy(self.mean)
+
+
+
+    def get_std(self):
+        """
+            Return the current standard deviation.
+        """
+
+        return self._copy(np.sqrt(np.maximum(self.m2, 0.)/self.count))
+
+
+
+    def get_standard_error(self):
+        """
+            Return the current standard error of the mean.
+        """
+
+        return self._copy(np.sqrt(np.maximum(self.m2, 0.))/self.count)
+
+
+
+class CodeAccumulator(Accumulator):
+    """
+        Running mean and standard deviation of the raw data of the board,
+        kept as integer sums of the sample codes and of their squares instead
+        of statistics in V.
+        The 12-bit codes of a batch are summed and squared in 32-bit
+        integers, by blocks of records small enough not to overflow, and
+        added to 64-bit totals so that the sums are exact. The sums of codes
+        given in FPGA_AVERAGE mode are too large to be squared in integers,
+        the total of their squares is kept in float64.
+        The conversion in V is done once, from the totals, when the mean or
+        the standard deviation is asked.
+    """
+
+    # Number of records whose squared 12-bit codes can be summed in uint32
+    block = 256
+
+
+
+    def __init__(self):
+
+        self.count   = 0
+        self.total   = None
+        self.squares = None
+
+
+
+    def __getstate__(self):
+
+        return {'count'   : self.count,
+                'total'   : self.total,
+                'squares' : self.squares}
+
+
+
+    def __setstate__(self, state):
+
+        self.__init__()
+
+        if state['total'] is not None:
+            self._allocate(state['total'].shape, state['squares'].dtype)
+            self.merge_state(state['count'], state['total'], state['squares'])
+
+
+
+    def reset(self):
+        """
+            Forget all the data added so far.
+            The arrays already allocated are kept and zeroed.
+        """
+
+        self.count = 0
+
+        if self.total is not None:
+            self.total.fill(0)
+            self.squares.fill(0)
+
+
+
+    def _allocate(self, shape, square_dtype):
+
+        self.total   = np.zeros(shape, dtype=np.int64)
+        self.squares = np.zeros(shape, dtype=square_dtype)
+
+        # Working arrays reused by every update
+        self._codes         = None
+        self._block_total   = np.zeros(shape, dtype=np.uint32)
+        self._block_squares = np.zeros(shape, dtype=np.uint32)
+
+
+
+    def add(self, value, shift=0):
+        """
+            Add a single observation, an array of raw data.
+        """
+
+        if self.total is None or value.dtype.itemsize > 2:
+            self.update(value[np.newaxis], shift)
+            return
+
+        # A single square of 12-bit codes fits in uint32
+        if shift:
+            if self._codes is None or self._codes.shape != value.shape:
+                self._codes = np.empty(value.shape, dtype=value.dtype)
+
+            np.right_shift(value, shift, out=self._codes)
+            value = self._codes
+
+        np.multiply(value, value, dtype=np.uint32, out=self._block_squares)
+
+        self.total   += value
+        self.squares += self._block_squares
+        self.count   += 1
+
+
+
+    def update(self, values, shift=0):
+        """
+            Add a batch of observations of raw data stacked along the first
+            axis, their codes being the data right-shifted by shift bits.
+        """
+
+        count = values.shape[0]
+
+        if count == 0:
+            return
+
+        if self.total is None:
+            if values.dtype.itemsize <= 2:
+                self._allocate(values.shape[1:], np.int64)
+            else:
+                self._allocate(values.shape[1:], np.float64)
+
+        if shift:
+            if self._codes is None or self._codes.shape != values.shape:
+                self._codes = np.empty(values.shape, dtype=values.dtype)
+
+            np.right_shift(values, shift, out=self._codes)
+            values = self._codes
+
+        if self.squares.dtype == np.int64:
+
+            for start in range(0, count, self.block):
+
+                codes = values[start:start + self.block]
+
+                np.add.reduce(codes, axis=0, dtype=np.uint32,
+                              out=self._block_total)
+                np.einsum('i...,i...->...', codes, codes, dtype=np.uint32,
+                          out=self._block_squares)
+
+                self.total   += self._block_total
+                self.squares += self._block_squares
+        else:
+            self.total   += np.sum(values, axis=0, dtype=np.int64)
+            self.squares += np.einsum('i...,i...->...', values, values,
+                                      dtype=np.float64)
+
+        self.count += count
+
+
+
+    def merge(self, other):
+        """
+            Add all the data of another accumulator.
+        """
+
+        self.merge_state(other.count, other.total, other.squares)
+
+
+
+    def merge_state(self, count, total, squares):
+        """
+            Add all the data summarized by their count, sum and sum of
+            squares.
+        """
+
+        if count == 0:
+            return
+
+        if self.total is None:
+            self._allocate(np.shape(total), squares.dtype)
+
+        self.total   += total
+        self.squares += squares
+        self.count   += count
+
+
+
+    def get_mean(self, scale=1., offset=0.):
+        """
+            Return the current mean as scale*codes - offset, the codes by
+            default.
+        """
+
+        return self._copy(self.total*(scale/self.count) - offset)
+
+
+
+    def get_std(self, scale=1.):
+        """
+            Return the current standard deviation as scale*codes, the codes
+            by default.
+        """
+
+        mean = self.total*(1./self.count)
+        mean *= mean
+
+        variance  = self.squares*(1./self.count)
+        variance -= mean
+        np.maximum(variance, 0., out=variance)
+        np.sqrt(variance, out=variance)
+        variance *= scale
+
+        if np.ndim(variance) == 0:
+            return variance[()]
+
+        return variance
+
+
+
+    def get_standard_error(self, scale=1.):
+        """
+            Return the current standard error of the mean as scale*codes,
+            the codes by default.
+        """
+
+        return self.get_std(scale)/np.sqrt(self.count)
+
+
+
+class IQHistogram(object):
+    """
+        Histogram in the IQ plane of single shots, one per step of the
+        sequence, filled as the sequences are treated so that its size does
+        not depend on the number of shots.
+        The shots outside of the real and imaginary ranges are not binned
+        but are still counted and assigned a state.
+
+        The shots may be assigned a state by a threshold on their projection
+        on the axis of angle "angle" in the IQ plane, the state 1 being above
+        the threshold:
+            - a float threshold assigns each shot as it comes and counts the
+              shots in the state 1 per step.
+            - an 'auto' threshold follows the shots: the projections are
+              histogrammed per step and the threshold is the one separating
+              best the two populations of all the steps (Otsu method),
+              computed when the result is asked.
+        Without assignment, or before the threshold is known, the threshold
+        is NaN and so is the population of each step, for the results to
+        keep the same types.
+    """
+
+
+
+    def __init__(self, real_range, imag_range, bins=100, threshold=None,
+                 angle=0.):
+        """
+            Input:
+                - real_range (tuple): (min, max) of the real part in V.
+                - imag_range (tuple): (min, max) of the imaginary part in V.
+                - bins (int or tuple): number of bins of each axis, or
+                  (real bins, imaginary bins).
+                - threshold (float, 'auto' or None): threshold of the state
+                  assignment in V, None for no assignment.
+                - angle (float): angle of the assignment axis in rad.
+        """
+
+        if np.ndim(bins) == 0:
+            bins = (bins, bins)
+
+        self.bins = (int(bins[0]), int(bins[1]))
+
+        if min(self.bins) < 1:
+            raise ValueError('The number of bins must be larger than 1')
+
+        self.edges_real = np.linspace(real_range[0], real_range[1], self.bins[0] + 1)
+        self.edges_imag = np.linspace(imag_range[0], imag_range[1], self.bins[1] + 1)
+
+        if not self.edges_real[-1] > self.edges_real[0]\
+           or not self.edges_imag[-1] > self.edges_imag[0]:
+            raise ValueError('The ranges must be given as (min, max)')
+
+        if threshold is not None and threshold != 'auto':
+            threshold = float(threshold)
+
+        self.threshold = threshold
+        self.angle     = float(angle)
+
+        if self.threshold == 'auto':
+
+            # The projections span the projection of the corners of the
+            # binned area
+            corners = np.cos(self.angle)*np.array(real_range)[:, None]\
+                      + np.sin(self.angle)*np.array(imag_range)[None, :]
+
+            self.edges_projection = np.linspace(corners.min(), corners.max(),
+                                                2*max(self.bins) + 1)
+
+        self.count = 0
+        self.counts = None
+
+
+
+    def reset(self):
+        """
+            Forget all the shots added so far.
+            The arrays already allocated are kept and zeroed.
+        """
+
+        self.count = 0
+
+        if self.counts is not None:
+            self.counts.fill(0)
+            self.states.fill(0)
+
+
+
+    def _allocate(self, nb_steps):
+
+        self.counts = np.zeros((nb_steps,) + self.bins, dtype=np.int64)
+
+        # Shots in the state 1, or histogram of the projections, per step
+        if self.threshold == 'auto':
+            self.states = np.zeros((nb_steps, len(self.edges_projection) + 1),
+                                   dtype=np.int64)
+        else:
+            self.states = np.zeros(nb_steps, dtype=np.int64)
+
+        self._steps = np.arange(nb_steps)
+
+
+
+    @staticmethod
+    def _bin(values, edges):
+        """
+            Return the bin of each value, -1 or len(edges) - 1 when out of
+            the edges.
+        """
+
+        index = np.floor((values - edges[0])*((len(edges) - 1)\
+                                              /(edges[-1] - edges[0])))
+
+        return np.clip(index, -1, len(edges) - 1).astype(np.intp)
+
+
+
+    def update(self, real, imag):
+        """
+            Add one shot per step, real and imag being arrays of one value
+            per step.
+        """
+
+        if self.counts is None:
+            self._allocate(len(real))
+
+        self.count += 1
+
+        index_real = self._bin(real, self.edges_real)
+        index_imag = self._bin(imag, self.edges_imag)
+
+        inside = (index_real >= 0) & (index_real < self.bins[0])\
+                 & (index_imag >= 0) & (index_imag < self.bins[1])
+
+        # There is a single shot per step, each bin is incremented once
+        self.counts[self._steps[inside], index_real[inside], index_imag[inside]] += 1
+
+        if self.threshold is None:
+            return
+
+        projection = np.cos(self.angle)*real + np.sin(self.angle)*imag
+
+        if self.threshold == 'auto':
+            # The first and last bins gather the projections out of the edges
+            index = np.searchsorted(self.edges_projection, projection)
+            self.states[self._steps, index] += 1
+        else:
+            self.states += projection > self.threshold
+
+
+
+    def merge(self, other):
+        """
+            Add all the shots of another histogram of the same bins.
+        """
+
+        if other.counts is None:
+            return
+
+        if self.counts is None:
+            self._allocate(len(other.counts))
+
+        self.count  += other.count
+        self.counts += other.counts
+        self.states += other.states
+
+
+
+    def get_threshold(self):
+        """
+            Return the threshold of the state assignment in V, NaN without
+            assignment or as long as it is unknown.
+        """
+
+        if self.threshold is None:
+            return np.nan
+
+        if self.threshold != 'auto':
+            return self.threshold
+
+        if self.counts is None:
+            return np.nan
+
+        # Otsu method on the projections of all the steps, the threshold
+        # maximizes the variance between the populations on both sides
+        histogram = self.states.sum(axis=0)[1:-1].astype(np.float64)
+        centers   = (self.edges_projection[1:] + self.edges_projection[:-1])/2.
+
+        weight_low  = np.cumsum(histogram)[:-1]
+        weight_high = histogram.sum() - weight_low
+        sum_low     = np.cumsum(histogram*centers)[:-1]
+        sum_high    = np.sum(histogram*centers) - sum_low
+
+        valid = (weight_low > 0) & (weight_high > 0)
+
+        if not np.any(valid):
+            return np.nan
+
+        between = np.zeros_like(weight_low)
+        between[valid] = weight_low[valid]*weight_high[valid]\
+                         *(sum_low[valid]/weight_low[valid]\
+                           - sum_high[valid]/weight_high[valid])**2
+
+        return self.edges_projection[np.argmax(between) + 1]
+
+
+
+    def get_population(self):
+        """
+            Return the fraction of the shots in the state 1 per step, NaN
+            for each step without assignment or as long as the threshold is
+            unknown, an empty array before the first shot.
+        """
+
+        if self.counts is None:
+            return np.zeros(0)
+
+        if self.threshold is None:
+            return np.full(len(self.counts), np.nan)
+
+        if self.threshold != 'auto':
+            return self.states/float(self.count)
+
+        threshold = self.get_threshold()
+
+        if np.isnan(threshold):
+            return np.full(len(self.counts), np.nan)
+
+        # The projections above the threshold, out of the edges included
+        index = np.searchsorted(self.edges_projection, threshold)
+
+        return self.states[:, index + 1:].sum(axis=1)/float(self.count)
+
+
+
+    def get_counts(self):
+        """
+            Return a copy of the counts as an array (steps, real bins,
+            imaginary bins), without step before the first shot.
+        """
+
+        if self.counts is None:
+            return np.zeros((0,) + self.bins, dtype=np.int64)
+
+        return np.copy(self.counts)
+
+
 
 class DataTreatment(object):
     """
         Canvas for data treatment class.
         Should only be used as parent class
+
+        The type of the data in V is given by the volt_dtype attribute,
+        set it to np.float32 to halve the memory bandwidth of the treatment.
     """
 
+    volt_dtype = np.float64
+
+    # Number of records co-added by the board, set from the parameters of
+    # the measurement
+    records_per_average = 1
+
+    # StageTimer of the treatment process, None outside of a measurement
+    timer = None
+
+    # Stages timed inside the "process" method, the rest of its duration is
+    # counted as averaging
+    inner_stages = ('conversion', 'demodulation', 'result_publish')
+
+
+
+    def _volt_converter(self):
+        """
+            Return the VoltConverter of the processor, built at the first
+            call in the treatment process.
+        """
+
+        converter = self.__dict__.get('volt_converter')
+
+        if converter is None or converter.dtype != self.volt_dtype\
+           or converter.records_per_average != self.records_per_average:
+
+            converter = VoltConverter(self.volt_dtype, self.records_per_average)
+            self.volt_converter = converter
+
+        return converter
+
+
+
+    def data_in_volt(self, data):
+        """
+            Get raw data coming from the board and transform them in V.
+            The returned array is reused by the next call, it should not be
+            kept from one buffer to the other.
+        """
+
+        converter = self._volt_converter()
+
+        if self.timer is None:
+            return converter(data)
+
+        start = monotonic()
+        data  = converter(data)
+        self.timer.lap('conversion', start)
+
+        return data
+
+
+
+    def demodulate(self, data):
+        """
+            Get raw data coming from the board and return their projection in
+            V on the references of self.demodulator, as an array
+            (records, references).
+            The returned array is reused by the next call.
+        """
+
+        if self.timer is None:
+            return self.demodulator(data, self.volt_dtype,
+                                    self.records_per_average)
+
+        start = monotonic()
+        data  = self.demodulator(data, self.volt_dtype,
+                                 self.records_per_average)
+        self.timer.lap('demodulation', start)
+
+        return data
+
+
+
+    @staticmethod
+    def data_2D(data, parameters):
+        """
+            From the data returned by the board,
+            the method makes a 2D array of them knowing the board's parameters.
+        """
+
+        # We reshape them in 2D-array to enhance the averaging
+        # print type(parameters['records_per_buffer'])
+        # print type(parameters['samplesPerRecord'])
+        # print parameters['records_per_buffer']
+        # print parameters['samplesPerRecord']
+
+
+        # With NPT footers, each record ends with footer_samples samples which
+        # are left out through a view
+        samplesPerRecord = parameters['samplesPerRecord']
+        recordLength     = samplesPerRecord + parameters['footer_samples']
+
+        # A slot of the ring can be larger than the buffer (FFT mode)
+        nb_samples = parameters['records_per_buffer']*recordLength
+
+        # In CHANNEL_AB mode the samples of the two channels are interleaved,
+        # the channels are deinterleaved through a view of shape
+        # (records, samples, channels)
+        if parameters['mode'] == 'CHANNEL_AB':
+
+            data = np.reshape(data[:2*nb_samples], (parameters['records_per_buffer'], recordLength, 2))
+        else:
+            data = np.reshape(data[:nb_samples], (parameters['records_per_buffer'], recordLength))
+
+        return data[:, :samplesPerRecord]
+
+
+
+    @staticmethod
+    def bitwise(data):
+        """
+            Right-shift 16-bit sample value by 4 to get 12-bit sample code
+        """
+        return data >> 4
+
+
+
+    def process_sequence(self, data, queue_treatment, parameters):
+        """
+            Send a whole sequence to the "process" method.
+            In CHANNEL_AB mode, each channel is treated by its own processor
+            state and the results are sent together as (result_a, result_b).
+        """
+
+        timer = self.timer
+        if timer is not None:
+            start = monotonic()
+            inner = timer.total(*self.inner_stages)
+
+        if parameters['mode'] == 'CHANNEL_AB':
+
+            # The channel B processor follows the counters of the channel A one
+            self.channel_b.treated_buffer   = self.treated_buffer
+            self.channel_b.treated_sequance = self.treated_sequance
+
+            self.process(data[:, :, 0], self.result_a, parameters)
+            self.channel_b.process(data[:, :, 1], self.result_b, parameters)
+
+            queue_treatment.put((self.result_a.result, self.result_b.result))
+        else:
+            self.process(data, queue_treatment, parameters)
+
+        if timer is not None:
+            timer.add('averaging', monotonic() - start\
+                                   - (timer.total(*self.inner_stages) - inner))
+
+
+
+    def assemble_sequences(self, data, queue_treatment, parameters):
+        """
+            Organise data when the number of records per buffer is not the
+            number of acquired sequences.
+            Complete sequences are sent to "process_sequence" as views, either
+            of the buffer or of the assembler when a sequence spans several
+            buffers.
+        """
+
+        for sequence in self.assembler.sequences(data):
+
+            self.process_sequence(sequence, queue_treatment, parameters)
+            self.treated_sequance += 1
+
+
+
+    @staticmethod
+    def sequence_aligned_buffers(records_per_buffer, nb_sequence):
+        """
+            Return the smallest number of consecutive buffers containing an
+            integer number of sequences.
+        """
+
+        a, b = records_per_buffer, nb_sequence
+        while b:
+            a, b = b, a%b
+
+        return nb_sequence//a
+
+
+
+    def result_bytes(self, samplesPerRecord, nb_channels, nb_sequence,
+                     nb_records):
+        """
+            Return an upper bound in bytes of the arrays of a result, for the
+            result slot to be sized before the measurement starts.
+            It allows four float arrays per channel of the size of a
+            sequence, as (amp_mean, amp_std, phase_mean, phase_std), and three
+            float per record for the processors returning the raw real and
+            imaginary parts. A processor sending larger results redefines it.
+
+            Input:
+                - samplesPerRecord (int): samples of a record per channel.
+                - nb_channels (int)
+                - nb_sequence (int)
+                - nb_records (int): records of the whole acquisition.
+        """
+
+        return 8*nb_channels*(4*samplesPerRecord*nb_sequence + 3*nb_records)
+
+
+
+    def _prepare_channels(self, parameters):
+        """
+            In CHANNEL_AB mode, a single worker treats both channels.
+            The channel B gets a copy of the processor, reference tables
+            included, before any data has been treated.
+            Return the number of treated channels.
+        """
+
+        # In FPGA_AVERAGE mode, the records are sums computed by the board
+        self.records_per_average = parameters['records_per_average']
+
+        if parameters['mode'] == 'CHANNEL_AB':
+            self.channel_b = copy.deepcopy(self)
+            self.result_a  = ChannelResult()
+            self.result_b  = ChannelResult()
+
+            return 2
+
+        return 1
+
+
+
+    def _set_timer(self, timer):
+        """
+            Time the stages of the treatment with timer, channel B included.
+        """
 
-    @staticmethod
-    def data_in_volt(data):
+        self.timer = timer
+
+        if 'channel_b' in vars(self):
+            self.channel_b.timer = timer
+
+
+
+    def _accumulators(self):
         """
-            Get raw data coming from the board and transform them in V.
+            Return the accumulators of the processor, channel B included, in a
+            fixed order.
         """
 
-        # Parameters of the board (are fixed).
-        # bitshift         = 4  # Sould be int
-        # bits_per_sample  = 12 # Sould be int
-        # inputRange_volts = 400e-3 # Fixed for the ats9360
+        accumulators = [value for name, value in sorted(vars(self).items())
+                        if isinstance(value, (Accumulator, IQHistogram))]
 
-        # Right-shift 16-bit sample value by 4 to get 12-bit sample code
-        data = data >> 4
+        if 'channel_b' in vars(self):
+            accumulators += self.channel_b._accumulators()
 
-        # AlazarTech digitizers are calibrated as follows
-        # codeZero  = (1 << (bits_per_sample - 1)) - 0.5
-        # codeRange = (1 << (bits_per_sample - 1)) - 0.5
-        # Following this a proportionality of 2047.5 is applied
-        # The calcul is inputRange_volts*(data - codeZero) / codeRange
+        return accumulators
 
-        return 0.4*(data - 2047.5)/2047.5
 
 
+    def _error_groups(self):
+        """
+            Return the groups of accumulators checked against the targets of
+            the averaging, as a list of tuples. The accumulators of a group
+            are the components of a vector in V, as the real and imaginary
+            parts of a demodulation.
+            By default each accumulator of the processor is a group. A
+            processor averaging quantities which are not in V, as a phase,
+            leaves them out of its groups.
+        """
 
-    @staticmethod
-    def data_2D(data, parameters):
+        return [(value,) for name, value in sorted(vars(self).items())
+                if isinstance(value, Accumulator)]
+
+
+
+    def standard_errors(self):
         """
-            From the data returned by the board,
-            the method makes a 2D array of them knowing the board's parameters.
+            Return the means of the quantities averaged so far with their
+            standard errors, as a list of (magnitude, error) in V, one per
+            group of accumulators of each channel, see _error_groups.
+            The magnitude and the error of a group are the norms of the means
+            and of the standard errors of its accumulators.
         """
 
-        # We reshape them in 2D-array to enhance the averaging
-        # print type(parameters['records_per_buffer'])
-        # print type(parameters['samplesPerRecord'])
-        # print parameters['records_per_buffer']
-        # print parameters['samplesPerRecord']
+        groups = self._error_groups()
 
+        if 'channel_b' in vars(self):
+            groups += self.channel_b._error_groups()
 
-        return np.reshape(data, (parameters['records_per_buffer'],parameters['samplesPerRecord']))
+        converter = self._volt_converter()
+        quantities = []
 
+        for group in groups:
 
+            if not all(accumulator.count for accumulator in group):
+                continue
 
-    def mean_averaging(self, current_average, new_data):
-        # print self.treated_sequance
+            mean  = 0.
+            error = 0.
 
-        return (self.treated_sequance*current_average + new_data)\
-              /(self.treated_sequance + 1.)
+            for accumulator in group:
 
+                if isinstance(accumulator, CodeAccumulator):
+                    mean  = mean + np.square(accumulator.get_mean(float(converter.scale),
+                                                                  float(converter.offset)))
+                    error = error + np.square(accumulator.get_standard_error(float(converter.scale)))
+                else:
+                    mean  = mean + np.square(accumulator.get_mean())
+                    error = error + np.square(accumulator.get_standard_error())
 
+            quantities.append((np.sqrt(mean), np.sqrt(error)))
 
-    @staticmethod
-    def bitwise(data):
+        return quantities
+
+
+
+    def converged(self, parameters):
         """
-            Right-shift 16-bit sample value by 4 to get 12-bit sample code
+            Return True once the averaging reached the targets of the
+            measurement, the standard error target "error_target" in V and
+            the signal to noise target "snr_target", for every point of the
+            averaged quantities and after at least "min_averaging"
+            sequences. A target of None is not checked.
+            Only the quantities of the groups of _error_groups are checked,
+            a processor without group is never stopped before the end of the
+            averaging.
         """
-        return data >> 4
 
+        error_target = parameters['error_target']
+        snr_target   = parameters['snr_target']
+
+        if error_target is None and snr_target is None:
+            return False
+
+        if self.treated_sequance < parameters['min_averaging']:
+            return False
 
+        quantities = self.standard_errors()
 
-    def std_averaging(self, current_std, new_std):
+        if not quantities:
+            return False
 
-        return np.sqrt((self.treated_sequance*current_std**2. + new_std**2.)\
-                      /(self.treated_sequance + 1.))
+        for magnitude, error in quantities:
 
+            if error_target is not None and np.max(error) > error_target:
+                return False
 
+            # A point without error has an infinite signal to noise ratio
+            if snr_target is not None\
+               and np.any(magnitude < snr_target*error):
+                return False
 
-    def many_sequences_per_buffer(self, data, queue_treatment, parameters):
+        return True
+
+
+
+    def _stop_if_converged(self, parameters):
         """
-            Organise data when the number of acquired sequences are smaller
-            than the number of records per buffer.
+            Stop the acquisition once the averaging has converged, the
+            buffers already acquired being treated.
         """
 
-        # For the first buffer, we initialize the data stored attribute
-        # witht the correct shape
-        if self.treated_buffer == 0:
-            self.data_stored = np.array([]).reshape(parameters['nb_sequence'], 0)
-        # If there are data stored from previous buffer
-        elif self.data_stored.shape[0] != parameters['nb_sequence']:
+        if parameters['measuring'] and self.converged(parameters):
+
+            parameters['measuring'] = False
+            parameters.add_message('Averaging target reached after %d sequences\n'\
+                                   % self.treated_sequance)
 
-            # Data used correspond to the data saved previously and
-            # data coming from the new buffer. We build an array combining
-            # these two sources of data.
-            self.process(np.vstack((self.data_stored,\
-                                   data[:parameters['nb_sequence'] - self.data_stored.shape[0]])),\
-                        queue_treatment, parameters)
 
-        # We iterate to empty the buffer by sending data in package
-        # corresponding to a whole sequence.
-        i = 0
-        while (i + 2)*parameters['nb_sequence'] - self.data_stored.shape[0] <= parameters['records_per_buffer']:
 
-            self.process(data[(i + 1)*parameters['nb_sequence'] - self.data_stored.shape[0]\
-                            :(i + 2)*parameters['nb_sequence'] - self.data_stored.shape[0]],\
-                        queue_treatment, parameters)
-            i += 1
+    def treat_buffer(self, data, queue_treatment, parameters):
+        """
+            Send the sequences of a 2D buffer to the "process" method.
+        """
 
-        # If there is data left but not enough to send a package, we store
-        # them for the next buffer.
-        i -= 1
-        if (i + 2)*parameters['nb_sequence'] - self.data_stored.shape[0] != data.shape[0]:
+        # If the number of sequence is equal to the number of records per buffer
+        # Then we can treat data immediately
+        if data.shape[0] == parameters['nb_sequence']:
 
-            self.data_stored = data[(i + 2)*parameters['nb_sequence'] - self.data_stored.shape[0]:]
-        # If not, we reinitialize the data stored attribute with an empty
-        # array
+            self.process_sequence(data, queue_treatment, parameters)
+            self.treated_sequance += 1
+        # Otherwise, we have to treat data per package, each package
+        # corresponding to a sequence.
         else:
-            self.data_stored = np.array([]).reshape(parameters['nb_sequence'], 0)
+            self.assemble_sequences(data, queue_treatment, parameters)
+
+
+
+    def close(self):
+        """
+            Called once all the buffers have been treated.
+            Can be defined in a child class to release its resources.
+        """
+
+        pass
 
 
 
-    def less_sequence_per_buffer(self, data, queue_treatment, parameters):
+    def _report(self, parameters, elapsed_time, nb_buffers, nb_channels):
         """
-            Organise data when the number of acquired sequences are greater
-            than the number of records per buffer.
+            Return information about the data treatment
         """
 
-        # For the first buffer, we initialize the data stored attribute
-        if self.treated_buffer == 0:
-            self.data_stored = data
+        acquired_samples = parameters['samplesPerRecord']*parameters['records_per_buffer']\
+                          *nb_buffers*nb_channels
+        # 2 bytes per sample, 4 for the sums of the FPGA_AVERAGE mode
+        if parameters['mode'] == 'FPGA_AVERAGE':
+            acquired_bytes = acquired_samples*4
         else:
+            acquired_bytes = acquired_samples*2
 
-            # If the new data are not enough to reach the number of sequence
-            # we store the whole measured buffer
-            if self.data_stored.shape[0] + data.shape[0] < parameters['nb_sequence']:
+        # Avoid a division by zero when no buffer has been treated
+        elapsed_time = max(elapsed_time, 1e-9)
 
-                self.data_stored  = np.vstack((self.data_stored, data))
-            # Otherwise, only a part of the buffer is use to store.
-            # The other part is stored for the next buffer
-            else:
-                self.process(np.vstack((self.data_stored,\
-                                        data[:parameters['nb_sequence']\
-                                        - self.data_stored.shape[0]])),\
-                            queue_treatment, parameters)
+        message  = 'Treatment completed in %f sec\n' % elapsed_time
+        message += 'Treated %d bytes (%f Mbytes per sec)\n' %\
+                   (acquired_bytes, acquired_bytes/elapsed_time/1024**2)
+        message += 'Treated %d samples (%f Ms per sec)\n' %\
+                   (acquired_samples, acquired_samples/elapsed_time/1e6)
 
-                self.data_stored = data[parameters['nb_sequence'] - self.data_stored.shape[0]:]
-                self.treated_sequance += 1
+        parameters.add_message(message)
 
 
 
-    def treat_data(self, queue_data, queue_treatment, parameters):
+    def treat_data(self, ring, queue_treatment, parameters):
         """
             Launch a loop to treat all the buffers acquired by the board.
             At each iteration, the method call "process" which should be
             defined in a child class.
+            Buffers are read in place from the slots of the shared memory
+            ring, which are released once treated.
         """
 
-        start_time = time.time()
+        start_time = monotonic()
         self.treated_buffer = 0
         self.treated_sequance = 0
+        self.assembler = SequenceAssembler(parameters['nb_sequence'])
+
+        nb_channels = self._prepare_channels(parameters)
+
+        # Each buffer is timed by stage, from the end of its acquisition, and
+        # each sequence if requested
+        timer = StageTimer()
+        if parameters['stage_timing']:
+            self._set_timer(timer)
+            queue_treatment = TimedQueue(queue_treatment, timer)
 
-        # We acquire as many buffer as the board has acquired
-        while parameters['measured_buffers'] is None or \
-              self.treated_buffer < parameters['measured_buffers']:
+        # The acquisition is stopped once the averaging reaches its target
+        adaptive = parameters['error_target'] is not None\
+                   or parameters['snr_target'] is not None
+
+        # We treat buffers up to the end of the acquisition
+        while True:
 
             # We obtain the data in a 2D array (acquired_sample, records)
-            data = self.data_2D(queue_data.get(), parameters)
-
-            # If the number of sequence is equal to the number of records per buffer
-            # Then we can treat data immediately
-            if data.shape[0] == parameters['nb_sequence']:
-
-                self.process(data, queue_treatment, parameters)
-                self.treated_sequance += 1
-            # If the number of sequence is smaller than the  number of acquired buffer
-            # We have to treat data per package, each package corresponding to
-            # a sequence.
-            elif data.shape[0] > parameters['nb_sequence']:
-
-                self.many_sequences_per_buffer(data, queue_treatment, parameters)
-                self.treated_sequance += 1
-            # If the number of sequence is larger than the number of records per
-            # buffer
-            else:
-                self.less_sequence_per_buffer(data, queue_treatment, parameters)
+            wait = monotonic()
+            index, data = ring.get()
+            if index is None:
+                break
+            timer.lap('queue_get', wait)
+
+            data = self.data_2D(data, parameters)
+
+            self.treat_buffer(data, queue_treatment, parameters)
 
+            # The slot is given back to the acquisition
+            acquired = ring.timestamp(index)
+            ring.release(index)
+            timer.lap('latency', acquired)
 
             # Each loop implies a treatment of one buffer
             self.treated_buffer += 1
 
-        # Return information about the data treatment
-        elapsed_time = time.time() - start_time
-        acquired_samples = parameters['samplesPerRecord']*parameters['records_per_buffer']\
-                          *parameters['measured_buffers']
-        acquired_bytes   = acquired_samples*2 # 2 bytes per sample
+            if adaptive:
+                self._stop_if_converged(parameters)
 
-        parameters['message'] += 'Treatment completed in %f sec\n' % elapsed_time
-        parameters['message'] += 'Treated %d bytes (%f Mbytes per sec)\n' %\
-                                 (acquired_bytes, acquired_bytes/elapsed_time/1024**2)
-        parameters['message'] += 'Treated %d samples (%f Ms per sec)\n' %\
-                                 (acquired_samples, acquired_samples/elapsed_time/1e6)
+        self._report(parameters, monotonic() - start_time,
+                     self.treated_buffer, nb_channels)
+        parameters.add_stage_timer(timer)
+        self.close()
 
         # Once the data are finished to be processed, we close the shared memory
-        queue_data.close()
+        ring.close()
+        queue_treatment.end()
         queue_treatment.close()
 
         # Inform the parent process that the data treatment is finished
-        if parameters['safe_treatment'][0]:
-            parameters['safe_treatment'][1] = True
+        parameters['safe_treatment'] = True
+
+
+
+    def treat_shard(self, ring, reader, nb_readers, unit_buffers,
+                    queue_partial, parameters):
+        """
+            Loop of one worker of a treatment pool.
+            The buffers are dealt by units of unit_buffers buffers, a unit
+            holding an integer number of sequences. Each unit is treated from
+            empty accumulators and, instead of results, the worker sends for
+            each buffer the number of results it gave and the state of its
+            accumulators at the end of the buffer, as
+            (buffer_index, (nb_results, state)).
+            Only processors defining a "result" method can be treated this
+            way.
+        """
+
+        self.treated_buffer = 0
+        self.treated_sequance = 0
+        self.assembler = SequenceAssembler(parameters['nb_sequence'])
+        self._prepare_channels(parameters)
+
+        accumulators = self._accumulators()
+        partial      = PartialResults(accumulators)
+
+        timer = StageTimer()
+        if parameters['stage_timing']:
+            self._set_timer(timer)
+            queue = TimedQueue(partial, timer)
         else:
-            parameters['safe_treatment'][0] = True
+            queue = partial
+
+        # Index of the buffer in the whole acquisition
+        buffer_index = reader*unit_buffers
+
+        while True:
+
+            wait = monotonic()
+            index, data = ring.get(reader)
+            if index is None:
+                break
+            timer.lap('queue_get', wait)
+
+            # A unit starts with no stored records and empty accumulators
+            if buffer_index%unit_buffers == 0:
+                self.assembler.reset()
+                for accumulator in accumulators:
+                    accumulator.reset()
+
+            data = self.data_2D(data, parameters)
+
+            self.treat_buffer(data, queue, parameters)
+
+            acquired = ring.timestamp(index)
+            ring.release(index)
+
+            start = monotonic()
+            queue_partial.put((buffer_index, partial.pop()))
+            timer.lap('result_publish', start)
+            timer.lap('latency', acquired)
+
+            self.treated_buffer += 1
+            buffer_index += 1
+
+            # We jump over the units of the other workers
+            if buffer_index%unit_buffers == 0:
+                buffer_index += (nb_readers - 1)*unit_buffers
+
+        # The reducer is informed that the worker has finished
+        queue_partial.put((None, None))
+
+        parameters.add_stage_timer(timer)
+
+        ring.close()
+        queue_partial.close()
+
+
+
+    def reduce_data(self, queue_partial, queue_treatment, nb_readers,
+                    unit_buffers, parameters):
+        """
+            Merge, in the acquisition order, the states sent by the workers of
+            a treatment pool and send, for each buffer, the last result
+            treat_data would send.
+            Stop once all the workers have finished.
+        """
+
+        start_time = monotonic()
+
+        nb_channels  = self._prepare_channels(parameters)
+        accumulators = self._accumulators()
+
+        timer = StageTimer()
+        queue_treatment = TimedQueue(queue_treatment, timer)
+
+        # Statistics of all the units merged so far and of the current unit,
+        # the accumulators being still empty
+        total   = [copy.deepcopy(accumulator) for accumulator in accumulators]
+        current = None
+
+        # States received before their turn
+        pending = {}
+
+        # The acquisition is stopped once the averaging reaches its target
+        adaptive = parameters['error_target'] is not None\
+                   or parameters['snr_target'] is not None
+        self.treated_sequance = 0
+
+        buffer_index = 0
+        nb_finished  = 0
+        while True:
+
+            while buffer_index not in pending and nb_finished < nb_readers:
+                wait = monotonic()
+                index, states = queue_partial.get()
+                timer.lap('queue_get', wait)
+
+                if index is None:
+                    nb_finished += 1
+                else:
+                    pending[index] = states
+
+            if buffer_index not in pending:
+                break
+
+            nb_results, state = pending.pop(buffer_index)
+
+            # The last state of a unit contains the whole unit
+            if buffer_index%unit_buffers == 0 and current is not None:
+                for accumulator, unit in zip(total, current):
+                    accumulator.merge(unit)
+                current = None
+
+            # Only the latest result is read, the intermediate results of the
+            # buffer are not rebuilt but still counted in the version
+            if state is not None:
+
+                for accumulator, base, partial in zip(accumulators, total, state):
+                    accumulator.reset()
+                    accumulator.merge(base)
+                    accumulator.merge(partial)
+
+                if parameters['mode'] == 'CHANNEL_AB':
+                    queue_treatment.put((self.result(), self.channel_b.result()),
+                                        nb_results)
+                else:
+                    queue_treatment.put(self.result(), nb_results)
+
+                current = state
+
+            self.treated_sequance += nb_results
+            buffer_index += 1
+
+            if adaptive:
+                self._stop_if_converged(parameters)
+
+        self._report(parameters, monotonic() - start_time,
+                     buffer_index, nb_channels)
+        parameters.add_stage_timer(timer)
+
+        queue_partial.close()
+        queue_treatment.end()
+        queue_treatment.close()
+
+        # Inform the parent process that the data treatment is finished
+        parameters['safe_treatment'] = True
+
+
+
+class PartialResults(object):
+    """
+        Stand-in for the treatment queue in a worker of a treatment pool.
+        The results sent by the processor are only counted: the accumulators
+        only grow within a buffer, so their state at the end of the buffer
+        holds its last result. Copying them after each sequence would send
+        the whole accumulators as many times as the buffer has sequences.
+    """
+
+
+
+    def __init__(self, accumulators):
+
+        self.accumulators = accumulators
+        self.nb_results   = 0
+
+
+
+    def put(self, result, count=1):
+
+        self.nb_results += count
+
+
+
+    def pop(self):
+        """
+            Return the number of results sent since the last call and a copy
+            of the accumulators, None when no result was sent.
+        """
+
+        nb_results, self.nb_results = self.nb_results, 0
+
+        if nb_results == 0:
+            return 0, None
+
+        return nb_results, [copy.deepcopy(accumulator)
+                            for accumulator in self.accumulators]
+
+
+
+class ChannelResult(object):
+    """
+        Keep the last result put by the processor of one channel in
+        CHANNEL_AB mode, in place of the treatment queue.
+    """
+
+    def __init__(self):
+
+        self.result = None
+
+    def put(self, result):
+
+        self.result = result
 
 
 class Raw(DataTreatment):
@@ -243,16 +1750,92 @@ class Raw(DataTreatment):
         self.data = np.append(self.data, data)
         queue_treatment.put(self.data)
 
+    def result_bytes(self, samplesPerRecord, nb_channels, nb_sequence,
+                     nb_records):
+        """
+            The result grows up to every sample of the acquisition, as float.
+        """
+
+        return 8*nb_channels*samplesPerRecord*nb_records
+
+
+class RawStream(DataTreatment):
+    """
+        Write the raw data, as given by the board, in a file while they are
+        acquired.
+        The file is a npy file of shape (buffers, records, samples), with a
+        last axis of length 2 in CHANNEL_AB mode, read afterwards by
+        np.load(filename, mmap_mode='r').
+        Only the progress of the capture is sent to the treatment queue as
+        (treated_buffers, preview) where preview is the first record of the
+        last buffer.
+    """
+
+    def __init__(self, filename):
+        """
+            Input:
+                - filename (str): path of the npy file, overwritten.
+        """
+
+        self.filename = filename
+        self.file     = None
+
+        # Number of records written so far
+        self.records  = 0
+
+
+    def treat_buffer(self, data, queue_treatment, parameters):
+
+        # The file is created by the treatment process
+        if self.file is None:
+            self.file = np.lib.format.open_memmap(self.filename, mode='w+',
+                dtype=data.dtype,
+                shape=(parameters['buffers_per_acquisition'],) + data.shape)
+
+        if self.treated_buffer < self.file.shape[0]:
+            self.file[self.treated_buffer] = data
+
+        # The progress counts the acquired sequences, as the other processors,
+        # with a single write of the preview standing for all of them
+        nb_sequences = (self.records + data.shape[0])//parameters['nb_sequence']\
+                       - self.records//parameters['nb_sequence']
+        self.records += data.shape[0]
+
+        # The preview is copied since the slot of the ring is released after
+        # the treatment
+        if nb_sequences:
+            preview = np.copy(data[0])
+            queue_treatment.put((self.treated_buffer + 1, preview), nb_sequences)
+
+
+    def close(self):
+
+        if self.file is not None:
+            self.file.flush()
+            self.file = None
+
 
 class Average(DataTreatment):
     """
         Class performing the average of the acquired data.
+        With integer set, the raw data are summed as integers and converted
+        in V only when a result is sent, see CodeAccumulator. It pays off
+        when many records are added between two results.
     """
 
-    def __init__(self):
+    def __init__(self, integer=False):
+        """
+            Input:
+                - integer (bool): if True, the averages are computed from
+                  integer sums of the sample codes.
+        """
 
-        self.mean = 0.
-        self.std  = 0.
+        self.integer = integer
+
+        if integer:
+            self.data = CodeAccumulator()
+        else:
+            self.data = Accumulator()
 
     def process(self, data, queue_treatment, parameters):
         """
@@ -262,41 +1845,57 @@ class Average(DataTreatment):
             (data, std)
         """
 
-        # We obtain the data in volt
-        data = self.data_in_volt(data)
-
-        # We obtain the current averaging for both and save them for
-        # the next iteration
-
-        # self.mean = self.mean_averaging(self.mean, data)
-        # self.std  = self.std_averaging(self.std, data)
-        self.mean = self.mean_averaging(self.mean, np.mean(data, axis=0))
-        self.std  = self.std_averaging(self.std, np.std(data, axis=0))
+        # All the records are added to the running average
+        if self.integer:
+            self.data.update(data, self._volt_converter().shift)
+        else:
+            # We obtain the data in volt
+            self.data.update(self.data_in_volt(data))
 
         # print 'data', np.shape(data)
         # Send the result with the amplitude in V
-        queue_treatment.put((self.mean, self.std))
+        queue_treatment.put(self.result())
+
+
+    def result(self):
+        """
+            Return the result of all the data treated so far.
+        """
+
+        if self.integer:
+            converter = self._volt_converter()
+            return (self.data.get_mean(float(converter.scale), float(converter.offset)),
+                    self.data.get_std(float(converter.scale)))
+
+        return (self.data.get_mean(), self.data.get_std())
 
 
 class Average_time(DataTreatment):
     """
         Class performing the average of the acquired data.
+        With integer set, the raw data are summed as integers and converted
+        in V only when a result is sent, see CodeAccumulator. It pays off
+        when many records are added between two results.
     """
 
-    def __init__(self):
+    def __init__(self, integer=False):
     # __init__(self,acquisition_time, samplerate):
         """
             Input:
-                - acquisition_time (float): in second
-                - samplerate (float): in sample per second
+                - integer (bool): if True, the averages are computed from
+                  integer sums of the sample codes.
         """
         # length=int(acquisition_time*samplerate)
 
         # We initialize np.array with the right dimension
         # self.mean = np.zeros(length)
         # self.std  = np.zeros(length)
-        self.mean = 0.
-        self.std  = 0.
+        self.integer = integer
+
+        if integer:
+            self.data = CodeAccumulator()
+        else:
+            self.data = Accumulator()
 
     def process(self, data, queue_treatment, parameters):
         """
@@ -306,17 +1905,168 @@ class Average_time(DataTreatment):
             (data, std)
         """
 
-        # We obtain the data in volt
-        data = self.data_in_volt(data)
+        # The whole sequence is added to the running average
+        if self.integer:
+            self.data.add(data, self._volt_converter().shift)
+        else:
+            # We obtain the data in volt
+            self.data.add(self.data_in_volt(data))
+
+        # Send the result with the amplitude in V
+        queue_treatment.put(self.result())
+        # queue_treatment.put((self.mean))
+
+
+    def result(self):
+        """
+            Return the result of all the data treated so far.
+        """
+
+        if self.integer:
+            converter = self._volt_converter()
+            return (self.data.get_mean(float(converter.scale), float(converter.offset)),
+                    self.data.get_std(float(converter.scale)))
+
+        return (self.data.get_mean(), self.data.get_std())
+
+
+class Spectrum(DataTreatment):
+    """
+        Canvas for the processors of the spectra given by the on-FPGA FFT, in
+        FFT mode.
+        The records are power spectra in the U16_AMP2 units of the board. They
+        are averaged as they are, the decimation of the frequency bins, the
+        log-power conversion and the peak search are only done on the
+        averaged spectrum, when a result is sent.
+    """
+
+
+
+    def __init__(self, samplerate, fftLength_samples, decimation=1,
+                 log_power=False, nb_peaks=0):
+        """
+            Input:
+                - samplerate (float): in sample per second
+                - fftLength_samples (int): length of the on-FPGA FFT, the
+                  power of 2 larger than the number of acquired samples.
+                - decimation (int): number of consecutive frequency bins
+                  summed in a bin of the result.
+                - log_power (bool): if True, the power is returned in dB.
+                - nb_peaks (int): number of highest bins of the averaged
+                  spectrum returned with it.
+        """
+
+        self.decimation = int(decimation)
+        self.log_power  = bool(log_power)
+        self.nb_peaks   = int(nb_peaks)
+
+        if self.decimation < 1:
+            raise ValueError('The decimation must be larger than 1')
+
+        # One-sided spectrum of the real signal
+        self.nb_bins = int(fftLength_samples)//2
+
+        # The frequency axis of the result, the center of the decimated bins
+        frequency = np.arange(self.nb_bins)*float(samplerate)/fftLength_samples
+        self.nb_decimated = self.nb_bins//self.decimation
+        self.frequency    = frequency[:self.nb_decimated*self.decimation]\
+                            .reshape(self.nb_decimated, self.decimation)\
+                            .mean(axis=1)
+
+        self.data = Accumulator()
+
+
+
+    def spectrum(self, power):
+        """
+            Return the power with its frequency bins decimated, in dB if
+            log_power.
+            The last axis of power is the frequency.
+        """
+
+        power = power[..., :self.nb_decimated*self.decimation]
+
+        if self.decimation > 1:
+            power = power.reshape(power.shape[:-1] + (self.nb_decimated,
+                                                      self.decimation))\
+                         .sum(axis=-1)
+
+        if self.log_power:
+            power = 10.*np.log10(np.maximum(power, np.finfo(float).tiny))
+
+        return power
+
+
+
+    def peaks(self, spectrum):
+        """
+            Return the frequencies and the values of the nb_peaks highest bins
+            of a spectrum, sorted by decreasing value.
+        """
+
+        nb_peaks = min(self.nb_peaks, spectrum.shape[-1])
+
+        # Only the highest bins are sorted
+        indexes = np.argpartition(spectrum, -nb_peaks, axis=-1)[..., -nb_peaks:]
+        values  = np.take_along_axis(spectrum, indexes, axis=-1)
+
+        order   = np.argsort(values, axis=-1)[..., ::-1]
+        indexes = np.take_along_axis(indexes, order, axis=-1)
+        values  = np.take_along_axis(values, order, axis=-1)
+
+        return self.frequency[indexes], values
+
+
+
+    def result(self):
+        """
+            Return the result of all the data treated so far, as the averaged
+            spectrum, followed by the frequencies and values of its peaks if
+            nb_peaks.
+        """
+
+        spectrum = self.spectrum(self.data.get_mean())
+
+        if self.nb_peaks:
+            return (spectrum,) + self.peaks(spectrum)
+
+        return spectrum
+
+
+    def _error_groups(self):
+        """
+            The power spectra are not in V.
+        """
+
+        return []
+
+
+class SpectrumAverage(Spectrum):
+    """
+        Average the power spectra of all the records.
+    """
+
+    def process(self, data, queue_treatment, parameters):
+
+        # All the records are added to the running average
+        self.data.update(data[:, :self.nb_bins])
+
+        queue_treatment.put(self.result())
+
+
+
+class SpectrumAveragePerSequence(Spectrum):
+    """
+        Average the power spectra of each record of a sequence, the result
+        has a spectrum per record of the sequence.
+    """
 
-        # We obtain the current averaging for both and save them for
-        # the next iteration
-        self.mean = self.mean_averaging(self.mean, data)
-        self.std  = self.std_averaging(self.std, data)
+    def process(self, data, queue_treatment, parameters):
 
-        # Send the result with the amplitude in V
-        queue_treatment.put((self.mean, self.std))
-        # queue_treatment.put((self.mean))
+        # The whole sequence is added to the running average
+        self.data.add(data[:, :self.nb_bins])
+
+        queue_treatment.put(self.result())
 
 
 class AmplitudePhase(DataTreatment):
@@ -345,17 +2095,17 @@ class AmplitudePhase(DataTreatment):
         # We obtain the number of point in these oscillations
         self.nb_points  = int(nb_oscillations/frequency*samplerate)
 
-        # We calculate the sin and cos
-        time = np.arange(self.nb_points)/samplerate
+        # We obtain the sin and cos, shared with the processors of same timing
+        self.cos, self.sin = oscillations(self.nb_points, samplerate, frequency)
 
-        self.cos = np.cos(2.*np.pi*frequency*time)
-        self.sin = np.sin(2.*np.pi*frequency*time)
+        # The cos and sin are stacked in a single reference matrix
+        self.demodulator = Demodulator((self.cos, self.sin),
+                                       ('oscillations', self.nb_points,
+                                        samplerate, frequency))
 
         # Data save
-        self.amp_mean = 0.
-        self.amp_std  = 0.
-        self.phase_mean = 0.
-        self.phase_std  = 0.
+        self.amp   = Accumulator()
+        self.phase = Accumulator()
 
 
 
@@ -367,28 +2117,37 @@ class AmplitudePhase(DataTreatment):
             (amp_mean, amp_std, phase_mean, phase_std)
         """
 
-        # We obtain the data in volt
-        data = self.data_in_volt(data)
-
         # Build cos and sin
-        cos = np.mean(data[:,:self.nb_points]*self.cos, axis=1)
-        sin = np.mean(data[:,:self.nb_points]*self.sin, axis=1)
+        cos, sin = self.demodulate(data).T
 
         # Obtain amplitude and phase
         amp   = 2.*np.sqrt(cos**2. + sin**2.)
         phase = np.angle(cos + 1j*sin)
 
-        # We obtain the current averaging for both and save them for
-        # the next iteration
-        self.amp_mean = self.mean_averaging(self.amp_mean, np.mean(amp, axis=0))
-        self.amp_std  = self.std_averaging(self.amp_std, np.std(amp, axis=0))
-
-        self.phase_mean = self.mean_averaging(self.phase_mean, np.mean(phase, axis=0))
-        self.phase_std  = self.std_averaging(self.phase_std, np.std(phase, axis=0))
+        # We obtain the current averaging for both, all the records are
+        # added to the running average
+        self.amp.update(amp)
+        self.phase.update(phase)
 
         # We send the result
-        queue_treatment.put((self.amp_mean, self.amp_std,\
-                             self.phase_mean, self.phase_std))
+        queue_treatment.put(self.result())
+
+
+    def result(self):
+        """
+            Return the result of all the data treated so far.
+        """
+
+        return (self.amp.get_mean(), self.amp.get_std(),\
+                self.phase.get_mean(), self.phase.get_std())
+
+
+    def _error_groups(self):
+        """
+            The phase is not in V.
+        """
+
+        return [(self.amp,)]
 
 
 class DBPhase(DataTreatment):
@@ -420,17 +2179,17 @@ class DBPhase(DataTreatment):
         # We obtain the number of point in these oscillations
         self.nb_points  = int(nb_oscillations/frequency*samplerate)
 
-        # We calculate the sin and cos
-        time = np.arange(self.nb_points)/samplerate
+        # We obtain the sin and cos, shared with the processors of same timing
+        self.cos, self.sin = oscillations(self.nb_points, samplerate, frequency)
 
-        self.cos = np.cos(2.*np.pi*frequency*time)
-        self.sin = np.sin(2.*np.pi*frequency*time)
+        # The cos and sin are stacked in a single reference matrix
+        self.demodulator = Demodulator((self.cos, self.sin),
+                                       ('oscillations', self.nb_points,
+                                        samplerate, frequency))
 
         # Data save
-        self.amp_mean = 0.
-        self.amp_std  = 0.
-        self.phase_mean = 0.
-        self.phase_std  = 0.
+        self.amp   = Accumulator()
+        self.phase = Accumulator()
 
         self.impedance = impedance
 
@@ -460,28 +2219,39 @@ class DBPhase(DataTreatment):
             (amp_mean, amp_std, phase_mean, phase_std)
         """
 
-        # Data in volt
-        data = self.data_in_volt(data)
-
         # Build cos and sin
-        cos = np.mean(data[:,:self.nb_points]*self.cos, axis=1)
-        sin = np.mean(data[:,:self.nb_points]*self.sin, axis=1)
+        cos, sin = self.demodulate(data).T
 
         # Obtain amplitude and phase
         amp   = 2.*np.sqrt(cos**2. + sin**2.)
         phase = np.angle(cos + 1j*sin)
 
-        # We obtain the current averaging for both and save them for
-        # the next iteration
-        self.amp_mean = self.mean_averaging(self.amp_mean, np.mean(amp, axis=0))
-        self.amp_std  = self.std_averaging(self.amp_std, np.std(amp, axis=0))
+        # We obtain the current averaging for both, all the records are
+        # added to the running average
+        self.amp.update(amp)
+        self.phase.update(phase)
+
+        queue_treatment.put(self.result())
 
-        self.phase_mean = self.mean_averaging(self.phase_mean, np.mean(phase, axis=0))
-        self.phase_std  = self.std_averaging(self.phase_std, np.std(phase, axis=0))
 
-        queue_treatment.put((20.*np.log10(self.amp_mean/self.input_amplitude),\
-                             20.*self.amp_std/self.amp_mean/np.log(10.),\
-                             self.phase_mean, self.phase_std))
+    def result(self):
+        """
+            Return the result of all the data treated so far.
+        """
+
+        amp_mean = self.amp.get_mean()
+
+        return (20.*np.log10(amp_mean/self.input_amplitude),\
+                20.*self.amp.get_std()/amp_mean/np.log(10.),\
+                self.phase.get_mean(), self.phase.get_std())
+
+
+    def _error_groups(self):
+        """
+            The amplitude is averaged in V, the phase is not in V.
+        """
+
+        return [(self.amp,)]
 
 
 class RealImag(DataTreatment):
@@ -510,17 +2280,17 @@ class RealImag(DataTreatment):
         # We obtain the number of point in these oscillations
         self.nb_points  = int(nb_oscillations/frequency*samplerate)
 
-        # We calculate the sin and cos
-        time = np.arange(self.nb_points)/samplerate
+        # We obtain the sin and cos, shared with the processors of same timing
+        self.cos, self.sin = oscillations(self.nb_points, samplerate, frequency)
 
-        self.cos = np.cos(2.*np.pi*frequency*time)
-        self.sin = np.sin(2.*np.pi*frequency*time)
+        # The cos and sin are stacked in a single reference matrix
+        self.demodulator = Demodulator((self.cos, self.sin),
+                                       ('oscillations', self.nb_points,
+                                        samplerate, frequency))
 
         # Data save
-        self.real_mean = 0.
-        self.real_std  = 0.
-        self.imag_mean = 0.
-        self.imag_std  = 0.
+        self.real = Accumulator()
+        self.imag = Accumulator()
 
 
 
@@ -532,25 +2302,36 @@ class RealImag(DataTreatment):
             (real_mean, real_std, imag_mean, imag_std)
         """
 
-        # Data in volt
-        data = self.data_in_volt(data)
-
         # Build cos and sin
-        real = 2.*np.mean(data[:,:self.nb_points]*self.cos, axis=1)
-        imag = 2.*np.mean(data[:,:self.nb_points]*self.sin, axis=1)
+        cos, sin = self.demodulate(data).T
+        real = 2.*cos
+        imag = 2.*sin
 
-        # We obtain the current averaging for both and save them for
-        # the next iteration
-        self.real_mean = self.mean_averaging(self.real_mean, np.mean(real, axis=0))
-        #self.real_std  = self.std_averaging(self.real_std, np.std(real, axis =0))
+        # We obtain the current averaging for both, all the records are
+        # added to the running average
+        self.real.update(real)
+        self.imag.update(imag)
 
-        self.imag_mean = self.mean_averaging(self.imag_mean, np.mean(imag, axis=0))
-        #self.imag_std  = self.std_averaging(self.imag_std, np.std(imag, axis=0))
+        # queue_treatment.put((self.real.get_mean(), self.real.get_std(),\
+        #                      self.imag.get_mean(), self.imag.get_std()))
+
+        queue_treatment.put(self.result())
+
+
+    def result(self):
+        """
+            Return the result of all the data treated so far.
+        """
+
+        return (self.real.get_mean(), self.imag.get_mean())
 
-        # queue_treatment.put((self.real_mean, self.real_std,\
-        #                      self.imag_mean, self.imag_std))
 
-        queue_treatment.put((self.real_mean, self.imag_mean))
+    def _error_groups(self):
+        """
+            The real and imaginary parts are the components of a vector.
+        """
+
+        return [(self.real, self.imag)]
 
 
 class AmplitudePhasePerSequence(DataTreatment):
@@ -580,63 +2361,51 @@ class AmplitudePhasePerSequence(DataTreatment):
         # We obtain the number of point in these oscillations
         self.nb_points  = int(nb_oscillations/frequency*samplerate)
 
-        # We calculate the sin and cos
-        time = np.arange(self.nb_points)/samplerate
-
-        self.cos = np.cos(2.*np.pi*frequency*time)
-        self.sin = np.sin(2.*np.pi*frequency*time)
+        # We obtain the sin and cos, shared with the processors of same timing
+        self.cos, self.sin = oscillations(self.nb_points, samplerate, frequency)
 
-        # We initialize np.array with the right dimension
-        self.amp_mean = np.zeros(nb_sequence)
-        self.amp_std  = np.zeros(nb_sequence)
-
-        self.phase_mean = np.zeros(nb_sequence)
-        self.phase_std  = np.zeros(nb_sequence)
+        # The cos and sin are stacked in a single reference matrix
+        self.demodulator = Demodulator((self.cos, self.sin),
+                                       ('oscillations', self.nb_points,
+                                        samplerate, frequency))
 
-        #self.amp_mean = 0.
-        #self.amp_std  = 0.
-
-        #self.phase_mean = 0.
-        #self.phase_std  = 0.
+        # Running average of each step of the sequence
+        self.amp   = Accumulator()
+        self.phase = Accumulator()
 
 
 
     def process(self, data, queue_treatment, parameters):
 
-        # Data in volt
-        data = self.data_in_volt(data)
-
         # Build cos and sin
-        cos = np.mean(data[:,:self.nb_points]*self.cos, axis=1)
-        sin = np.mean(data[:,:self.nb_points]*self.sin, axis=1)
+        cos, sin = self.demodulate(data).T
+
+        amp   = 2.*np.sqrt(cos**2. + sin**2.)
+        phase = np.angle(cos + 1j*sin)
 
-        amp      = 2.*np.sqrt(cos**2. + sin**2.)
-        amp_mean = self.mean_averaging(self.amp_mean, amp)
+        # The sequence is added to the running average of each step
+        self.amp.add(amp)
+        self.phase.add(phase)
 
-        phase      = np.angle(cos + 1j*sin)
-        phase_mean = self.mean_averaging(self.phase_mean, phase)
+        # We send the result with the amplitude in V
+        queue_treatment.put(self.result())
 
-        if self.treated_buffer < 2:
 
-            self.amp_std   = amp_mean
-            self.phase_std = phase_mean
-        else:
-            self.amp_std = np.sqrt((self.treated_buffer - 1.)*self.amp_std**2.\
-                                     /self.treated_buffer
-                                     + (amp - self.amp_mean)**2.\
-                                    /(self.treated_buffer + 1.))
+    def result(self):
+        """
+            Return the result of all the data treated so far.
+        """
 
-            self.phase_std = np.sqrt((self.treated_buffer - 1.)*self.phase_std**2.\
-                                     /self.treated_buffer
-                                     + (phase - self.phase_mean)**2.\
-                                    /(self.treated_buffer + 1.))
+        return (self.amp.get_mean(), self.amp.get_std(),\
+                self.phase.get_mean(), self.phase.get_std())
 
-        self.amp_mean   = amp_mean
-        self.phase_mean = phase_mean
 
-        # We send the result with the amplitude in V
-        queue_treatment.put((self.amp_mean, self.amp_std,\
-                             self.phase_mean, self.phase_std))
+    def _error_groups(self):
+        """
+            The phase is not in V.
+        """
+
+        return [(self.amp,)]
 
 
 class AmplitudePhasePerSequencedB(DataTreatment):
@@ -667,17 +2436,17 @@ class AmplitudePhasePerSequencedB(DataTreatment):
         # We obtain the number of point in these oscillations
         self.nb_points  = int(nb_oscillations/frequency*samplerate)
 
-        # We calculate the sin and cos
-        time = np.arange(self.nb_points)/samplerate
+        # We obtain the sin and cos, shared with the processors of same timing
+        self.cos, self.sin = oscillations(self.nb_points, samplerate, frequency)
 
-        self.cos = np.cos(2.*np.pi*frequency*time)
-        self.sin = np.sin(2.*np.pi*frequency*time)
+        # The cos and sin are stacked in a single reference matrix
+        self.demodulator = Demodulator((self.cos, self.sin),
+                                       ('oscillations', self.nb_points,
+                                        samplerate, frequency))
 
         # Data save
-        self.amp_mean = 0.
-        self.amp_std  = 0.
-        self.phase_mean = 0.
-        self.phase_std  = 0.
+        self.amp   = Accumulator()
+        self.phase = Accumulator()
 
         self.impedance = impedance
 
@@ -699,41 +2468,37 @@ class AmplitudePhasePerSequencedB(DataTreatment):
 
     def process(self, data, queue_treatment, parameters):
 
-        # Data in volt
-        data = self.data_in_volt(data)
-
         # Build cos and sin
-        cos = np.mean(data[:,:self.nb_points]*self.cos, axis=1)
-        sin = np.mean(data[:,:self.nb_points]*self.sin, axis=1)
+        cos, sin = self.demodulate(data).T
 
-        amp      = 2.*np.sqrt(cos**2. + sin**2.)
-        amp_mean = self.mean_averaging(self.amp_mean, amp)
+        amp   = 2.*np.sqrt(cos**2. + sin**2.)
+        phase = np.angle(cos + 1j*sin)
 
-        phase      = np.angle(cos + 1j*sin)
-        phase_mean = self.mean_averaging(self.phase_mean, phase)
+        # The sequence is added to the running average of each step
+        self.amp.add(amp)
+        self.phase.add(phase)
 
-        if self.treated_buffer < 2:
+        queue_treatment.put(self.result())
 
-            self.amp_std   = amp_mean
-            self.phase_std = phase_mean
-        else:
-            self.amp_std = np.sqrt((self.treated_buffer - 1.)*self.amp_std**2.\
-                                     /self.treated_buffer
-                                     + (amp - self.amp_mean)**2.\
-                                    /(self.treated_buffer + 1.))
 
-            self.phase_std = np.sqrt((self.treated_buffer - 1.)*self.phase_std**2.\
-                                     /self.treated_buffer
-                                     + (phase - self.phase_mean)**2.\
-                                    /(self.treated_buffer + 1.))
+    def result(self):
+        """
+            Return the result of all the data treated so far.
+        """
+
+        amp_mean = self.amp.get_mean()
+
+        return (20.*np.log10(amp_mean/self.input_amplitude),\
+                20.*self.amp.get_std()/amp_mean/np.log(10.),\
+                self.phase.get_mean(), self.phase.get_std())
+
 
-        self.amp_mean   = amp_mean
-        self.phase_mean = phase_mean
+    def _error_groups(self):
+        """
+            The amplitude is averaged in V, the phase is not in V.
+        """
 
-        # We send the result with the amplitude in dB
-        queue_treatment.put((20.*np.log10(self.amp_mean/self.input_amplitude),\
-                             20.*self.amp_std/self.amp_mean/np.log(10.),\
-                             self.phase_mean, self.phase_std))
+        return [(self.amp,)]
 
 
 class RealImagPerSequence(DataTreatment):
@@ -768,37 +2533,174 @@ class RealImagPerSequence(DataTreatment):
         # We obtain the number of point in these oscillations
         self.nb_points  = int(nb_oscillations/frequency*samplerate)
 
-        # We calculate the sin and cos
-        time = np.arange(self.nb_points)/samplerate
+        # We obtain the sin and cos, shared with the processors of same timing
+        self.cos, self.sin = oscillations(self.nb_points, samplerate, frequency)
 
-        self.cos = np.cos(2.*np.pi*frequency*time)
-        self.sin = np.sin(2.*np.pi*frequency*time)
+        # The cos and sin are stacked in a single reference matrix
+        self.demodulator = Demodulator((self.cos, self.sin),
+                                       ('oscillations', self.nb_points,
+                                        samplerate, frequency))
 
-        self.real_mean = 0.
-        self.real_std  = 0.
-        self.imag_mean = 0.
-        self.imag_std  = 0.
+        self.real = Accumulator()
+        self.imag = Accumulator()
 
 
     def process(self, data, queue_treatment, parameters):
 
-            # Data in volt
-            data = self.data_in_volt(data)
-
             # Build cos and sin
-            real = 2.*np.mean(data[:,:self.nb_points]*self.cos, axis=1)
-            imag = 2.*np.mean(data[:,:self.nb_points]*self.sin, axis=1)
+            cos, sin = self.demodulate(data).T
+            real = 2.*cos
+            imag = 2.*sin
 
             # We obtain the current averaging for both
-            real_mean = self.mean_averaging(self.real_mean, real)
-            imag_mean = self.mean_averaging(self.imag_mean, imag)
+            self.real.add(real)
+            self.imag.add(imag)
 
+            #queue_treatment.put((self.real.get_mean(), self.real.get_std(), self.imag.get_mean(), self.imag.get_std()))
+            queue_treatment.put(self.result())
 
-            self.real_mean = real_mean
-            self.imag_mean = imag_mean
 
-            #queue_treatment.put((self.real_mean, self.real_std, self.imag_mean, self.imag_std))
-            queue_treatment.put((self.real_mean, self.imag_mean))
+    def result(self):
+        """
+            Return the result of all the data treated so far.
+        """
+
+        return (self.real.get_mean(), self.imag.get_mean())
+
+
+    def _error_groups(self):
+        """
+            The real and imaginary parts are the components of a vector.
+        """
+
+        return [(self.real, self.imag)]
+
+
+class RealImagPerSequenceMultiTone(DataTreatment):
+    """
+        Frequency multiplexed version of RealImagPerSequence.
+        All the tones are demodulated in one pass with a single reference
+        matrix.
+        Return the real part and the imaginary part in V of each tone, as
+        arrays (nb_sequence, nb_tones).
+    """
+
+
+    def __init__(self, acquisition_time, samplerate, frequencies,
+                 windows=None, weights=None):
+        """
+            Input:
+                - acquisition_time (float): in second
+                - samplerate (float): in sample per second
+                - frequencies (list of float): in hertz
+                - windows (list of tuple): (t_start, t_stop) in second of the
+                  integration window of each tone. None for the whole
+                  acquisition time.
+                - weights (list of array): weight applied on the integration
+                  window of each tone, should have as many points as the
+                  window. None for an uniform weight.
+        """
+
+        frequencies = np.atleast_1d(np.asarray(frequencies, dtype=float))
+        self.nb_tones = len(frequencies)
+
+        if windows is None:
+            windows = [(0., acquisition_time)]*self.nb_tones
+        if weights is None:
+            weights = [None]*self.nb_tones
+
+        if len(windows) != self.nb_tones or len(weights) != self.nb_tones:
+            raise ValueError('windows and weights must have one element per'
+                             ' frequency')
+
+        self.nb_points = int(acquisition_time*samplerate)
+
+        nb_points = self.nb_points
+        nb_tones  = self.nb_tones
+
+        def compute():
+
+            time = np.arange(nb_points)/samplerate
+
+            # First the cos of all the tones, then the sin
+            references = np.zeros((2*nb_tones, nb_points))
+
+            for i, (frequency, (t_start, t_stop), weight)\
+                in enumerate(zip(frequencies, windows, weights)):
+
+                # We need an integer number of oscillations in the window
+                nb_oscillations = int(frequency*(t_stop - t_start))
+
+                if nb_oscillations < 1:
+                    raise ValueError('The number of acquired oscillations must be'
+                                     ' larger than 1')
+
+                start = int(t_start*samplerate)
+                stop  = start + int(nb_oscillations/frequency*samplerate)
+
+                if stop > nb_points:
+                    raise ValueError('The integration window must be included in'
+                                     ' the acquisition time')
+
+                if weight is None:
+                    weight = 1.
+                elif len(weight) != stop - start:
+                    raise ValueError('The weight of the tone %s Hz must have %i'
+                                     ' points' % (frequency, stop - start))
+
+                # The demodulator averages over nb_points, we rescale to get the
+                # average over the window
+                envelope = 2.*np.asarray(weight)*nb_points/(stop - start)
+
+                references[i, start:stop] = envelope\
+                                            *np.cos(2.*np.pi*frequency*time[start:stop])
+                references[nb_tones + i, start:stop] = envelope\
+                                            *np.sin(2.*np.pi*frequency*time[start:stop])
+
+            return references
+
+        # Without weights, the references only depend on the timing and are
+        # shared with the processors of same timing
+        if all(weight is None for weight in weights):
+            key = ('multitone', self.nb_points, float(samplerate),
+                   tuple(frequencies), tuple(tuple(window) for window in windows))
+            references = reference_cache.get(key, compute)
+        else:
+            key = None
+            references = compute()
+
+        self.frequencies = frequencies
+        self.demodulator = Demodulator(references, key)
+
+        self.real = Accumulator()
+        self.imag = Accumulator()
+
+
+    def process(self, data, queue_treatment, parameters):
+
+            iq = self.demodulate(data)
+
+            # We obtain the current averaging of each tone
+            self.real.add(iq[:,:self.nb_tones])
+            self.imag.add(iq[:,self.nb_tones:])
+
+            queue_treatment.put(self.result())
+
+
+    def result(self):
+        """
+            Return the result of all the data treated so far.
+        """
+
+        return (self.real.get_mean(), self.imag.get_mean())
+
+
+    def _error_groups(self):
+        """
+            The real and imaginary parts are the components of a vector.
+        """
+
+        return [(self.real, self.imag)]
 
 
 class RealImag_raw(DataTreatment):
@@ -824,11 +2726,13 @@ class RealImag_raw(DataTreatment):
         # We obtain the number of point in these oscillations
         self.nb_points  = int(nb_oscillations/frequency*samplerate)
 
-        # We calculate the sin and cos
-        time = np.arange(self.nb_points)/samplerate
+        # We obtain the sin and cos, shared with the processors of same timing
+        self.cos, self.sin = oscillations(self.nb_points, samplerate, frequency)
 
-        self.cos = np.cos(2.*np.pi*frequency*time)
-        self.sin = np.sin(2.*np.pi*frequency*time)
+        # The cos and sin are stacked in a single reference matrix
+        self.demodulator = Demodulator((self.cos, self.sin),
+                                       ('oscillations', self.nb_points,
+                                        samplerate, frequency))
 
         # Data save
         self.real_raw = []
@@ -844,11 +2748,10 @@ class RealImag_raw(DataTreatment):
             Real and imaginary parts will be array of length=averaging
         """
 
-        # Data in volt
-        data = self.data_in_volt(data)
         # Build cos and sin
-        real = 2.*np.mean(data[:,:self.nb_points]*self.cos, axis=1)
-        imag = 2.*np.mean(data[:,:self.nb_points]*self.sin, axis=1)
+        cos, sin = self.demodulate(data).T
+        real = 2.*cos
+        imag = 2.*sin
 
         # We obtain the current averaging for both and save them for
         # the next iteration
@@ -868,22 +2771,117 @@ class RealImag_raw(DataTreatment):
         queue_treatment.put((self.real_raw, self.imag_raw))
 
 
+class RealImagHistogram(DataTreatment):
+    """
+        Histogram of the single shot real and imaginary parts, obtained by
+        the cos, sin method, per step of the sequence.
+        Instead of every shot as RealImag_raw, only the IQHistogram of the
+        shots treated so far is sent, with the fraction of the shots in the
+        state 1 when a threshold is given.
+        Return (counts, population, threshold), see IQHistogram, the
+        population and the threshold being NaN without threshold. The edges
+        of the bins are the edges_real and edges_imag attributes.
+    """
+
+    def __init__(self, acquisition_time, samplerate, frequency, real_range,
+                 imag_range, bins=100, threshold=None, angle=0.):
+        """
+            Input:
+                - acquisition_time (float): in second
+                - samplerate (float): in sample per second
+                - frequency (float): in hertz
+                - real_range (tuple): (min, max) of the real part in V
+                - imag_range (tuple): (min, max) of the imaginary part in V
+                - bins (int or tuple): number of bins of each axis
+                - threshold (float, 'auto' or None): threshold of the state
+                  assignment in V
+                - angle (float): angle of the assignment axis in rad
+        """
+
+        # We need an integer number of oscillations
+        nb_oscillations = int(frequency*acquisition_time)
+
+        if nb_oscillations < 1:
+            raise ValueError('The number of acquired oscillations must be larger than 1')
+
+        # We obtain the number of point in these oscillations
+        self.nb_points  = int(nb_oscillations/frequency*samplerate)
+
+        # We obtain the sin and cos, shared with the processors of same timing
+        self.cos, self.sin = oscillations(self.nb_points, samplerate, frequency)
+
+        # The cos and sin are stacked in a single reference matrix
+        self.demodulator = Demodulator((self.cos, self.sin),
+                                       ('oscillations', self.nb_points,
+                                        samplerate, frequency))
+
+        self.histogram = IQHistogram(real_range, imag_range, bins, threshold,
+                                     angle)
+
+        self.edges_real = self.histogram.edges_real
+        self.edges_imag = self.histogram.edges_imag
+
+
+    def process(self, data, queue_treatment, parameters):
+        """
+            Add the shots of a sequence to the histogram.
+        """
+
+        cos, sin = self.demodulate(data).T
+
+        self.histogram.update(2.*cos, 2.*sin)
+
+        queue_treatment.put(self.result())
+
+
+    def result(self):
+        """
+            Return the result of all the data treated so far.
+        """
+
+        return (self.histogram.get_counts(), self.histogram.get_population(),
+                self.histogram.get_threshold())
+
+
+    def result_bytes(self, samplesPerRecord, nb_channels, nb_sequence,
+                     nb_records):
+        """
+            The counts of each step, whatever the length of the records.
+        """
+
+        real_bins, imag_bins = self.histogram.bins
+
+        return 8*nb_channels*(nb_sequence*(real_bins*imag_bins + 1) + 1)
+
+
 class Average_IQ(DataTreatment):
     """
         Class performing the average of the acquired data.
+        The real and imaginary parts are low-pass filtered and averaged at a
+        rate reduced by the decimation attribute, the time of each filtered
+        sample being given by the time attribute.
     """
 
-    def __init__(self, acquisition_time, samplerate, frequency, f_cutoff, order=1):
+    def __init__(self, acquisition_time, samplerate, frequency, f_cutoff, order=1,
+                 decimation=None):
+        """
+            Input:
+                - acquisition_time (float): in second
+                - samplerate (float): in sample per second
+                - frequency (float): in hertz
+                - f_cutoff (float): in hertz, the cutoff of the Butterworth
+                  filter being f_cutoff/samplerate times the Nyquist frequency
+                - order (int): order of the Butterworth filter
+                - decimation (int): if None, the largest one allowed by the
+                  cutoff, 1 to keep the full rate
+        """
 
         # We obtain the number of point in these oscillations
         self.nb_points = int(samplerate*acquisition_time)
 
         # print 'size:', self.nb_points
-        # We calculate the sin and cos
-        time = np.arange(self.nb_points)/samplerate
-
-        self.cos = np.cos(2.*np.pi*frequency*time)
-        self.sin = np.sin(2.*np.pi*frequency*time)
+        # We obtain the sin and cos, shared with the processors of same timing
+        self.cos, self.sin = oscillations(self.nb_points, samplerate, frequency)
 
         # self.mat = np.zeros((self.nb_points, self.nb_points))
 
@@ -903,11 +2901,24 @@ class Average_IQ(DataTreatment):
 
         # if order == 0:
         #     self.mat = np.identity(self.nb_points)
-        self.B, self.A = scisig.butter(order, beta, btype='low' )
-        # Data save
-        self.real = np.zeros(self.nb_points)
+        if decimation is None:
+            decimation = DecimatingFilter.decimation_for(beta, self.nb_points)
+
+        if beta*decimation >= 1.:
+            raise ValueError('The cutoff frequency must be below the Nyquist '
+                             'frequency of the decimated data')
 
-        self.imag = np.zeros(self.nb_points)
+        # The filter is designed for the reduced rate, as second-order
+        # sections which stay stable at low cutoff
+        self.filter = DecimatingFilter(butter(order, beta*decimation,
+                                              btype='low', output='sos'),
+                                       decimation)
+
+        self.decimation = decimation
+        self.time = np.arange(self.nb_points//decimation)*decimation/float(samplerate)
+        # Data save
+        self.real = Accumulator()
+        self.imag = Accumulator()
 
 
     def process(self, data, queue_treatment, parameters):
@@ -931,26 +2942,38 @@ class Average_IQ(DataTreatment):
         # real_filtered = scisig.filtfilt(self.B, self.A, real)
         # imag_filtered = scisig.filtfilt(self.B, self.A, imag)
 
-        real_filtered = scisig.lfilter(self.B, self.A, real)
-        imag_filtered = scisig.lfilter(self.B, self.A, imag)
+        real_filtered = self.filter(real)
+        imag_filtered = self.filter(imag)
         # print 'dt real filtered',np.shape(real_filtered)
 
         # # We obtain the current averaging for both
-        real = self.mean_averaging(self.real, real_filtered)
-        imag = self.mean_averaging(self.imag, imag_filtered)
-
-        # print np.shape(real)
-        # print type(real)
-        self.real = real
-        self.imag = imag
+        self.real.add(real_filtered)
+        self.imag.add(imag_filtered)
 
         # Send the result with the real and imaginary parts in V
-        queue_treatment.put((self.real, self.imag))
+        queue_treatment.put(self.result())
+
+
+    def result(self):
+        """
+            Return the result of all the data treated so far.
+        """
+
+        return (self.real.get_mean(), self.imag.get_mean())
+
+
+    def _error_groups(self):
+        """
+            The real and imaginary parts are the components of a vector.
+        """
+
+        return [(self.real, self.imag)]
 
 ################################################################################
 # Test Remy 2017_11_21
 ################################################################################
 
+
 class SeveralRealImagPerSequence(DataTreatment):
     """
         By using the cos, sin method.
@@ -992,15 +3015,13 @@ class SeveralRealImagPerSequence(DataTreatment):
             self.nb_points[i,0]  = int( int(frequency*(arg[i][0])) /frequency*samplerate)
             self.nb_points[i,1]  = int( int(frequency*(arg[i][1])) /frequency*samplerate)
 
-        # We calculate the sin and cos
-        time = np.arange(self.nb_points[-1, 1])/samplerate
+        # We obtain the sin and cos, shared with the processors of same timing
+        self.cos, self.sin = oscillations(self.nb_points[-1, 1], samplerate,
+                                          frequency)
 
-        self.cos = np.cos(2.*np.pi*frequency*time)
-        self.sin = np.sin(2.*np.pi*frequency*time)
-
-        self.real_mean = np.zeros(N)
+        self.real_mean = Accumulator()
         self.real  =  np.zeros(N)
-        self.imag_mean =  np.zeros(N)
+        self.imag_mean = Accumulator()
         self.imag =  np.zeros(N)
 
         self.N = N
@@ -1017,17 +3038,26 @@ class SeveralRealImagPerSequence(DataTreatment):
                 self.imag[i] = 2.*np.mean(data[:,self.nb_points[i,0]:self.nb_points[i,1]]*self.sin, axis=1)
 
             # We obtain the current averaging for both
-            self.real_mean  = self.mean_averaging(self.real_mean, self.real)
-            self.imag_mean = self.mean_averaging(self.imag_mean, self.imag)
+            self.real_mean.add(self.real)
+            self.imag_mean.add(self.imag)
 
 
             #queue_treatment.put((self.real_mean, self.real_std, self.imag_mean, self.imag_std))
-            queue_treatment.put((self.real_mean, self.imag_mean))
+            queue_treatment.put((self.real_mean.get_mean(), self.imag_mean.get_mean()))
+
+
+    def _error_groups(self):
+        """
+            The real and imaginary parts are the components of a vector.
+        """
+
+        return [(self.real_mean, self.imag_mean)]
 
 ################################################################################
 # reset
 ################################################################################
 
+
 class RealImagPerSequence_reset(DataTreatment):
     """
         By using the cos, sin method.
@@ -1060,11 +3090,13 @@ class RealImagPerSequence_reset(DataTreatment):
         # We obtain the number of point in these oscillations
         self.nb_points  = int(nb_oscillations/frequency*samplerate)
 
-        # We calculate the sin and cos
-        time = np.arange(self.nb_points)/samplerate
+        # We obtain the sin and cos, shared with the processors of same timing
+        self.cos, self.sin = oscillations(self.nb_points, samplerate, frequency)
 
-        self.cos = np.cos(2.*np.pi*frequency*time)
-        self.sin = np.sin(2.*np.pi*frequency*time)
+        # The cos and sin are stacked in a single reference matrix
+        self.demodulator = Demodulator((self.cos, self.sin),
+                                       ('oscillations', self.nb_points,
+                                        samplerate, frequency))
 
         self.real= 0.
         self.imag = 0.
@@ -1072,12 +3104,10 @@ class RealImagPerSequence_reset(DataTreatment):
 
     def process(self, data, queue_treatment, parameters):
 
-            # Data in volt
-            data = self.data_in_volt(data)
-
             # Build cos and sin
-            self.real = 2.*np.mean(data[:,:self.nb_points]*self.cos, axis=1)
-            self.imag = 2.*np.mean(data[:,:self.nb_points]*self.sin, axis=1)
+            cos, sin = self.demodulate(data).T
+            self.real = 2.*cos
+            self.imag = 2.*sin
 
 
             queue_treatment.put((self.real, self.imag))
@@ -1109,8 +3139,8 @@ class HomodyneRealImagPerSequence(DataTreatment):
             raise ValueError('The number of acquired points must be larger than 1')
 
 
-        self.data_mean_sig = 0.
-        self.data_mean_no_sig = 0.
+        self.data_mean_sig = Accumulator()
+        self.data_mean_no_sig = Accumulator()
 
 
     def process(self, data, queue_treatment, parameters):
@@ -1125,14 +3155,28 @@ class HomodyneRealImagPerSequence(DataTreatment):
             data_no_sig = np.mean(data[:,self.nb_points2:], axis=1)
             # print np.shape(data)
             # We obtain the current averaging for both
-            data_mean_sig = self.mean_averaging(self.data_mean_sig, data_sig)
-            data_mean_no_sig = self.mean_averaging(self.data_mean_no_sig, data_no_sig)
+            self.data_mean_sig.add(data_sig)
+            self.data_mean_no_sig.add(data_no_sig)
+
+            queue_treatment.put(self.result())
+
+
+    def result(self):
+        """
+            Return the result of all the data treated so far.
+        """
+
+        return (self.data_mean_sig.get_mean(),
+                self.data_mean_no_sig.get_mean())
 
 
-            self.data_mean_sig = data_mean_sig
-            self.data_mean_no_sig = data_mean_no_sig
+    def _error_groups(self):
+        """
+            The mean without signal is near 0 V, only the signal is checked.
+        """
+
+        return [(self.data_mean_sig,)]
 
-            queue_treatment.put((self.data_mean_sig, self.data_mean_no_sig))
 
 class HomodyneRealImag_raw(DataTreatment):
     """
@@ -1311,18 +3355,49 @@ class HomodyneRealImag_Nraw(DataTreatment):
 class Homodyne_Tchebytchev(DataTreatment):
     """
         Class performing the Tchebytchev data.
+        The data are low-pass filtered and averaged at a rate reduced by the
+        decimation attribute, the time of each filtered sample being given by
+        the time attribute.
     """
 
-    def __init__(self, acquisition_time, samplerate, f_cutoff, r_dB, order, doweaverage):
+    def __init__(self, acquisition_time, samplerate, f_cutoff, r_dB, order, doweaverage,
+                 decimation=None):
+        """
+            Input:
+                - acquisition_time (float): in second
+                - samplerate (float): in sample per second
+                - f_cutoff (float): in hertz, the cutoff of the Chebyshev
+                  filter being f_cutoff/samplerate times the Nyquist frequency
+                - r_dB (float): minimum attenuation in the stop band in [dB]
+                - order (int): order of the Chebyshev filter
+                - doweaverage (bool): if False, the filtered records are sent
+                  without averaging
+                - decimation (int): if None, the largest one allowed by the
+                  cutoff, 1 to keep the full rate
+        """
 
         # We obtain the number of point
         self.nb_points = int(samplerate*acquisition_time)
         self.doweaverage = doweaverage
         beta = f_cutoff/samplerate
 
-        self.B, self.A = scisig.cheby2(order, r_dB, beta, btype='low' )
+        if decimation is None:
+            decimation = DecimatingFilter.decimation_for(beta, self.nb_points)
+
+        if beta*decimation >= 1.:
+            raise ValueError('The cutoff frequency must be below the Nyquist '
+                             'frequency of the decimated data')
+
+        # The filter is designed for the reduced rate, as second-order
+        # sections which stay stable at low cutoff
+        self.filter = DecimatingFilter(cheby2(order, r_dB, beta*decimation,
+                                              btype='low', output='sos'),
+                                       decimation)
+
+        self.decimation = decimation
+        self.time = np.arange(self.nb_points//decimation)*decimation/float(samplerate)
         # Data save
-        self.data = np.zeros(self.nb_points)
+        self.data = Accumulator()
 
     def process(self, data, queue_treatment, parameters):
         """
@@ -1335,15 +3410,15 @@ class Homodyne_Tchebytchev(DataTreatment):
         # We obtain the data in volt
         data = self.data_in_volt(data)
         # print np.shape(data)
-        data_filtered = scisig.lfilter(self.B, self.A, data,  axis=1)
+        data_filtered = self.filter(data)
         # print np.shape(data_filtered)
 
         if self.doweaverage:
-            self.data = self.mean_averaging(self.data, data_filtered)
-        else:
-            self.data = data_filtered
+            self.data.add(data_filtered)
 
-        queue_treatment.put((self.data))
+            queue_treatment.put((self.data.get_mean()))
+        else:
+            queue_treatment.put((data_filtered))
 
 
 class HomodyneRealImagPerSequenceWeighted(DataTreatment):
@@ -1366,14 +3441,9 @@ class HomodyneRealImagPerSequenceWeighted(DataTreatment):
 
         self.time = np.arange(self.nb_points_tot)/samplerate
 
-        Heavi1 = np.piecewise(self.time-t_start,
-            [(self.time-t_start)<0, (self.time-t_start) == 0, (self.time-t_start)>0],
-            [0., 0.5, 1.] )
-        t_stop = t_start + pulse_time
-        Heavi2 = np.piecewise(self.time-t_stop,
-            [(self.time-t_stop)<0, (self.time-t_stop) == 0, (self.time-t_stop) >0],
-            [0., 0.5, 1.] )
-        self.ideal_pulse = (1.-np.exp(-(self.time-t_start)/tau))*Heavi1 - Heavi2*(1.-np.exp(-(self.time-t_stop)/tau))
+        # The envelope is shared with the processors of same timing
+        self.ideal_pulse = pulse_envelope(self.nb_points_tot, samplerate, t_start,
+                                          pulse_time, tau)
 
         self.nb_points = int(samplerate*pulse_time)
         self.nb_points2 = int(samplerate*(pulse_time+delta_t))
@@ -1382,8 +3452,8 @@ class HomodyneRealImagPerSequenceWeighted(DataTreatment):
             raise ValueError('The number of acquired points must be larger than 1')
 
 
-        self.data_mean_sig = 0.
-        self.data_mean_no_sig = 0.
+        self.data_mean_sig = Accumulator()
+        self.data_mean_no_sig = Accumulator()
 
 
     def process(self, data, queue_treatment, parameters):
@@ -1396,14 +3466,28 @@ class HomodyneRealImagPerSequenceWeighted(DataTreatment):
             data_no_sig = np.mean(data[:,self.nb_points2:], axis=1)
             # print np.shape(data)
             # We obtain the current averaging for both
-            data_mean_sig = self.mean_averaging(self.data_mean_sig, data_sig)
-            data_mean_no_sig = self.mean_averaging(self.data_mean_no_sig, data_no_sig)
+            self.data_mean_sig.add(data_sig)
+            self.data_mean_no_sig.add(data_no_sig)
+
+            queue_treatment.put(self.result())
 
 
-            self.data_mean_sig = data_mean_sig
-            self.data_mean_no_sig = data_mean_no_sig
+    def result(self):
+        """
+            Return the result of all the data treated so far.
+        """
+
+        return (self.data_mean_sig.get_mean(),
+                self.data_mean_no_sig.get_mean())
+
+
+    def _error_groups(self):
+        """
+            The mean without signal is near 0 V, only the signal is checked.
+        """
+
+        return [(self.data_mean_sig,)]
 
-            queue_treatment.put((self.data_mean_sig, self.data_mean_no_sig))
 
 class HomodyneRealImag_rawWeighted(DataTreatment):
     """
@@ -1425,14 +3509,9 @@ class HomodyneRealImag_rawWeighted(DataTreatment):
         self.nb_points2 = int((pulse_time+delta_t)*samplerate)
 
         self.time = np.arange(self.nb_points_tot)/samplerate
-        Heavi1 = np.piecewise(self.time-t_start,
-            [(self.time-t_start)<0, (self.time-t_start) == 0, (self.time-t_start)>0],
-            [0., 0.5, 1.] )
-        t_stop = t_start + pulse_time
-        Heavi2 = np.piecewise(self.time-t_stop,
-            [(self.time-t_stop)<0, (self.time-t_stop) == 0, (self.time-t_stop) >0],
-            [0., 0.5, 1.] )
-        self.ideal_pulse = (1.-np.exp(-(self.time-t_start)/tau))*Heavi1 - Heavi2*(1.-np.exp(-(self.time-t_stop)/tau))
+        # The envelope is shared with the processors of same timing
+        self.ideal_pulse = pulse_envelope(self.nb_points_tot, samplerate, t_start,
+                                          pulse_time, tau)
 
         # Data save
         self.data_pulse_raw = []
@@ -1481,26 +3560,16 @@ class HomodyneRealImag_raw_sevROWeighted(DataTreatment):
         # We obtain the number of point in these oscillations
         self.nb_points_start1 = int(t1_start*samplerate)
         self.nb_points_end1   = int((t1_start+pulse_time1)*samplerate)
-        Heavi1 = np.piecewise(self.time-t1_start,
-            [(self.time-t1_start)<0, (self.time-t1_start) == 0, (self.time-t1_start)>0],
-            [0., 0.5, 1.] )
-        t_stop = t1_start + pulse_time1
-        Heavi2 = np.piecewise(self.time-t_stop,
-            [(self.time-t_stop)<0, (self.time-t_stop) == 0, (self.time-t_stop) >0],
-            [0., 0.5, 1.] )
-        self.ideal_pulse1 = (1.-np.exp(-(self.time-t1_start)/tau))*Heavi1 - Heavi2*(1.-np.exp(-(self.time-t_stop)/tau))
+        # The envelope is shared with the processors of same timing
+        self.ideal_pulse1 = pulse_envelope(self.nb_points_tot, samplerate, t1_start,
+                                           pulse_time1, tau)
 
 
         self.nb_points_start2 = int(t2_start*samplerate)
         self.nb_points_end2   = int((t2_start+pulse_time2)*samplerate)
-        Heavi1 = np.piecewise(self.time-t2_start,
-            [(self.time-t2_start)<0, (self.time-t2_start) == 0, (self.time-t2_start)>0],
-            [0., 0.5, 1.] )
-        t_stop = t2_start + pulse_time2
-        Heavi2 = np.piecewise(self.time-t_stop,
-            [(self.time-t_stop)<0, (self.time-t_stop) == 0, (self.time-t_stop) >0],
-            [0., 0.5, 1.] )
-        self.ideal_pulse2 = (1.-np.exp(-(self.time-t2_start)/tau))*Heavi1 - Heavi2*(1.-np.exp(-(self.time-t_stop)/tau))
+        # The envelope is shared with the processors of same timing
+        self.ideal_pulse2 = pulse_envelope(self.nb_points_tot, samplerate, t2_start,
+                                           pulse_time2, tau)
         print np.mean(self.ideal_pulse1), np.mean(self.ideal_pulse2)
 
 
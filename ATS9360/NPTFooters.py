@@ -0,0 +1,197 @@
+# This Python file uses the following encoding: utf-8
+# ATS9360_NPT.py driver for The aquisition board Alzar ATS9360
+# Etienne Dumur <etienne.dumur@neel.cnrs.fr> 2015
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import ctypes
+import numpy as np
+import atsapi as ats
+
+
+class FooterMonitor(object):
+    """
+        Follow the record numbers and the trigger timestamps given by the NPT
+        footers of the acquired buffers.
+        The footers of a buffer are extracted by a single call to the ATS-SDK
+        in a numpy structured array, and checked on the whole array at once.
+        A record number not following the previous one is a gap, the records
+        skipped are counted as missed.
+    """
+
+    # Samples added at the end of each record to hold its footer, the record
+    # length stays a multiple of 128 samples. The samples given to the
+    # treatment are the ones before.
+    footer_samples = 128
+
+    # Layout of ats.NPTFooter
+    footer_dtype = np.dtype([('trigger_timestamp', np.uint64),
+                             ('record_number',     np.uint32),
+                             ('frame_count',       np.uint32),
+                             ('aux_in_state',      np.uint32)], align=True)
+
+
+
+    def __init__(self, records_per_buffer, bytes_per_record, bytes_per_buffer,
+                 samplerate, samples_per_timestamp):
+        """
+            Input:
+                - records_per_buffer (int)
+                - bytes_per_record (int): size of a record, footer included.
+                - bytes_per_buffer (int)
+                - samplerate (float): in [MS/s].
+                - samples_per_timestamp (int): number of sample clock periods
+                  per tick of the trigger timestamp counter.
+        """
+
+        self.bytes_per_record = int(bytes_per_record)
+        self.bytes_per_buffer = int(bytes_per_buffer)
+
+        self.footers  = np.zeros(records_per_buffer, dtype=self.footer_dtype)
+        self._pointer = self.footers.ctypes.data_as(ctypes.POINTER(ats.NPTFooter))
+
+        # Duration of a tick of the timestamp counter in s
+        self.tick = samples_per_timestamp/(samplerate*1e6)
+
+        self.reset()
+
+
+
+    def reset(self):
+        """
+            Forget the footers seen so far.
+        """
+
+        self.records        = 0
+        self.gaps           = 0
+        self.missed_records = 0
+
+        self.last_record    = None
+        self.last_timestamp = None
+
+        # Statistics of the trigger periods in ticks
+        self.nb_periods  = 0
+        self.period_mean = 0.
+        self.period_m2   = 0.
+        self.period_min  = None
+        self.period_max  = None
+
+
+
+    def extract(self, buff):
+        """
+            Return the footers of a DMA buffer, as a structured array
+            overwritten by the next extraction.
+        """
+
+        ats.extractNPTFooters(buff.addr, self.bytes_per_record,
+                              self.bytes_per_buffer, self._pointer,
+                              len(self.footers))
+
+        return self.footers
+
+
+
+    def update(self, footers):
+        """
+            Add the footers of a buffer to the statistics.
+        """
+
+        numbers    = footers['record_number'].astype(np.int64)
+        timestamps = footers['trigger_timestamp'].astype(np.int64)
+
+        steps   = np.diff(numbers)
+        periods = np.diff(timestamps)
+
+        # The first record follows the last one of the previous buffer
+        if self.last_record is not None:
+            steps   = np.append(numbers[0] - self.last_record, steps)
+            periods = np.append(timestamps[0] - self.last_timestamp, periods)
+
+        self.last_record    = numbers[-1]
+        self.last_timestamp = timestamps[-1]
+        self.records       += len(numbers)
+
+        self.gaps           += int(np.count_nonzero(steps != 1))
+        self.missed_records += int(np.sum(steps[steps > 1] - 1))
+
+        if len(periods):
+
+            # Statistics of the buffer merged with the previous ones
+            count = len(periods)
+            mean  = periods.mean()
+            m2    = np.sum((periods - mean)**2)
+
+            total = self.nb_periods + count
+            delta = mean - self.period_mean
+
+            self.period_mean += delta*count/total
+            self.period_m2   += m2 + delta**2*self.nb_periods*count/total
+            self.nb_periods   = total
+
+            minimum, maximum = periods.min(), periods.max()
+            if self.period_min is None or minimum < self.period_min:
+                self.period_min = minimum
+            if self.period_max is None or maximum > self.period_max:
+                self.period_max = maximum
+
+
+
+    def statistics(self):
+        """
+            Return the trigger statistics of the footers seen so far, the
+            periods being in s and the rate in Hz.
+        """
+
+        statistics = {'triggers'       : self.records,
+                      'gaps'           : self.gaps,
+                      'missed_records' : self.missed_records,
+                      'rate'           : 0.,
+                      'period_mean'    : 0.,
+                      'period_std'     : 0.,
+                      'period_min'     : 0.,
+                      'period_max'     : 0.}
+
+        if self.nb_periods:
+
+            statistics['period_mean'] = self.period_mean*self.tick
+            statistics['period_std']  = np.sqrt(self.period_m2/self.nb_periods)\
+                                        *self.tick
+            statistics['period_min']  = self.period_min*self.tick
+            statistics['period_max']  = self.period_max*self.tick
+
+            if self.period_mean > 0:
+                statistics['rate'] = 1./statistics['period_mean']
+
+        return statistics
+
+
+
+    def report(self):
+        """
+            Return information about the triggers of the measurement.
+        """
+
+        statistics = self.statistics()
+
+        message  = 'Footers of %d records, %d gaps, %d records missed\n'\
+                   % (statistics['triggers'], statistics['gaps'],
+                      statistics['missed_records'])
+        message += 'Trigger rate %f Hz, period %e +/- %e sec (min %e sec, max %e sec)\n'\
+                   % (statistics['rate'], statistics['period_mean'],
+                      statistics['period_std'], statistics['period_min'],
+                      statistics['period_max'])
+
+        return message
@@ -0,0 +1,239 @@
+# This Python file uses the following encoding: utf-8
+# ATS9360_NPT.py driver for The aquisition board Alzar ATS9360
+# Etienne Dumur <etienne.dumur@neel.cnrs.fr> 2015
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+from __future__ import division
+import collections
+import numpy as np
+import scipy.signal as scisig
+
+
+class ReferenceCache(object):
+    """
+        Size-bounded cache of the reference waveforms and filter designs of
+        the processors, the least recently used entries being dropped first.
+        The processors of successive measurements with the same timing then
+        share their references instead of computing them again.
+        The cached arrays are read-only since they are shared.
+    """
+
+
+
+    def __init__(self, max_bytes=64*2**20):
+        """
+            Input:
+                - max_bytes (int): memory allowed to the cached arrays.
+        """
+
+        self.max_bytes = int(max_bytes)
+
+        self._entries = collections.OrderedDict()
+        self.nbytes   = 0
+        self.hits     = 0
+        self.misses   = 0
+
+
+
+    @staticmethod
+    def _arrays(value):
+        """
+            Return the arrays of a cached value, arrays being nested in
+            tuples.
+        """
+
+        if isinstance(value, np.ndarray):
+            return [value]
+
+        if isinstance(value, tuple):
+            return [array for item in value for array in ReferenceCache._arrays(item)]
+
+        return []
+
+
+
+    def get(self, key, compute):
+        """
+            Return the value of a key, computed by compute() when the key is
+            not in the cache.
+
+            Input:
+                - key (tuple): hashable description of the value, as its kind
+                  followed by the sample count, sample rate, frequency or
+                  window parameters.
+                - compute (function): return the value, an array or a tuple
+                  of arrays.
+        """
+
+        if key in self._entries:
+
+            self.hits += 1
+
+            # The entry becomes the most recently used
+            value, nbytes = self._entries.pop(key)
+            self._entries[key] = (value, nbytes)
+
+            return value
+
+        self.misses += 1
+
+        value  = compute()
+        arrays = self._arrays(value)
+
+        for array in arrays:
+            array.setflags(write=False)
+
+        nbytes = sum(array.nbytes for array in arrays)
+
+        # A value larger than the cache is not kept
+        if nbytes > self.max_bytes:
+            return value
+
+        while self._entries and self.nbytes + nbytes > self.max_bytes:
+            old_value, old_nbytes = self._entries.popitem(last=False)[1]
+            self.nbytes -= old_nbytes
+
+        self._entries[key] = (value, nbytes)
+        self.nbytes += nbytes
+
+        return value
+
+
+
+    def clear(self):
+        """
+            Drop all the entries.
+        """
+
+        self._entries.clear()
+        self.nbytes = 0
+
+
+
+    def __len__(self):
+
+        return len(self._entries)
+
+
+
+# Cache shared by all the processors of a process
+reference_cache = ReferenceCache()
+
+
+
+def oscillations(nb_points, samplerate, frequency):
+    """
+        Return the cos and sin of a frequency on nb_points samples, as two
+        read-only arrays.
+
+        Input:
+            - nb_points (int)
+            - samplerate (float): in sample per second
+            - frequency (float): in hertz
+    """
+
+    nb_points  = int(nb_points)
+    samplerate = float(samplerate)
+    frequency  = float(frequency)
+
+    def compute():
+
+        time = np.arange(nb_points)/samplerate
+
+        return (np.cos(2.*np.pi*frequency*time),
+                np.sin(2.*np.pi*frequency*time))
+
+    return reference_cache.get(('oscillations', nb_points, samplerate,
+                                frequency), compute)
+
+
+
+def butter(order, cutoff, btype='low', output='ba'):
+    """
+        Return the (b, a) coefficients of a Butterworth filter, or its
+        second-order sections if output is 'sos'.
+
+        Input:
+            - order (int)
+            - cutoff (float): cutoff frequency over the Nyquist frequency.
+            - btype (str): type of filter, see scipy.signal.butter.
+            - output (str): 'ba' or 'sos'.
+    """
+
+    return reference_cache.get(('butter', int(order), float(cutoff), btype,
+                                output),
+                               lambda: scisig.butter(order, cutoff, btype=btype,
+                                                     output=output))
+
+
+
+def cheby2(order, attenuation, cutoff, btype='low', output='ba'):
+    """
+        Return the (b, a) coefficients of a Chebyshev type II filter, or its
+        second-order sections if output is 'sos'.
+
+        Input:
+            - order (int)
+            - attenuation (float): minimum attenuation in the stop band in
+              [dB].
+            - cutoff (float): cutoff frequency over the Nyquist frequency.
+            - btype (str): type of filter, see scipy.signal.cheby2.
+            - output (str): 'ba' or 'sos'.
+    """
+
+    return reference_cache.get(('cheby2', int(order), float(attenuation),
+                                float(cutoff), btype, output),
+                               lambda: scisig.cheby2(order, attenuation, cutoff,
+                                                     btype=btype,
+                                                     output=output))
+
+
+
+def pulse_envelope(nb_points, samplerate, t_start, pulse_time, tau):
+    """
+        Return the envelope of a pulse filtered by a cavity, rising as
+        1 - exp(-t/tau) from t_start and falling from t_start + pulse_time,
+        as a read-only array.
+
+        Input:
+            - nb_points (int)
+            - samplerate (float): in sample per second
+            - t_start (float): in second
+            - pulse_time (float): in second
+            - tau (float): cavity raising time in second
+    """
+
+    nb_points  = int(nb_points)
+    samplerate = float(samplerate)
+
+    def compute():
+
+        time = np.arange(nb_points)/samplerate
+
+        Heavi1 = np.piecewise(time-t_start,
+            [(time-t_start)<0, (time-t_start) == 0, (time-t_start)>0],
+            [0., 0.5, 1.] )
+        t_stop = t_start + pulse_time
+        Heavi2 = np.piecewise(time-t_stop,
+            [(time-t_stop)<0, (time-t_stop) == 0, (time-t_stop) >0],
+            [0., 0.5, 1.] )
+
+        return (1.-np.exp(-(time-t_start)/tau))*Heavi1\
+               - Heavi2*(1.-np.exp(-(time-t_stop)/tau))
+
+    return reference_cache.get(('pulse_envelope', nb_points, samplerate,
+                                float(t_start), float(pulse_time), float(tau)),
+                               compute)
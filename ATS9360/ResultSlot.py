@@ -0,0 +1,486 @@
+# This Python file uses the following encoding: utf-8
+# ATS9360_NPT.py driver for The aquisition board Alzar ATS9360
+# Etienne Dumur <etienne.dumur@neel.cnrs.fr> 2015
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import ctypes
+import cPickle as pickle
+import time
+import numpy as np
+import multiprocessing as mp
+
+
+class ResultSlot(object):
+    """
+        Latest result of the data treatment, kept in shared memory.
+        Each result overwrites the previous one in place and increments a
+        version counter, so that the reader gets the latest result without
+        going through the stale ones.
+        The slot is used by the treatment as a queue, through its put method.
+        A result is a numpy array, a number, or tuples and lists of them.
+    """
+
+
+
+    # Alignment in bytes of the arrays in the shared memory
+    alignment = 64
+
+
+
+    def __init__(self, capacity):
+        """
+            Input:
+                - capacity (int): size in bytes of the shared memory, should
+                  be larger than the arrays of a result and their description.
+        """
+
+        self.capacity = int(capacity)
+
+        self.memory = mp.RawArray(ctypes.c_uint8, self.capacity)
+
+        # Size of the description of the result written at the beginning of
+        # the memory, and number of results written so far
+        self.layout_size = mp.RawValue(ctypes.c_long, 0)
+        self.version     = mp.RawValue(ctypes.c_long, 0)
+
+        # True once the treatment has sent its last result
+        self._ended      = mp.RawValue(ctypes.c_bool, False)
+
+        self.condition = mp.Condition()
+
+        # The numpy view and the last description are kept in each process
+        self._bytes       = None
+        self._layout      = None
+        self._layout_data = None
+
+
+
+    def __getstate__(self):
+
+        state = self.__dict__.copy()
+        state['_bytes']       = None
+        state['_layout']      = None
+        state['_layout_data'] = None
+
+        return state
+
+
+
+    @property
+    def bytes(self):
+        """
+            1D numpy view of the shared memory.
+        """
+
+        if self._bytes is None:
+            self._bytes = np.frombuffer(self.memory, dtype=np.uint8)
+
+        return self._bytes
+
+
+
+    def _align(self, offset):
+
+        return -(-offset//self.alignment)*self.alignment
+
+
+
+    def _flatten(self, result, arrays, offset):
+        """
+            Return the description of result and append the
+            (offset, array) of its arrays, offset being relative to the end
+            of the description.
+        """
+
+        if isinstance(result, (tuple, list)):
+
+            children = []
+            for item in result:
+                child, offset = self._flatten(item, arrays, offset)
+                children.append(child)
+
+            return (type(result).__name__, children), offset
+
+        array = np.asarray(result)
+
+        if array.dtype.hasobject:
+            raise ValueError('The result slot can not contain %s' % type(result))
+
+        offset = self._align(offset)
+        arrays.append((offset, array))
+
+        kind = 'array' if isinstance(result, np.ndarray) else 'scalar'
+
+        return (kind, (array.dtype.str, array.shape, offset)), offset + array.nbytes
+
+
+
+    def _build(self, layout, start):
+        """
+            Return a copy of the result described by layout.
+        """
+
+        kind, content = layout
+
+        if kind in ('tuple', 'list'):
+
+            items = [self._build(child, start) for child in content]
+
+            return tuple(items) if kind == 'tuple' else items
+
+        dtype, shape, offset = content
+        dtype  = np.dtype(dtype)
+        offset = start + offset
+        nbytes = dtype.itemsize*int(np.prod(shape))
+
+        array = self.bytes[offset:offset + nbytes].view(dtype).reshape(shape).copy()
+
+        if kind == 'scalar':
+            return array[()]
+
+        return array
+
+
+
+    def put(self, result, count=1):
+        """
+            Overwrite the result in the shared memory.
+
+            Input:
+                - result: see the class description.
+                - count (int): number of results the written one stands for,
+                  added to the version. A treatment pool only writes the last
+                  result of each buffer.
+        """
+
+        arrays = []
+        layout, size = self._flatten(result, arrays, 0)
+
+        with self.condition:
+
+            # The description is only written when it changes, there is a
+            # single writer per measurement
+            if layout != self._layout:
+
+                layout_data = pickle.dumps(layout, 2)
+                start       = self._align(len(layout_data))
+
+                if start + size > self.capacity:
+                    raise ValueError('The result needs %i bytes, more than the %i bytes of the result slot'\
+                                     % (start + size, self.capacity))
+
+                self.bytes[:len(layout_data)] = np.frombuffer(layout_data,
+                                                              dtype=np.uint8)
+                self.layout_size.value = len(layout_data)
+
+                self._layout      = layout
+                self._layout_data = layout_data
+
+            start = self._align(len(self._layout_data))
+
+            for offset, array in arrays:
+
+                offset += start
+                self.bytes[offset:offset + array.nbytes]\
+                    .view(array.dtype).reshape(array.shape)[...] = array
+
+            self.version.value += count
+            self.condition.notify_all()
+
+
+
+    def get(self, min_version=1, timeout=None):
+        """
+            Wait until at least min_version results have been written, the
+            end of the treatment or until timeout in second, and return the
+            latest result as (version, result).
+            The result is None if nothing has been written yet.
+        """
+
+        if timeout is not None:
+            end = time.time() + timeout
+
+        with self.condition:
+
+            while self.version.value < min_version and not self._ended.value:
+
+                if timeout is None:
+                    self.condition.wait()
+                else:
+                    remaining = end - time.time()
+                    if remaining <= 0.:
+                        break
+                    self.condition.wait(remaining)
+
+            version = self.version.value
+
+            if version == 0:
+                return version, None
+
+            layout_data = self.bytes[:self.layout_size.value].tostring()
+
+            if layout_data != self._layout_data:
+                self._layout      = pickle.loads(layout_data)
+                self._layout_data = layout_data
+
+            return version, self._build(self._layout, self._align(len(layout_data)))
+
+
+
+    def end(self):
+        """
+            Indicate that no result will be written anymore, the readers
+            waiting for a result get the last one.
+        """
+
+        with self.condition:
+            self._ended.value = True
+            self.condition.notify_all()
+
+
+
+    @property
+    def ended(self):
+        """
+            True once the treatment has sent its last result.
+        """
+
+        return self._ended.value
+
+
+
+    def close(self):
+        """
+            Indicate that the current process will not use the slot anymore.
+            Present for the slot to be used as the treatment queue.
+        """
+
+        pass
+
+
+
+class MergedResultSlot(object):
+    """
+        Latest results of the data treatments of several boards, aligned on
+        their version.
+        Each board writes its results through its own BoardResultSlot and the
+        reader gets, for the latest version written by every board, the
+        result of each board, that is the results of the same records.
+        Each board alternates between two ResultSlot, a board being at most
+        one result ahead of the slowest one: its treatment waits before
+        writing further. The boards treating the same buffers, they write
+        their results at the same versions.
+    """
+
+
+
+    def __init__(self, capacity, nb_boards):
+        """
+            Input:
+                - capacity (int): size in bytes of the shared memory of each
+                  result, see ResultSlot.
+                - nb_boards (int)
+        """
+
+        self.nb_boards = int(nb_boards)
+
+        self.slots = [(ResultSlot(capacity), ResultSlot(capacity))
+                      for board in range(self.nb_boards)]
+
+        # Number of results written by each board, and True once a board has
+        # sent its last result
+        self.versions = mp.RawArray(ctypes.c_long, self.nb_boards)
+        self._ended   = mp.RawArray(ctypes.c_bool, self.nb_boards)
+
+        # Version of the result in the slot k of a board, at 2*board + k
+        self.slot_versions = mp.RawArray(ctypes.c_long, 2*self.nb_boards)
+
+        self.condition = mp.Condition()
+
+
+
+    def _merged_version(self):
+        """
+            Return the latest version written by every board and True if it
+            will not change anymore, a board having ended on it.
+            Must be called with the condition acquired.
+        """
+
+        version = min(self.versions)
+
+        finished = any(self._ended[board] and self.versions[board] == version
+                       for board in range(self.nb_boards))
+
+        return version, finished
+
+
+
+    def _slot(self, board, version):
+        """
+            Return the index of the slot of a board holding the latest result
+            written up to version.
+            Must be called with the condition acquired.
+        """
+
+        versions = self.slot_versions[2*board:2*board + 2]
+
+        return max((0, 1), key=lambda k: (versions[k] <= version, versions[k]))
+
+
+
+    def writer(self, board):
+        """
+            Return the slot in which a board writes its results, used by its
+            treatment as a queue.
+        """
+
+        return BoardResultSlot(self, board)
+
+
+
+    def put(self, board, result, count=1):
+        """
+            Write the next result of a board, standing for count results,
+            see ResultSlot.put.
+            A result which can not be aligned anymore, another board having
+            ended before it, is dropped.
+        """
+
+        with self.condition:
+
+            while True:
+
+                version, finished = self._merged_version()
+
+                # The slot of the next version is not read anymore
+                if self.versions[board] <= version:
+                    break
+
+                if finished:
+                    return
+
+                self.condition.wait()
+
+            version = self.versions[board] + count
+
+            # The oldest slot of the board is not read anymore
+            slot = 1 - self._slot(board, self.versions[board])
+
+        self.slots[board][slot].put(result, count)
+
+        with self.condition:
+            self.slot_versions[2*board + slot] = version
+            self.versions[board] = version
+            self.condition.notify_all()
+
+
+
+    def get(self, min_version=1, timeout=None):
+        """
+            Wait until every board has written at least min_version results,
+            the end of the treatment or until timeout in second, and return
+            the latest version written by every board with the results of the
+            boards as (version, (result_board_1, result_board_2, ...)).
+            The result is None if nothing has been written yet.
+        """
+
+        if timeout is not None:
+            end = time.time() + timeout
+
+        # The condition is kept while reading for the boards not to write
+        # in the slots read
+        with self.condition:
+
+            version, finished = self._merged_version()
+
+            while version < min_version and not finished:
+
+                if timeout is None:
+                    self.condition.wait()
+                else:
+                    remaining = end - time.time()
+                    if remaining <= 0.:
+                        break
+                    self.condition.wait(remaining)
+
+                version, finished = self._merged_version()
+
+            if version == 0:
+                return version, None
+
+            return version, tuple(self.slots[board][self._slot(board, version)].get(0)[1]
+                                  for board in range(self.nb_boards))
+
+
+
+    def end(self, board):
+        """
+            Indicate that a board will not write any result anymore.
+        """
+
+        with self.condition:
+            self._ended[board] = True
+            self.condition.notify_all()
+
+
+
+    @property
+    def ended(self):
+        """
+            True once the merged version will not change anymore.
+        """
+
+        with self.condition:
+            return self._merged_version()[1]
+
+
+
+    def close(self):
+
+        pass
+
+
+
+class BoardResultSlot(object):
+    """
+        Slot of a board in a MergedResultSlot, used by the treatment of the
+        board as a queue.
+    """
+
+
+
+    def __init__(self, merged, board):
+
+        self.merged = merged
+        self.board  = board
+
+
+
+    def put(self, result, count=1):
+
+        self.merged.put(self.board, result, count)
+
+
+
+    def end(self):
+
+        self.merged.end(self.board)
+
+
+
+    def close(self):
+
+        pass
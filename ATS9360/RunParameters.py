@@ -0,0 +1,351 @@
+# This Python file uses the following encoding: utf-8
+# ATS9360_NPT.py driver for The aquisition board Alzar ATS9360
+# Etienne Dumur <etienne.dumur@neel.cnrs.fr> 2015
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import ctypes
+import numpy as np
+import multiprocessing as mp
+from StageTimer import StageTimer
+
+
+class RunConfig(object):
+    """
+        Frozen configuration of a measurement.
+        It is given to the processes when they start and read as a local
+        dictionary, without any communication between processes.
+    """
+
+
+
+    def __init__(self, **values):
+
+        object.__setattr__(self, '_values', dict(values))
+
+
+
+    def __getitem__(self, name):
+
+        return self._values[name]
+
+
+
+    def __contains__(self, name):
+
+        return name in self._values
+
+
+
+    def __setitem__(self, name, value):
+
+        raise TypeError('The run configuration is frozen, %s can not be set' % name)
+
+
+
+    def __setattr__(self, name, value):
+
+        raise TypeError('The run configuration is frozen, %s can not be set' % name)
+
+
+
+    def __getstate__(self):
+
+        return self._values
+
+
+
+    def __setstate__(self, values):
+
+        object.__setattr__(self, '_values', values)
+
+
+
+    def keys(self):
+
+        return self._values.keys()
+
+
+
+class RunState(object):
+    """
+        Values of a measurement changing while it runs, kept in shared memory.
+        They are read and written without lock, except the message and the
+        stage statistics.
+        In a measurement of several boards, each board has its own state,
+        the measuring flag and the start of the capture being shared by all
+        of them.
+    """
+
+    # Size in bytes of the message
+    message_size = 2**14
+
+    names = frozenset(('measuring', 'measured_buffers', 'samplesPerRecord',
+                       'safe_acquisition', 'safe_treatment', 'message',
+                       'trigger_statistics', 'stage_statistics',
+                       'capture_time'))
+
+    # Trigger statistics given by the NPT footers
+    trigger_statistics_names = ('triggers', 'gaps', 'missed_records', 'rate',
+                                'period_mean', 'period_std', 'period_min',
+                                'period_max')
+
+
+
+    def __init__(self, shared=None):
+        """
+            Input:
+                - shared (RunState): state of another board of the
+                  measurement, whose measuring flag and start of the capture
+                  are shared. If None, the measurement has a single board so
+                  far.
+        """
+
+        if shared is None:
+
+            # False asks the acquisition of every board to stop
+            self._measuring = mp.RawValue(ctypes.c_bool, True)
+
+            # Number of boards of the measurement and of boards ready to
+            # capture
+            self._nb_boards       = mp.RawValue(ctypes.c_long, 0)
+            self._ready_boards    = mp.RawValue(ctypes.c_long, 0)
+            self._ready_condition = mp.Condition()
+        else:
+
+            self._measuring       = shared._measuring
+            self._nb_boards       = shared._nb_boards
+            self._ready_boards    = shared._ready_boards
+            self._ready_condition = shared._ready_condition
+
+        self._nb_boards.value += 1
+
+        # Number of buffers acquired, negative as long as unknown
+        self._measured_buffers = mp.RawValue(ctypes.c_long, -1)
+
+        # Number of samples per record set on the board, zero as long as
+        # unknown
+        self._samplesPerRecord = mp.RawValue(ctypes.c_long, 0)
+
+        # True means the board has been closed properly
+        self._safe_acquisition = mp.RawValue(ctypes.c_bool, False)
+
+        # True means the treatment is finished
+        self._safe_treatment   = mp.RawValue(ctypes.c_bool, False)
+
+        # Duration of the capture in s, zero as long as unknown
+        self._capture_time     = mp.RawValue(ctypes.c_double, 0.)
+
+        self._message      = mp.RawArray(ctypes.c_char, self.message_size)
+        self._message_lock = mp.Lock()
+
+        self._trigger_statistics = mp.RawArray(ctypes.c_double,
+                                               len(self.trigger_statistics_names))
+
+        # Stage timers of all the processes of the measurement, added up
+        self._stage_statistics = mp.RawArray(ctypes.c_double,
+                                             len(StageTimer.stages)*StageTimer.width)
+        self._stage_lock       = mp.Lock()
+
+        StageTimer.reset(self._stage_array())
+
+
+
+    def reset(self):
+        """
+            Set the values of the beginning of a measurement.
+        """
+
+        self._measuring.value        = True
+        self._measured_buffers.value = -1
+        self._samplesPerRecord.value = 0
+        self._safe_acquisition.value = False
+        self._safe_treatment.value   = False
+        self._capture_time.value     = 0.
+        self._ready_boards.value     = 0
+
+        self._trigger_statistics[:] = [0.]*len(self.trigger_statistics_names)
+
+        with self._stage_lock:
+            StageTimer.reset(self._stage_array())
+
+        with self._message_lock:
+            self._message.value = ''
+
+
+
+    def _stage_array(self):
+        """
+            Return a numpy view of the stage statistics, one row per stage.
+        """
+
+        return np.frombuffer(self._stage_statistics, dtype=np.float64)\
+                 .reshape(len(StageTimer.stages), StageTimer.width)
+
+
+
+    def add_stage_timer(self, timer):
+        """
+            Add the StageTimer of a process to the stage statistics.
+        """
+
+        with self._stage_lock:
+            StageTimer.merge(self._stage_array(), timer.array)
+
+
+
+    def stage_array(self):
+        """
+            Return a copy of the stage statistics as a timer array, to be
+            merged with the ones of the other boards.
+        """
+
+        with self._stage_lock:
+            return self._stage_array().copy()
+
+
+
+    def wait_boards(self):
+        """
+            Wait until every board of the measurement is ready to capture, for
+            their records to follow the same triggers, or until the
+            measurement is stopped.
+        """
+
+        with self._ready_condition:
+
+            self._ready_boards.value += 1
+            self._ready_condition.notify_all()
+
+            # The measuring flag is not notified, it is polled
+            while self._ready_boards.value < self._nb_boards.value\
+                  and self._measuring.value:
+                self._ready_condition.wait(0.1)
+
+
+
+    def add_message(self, message):
+        """
+            Append message to the information about the measurement.
+        """
+
+        with self._message_lock:
+            message = self._message.value + message
+            self._message.value = message[:self.message_size - 1]
+
+
+
+    def __getitem__(self, name):
+
+        if name == 'message':
+            return self._message.value
+
+        if name == 'trigger_statistics':
+            return dict(zip(self.trigger_statistics_names,
+                            self._trigger_statistics))
+
+        if name == 'stage_statistics':
+            with self._stage_lock:
+                return StageTimer.statistics(self._stage_array().copy())
+
+        value = getattr(self, '_' + name).value
+
+        if name == 'measured_buffers' and value < 0:
+            return None
+
+        return value
+
+
+
+    def __setitem__(self, name, value):
+
+        if name == 'message':
+            with self._message_lock:
+                self._message.value = value[:self.message_size - 1]
+        elif name == 'trigger_statistics':
+            self._trigger_statistics[:] = [value[key] for key in self.trigger_statistics_names]
+        elif name == 'measured_buffers' and value is None:
+            self._measured_buffers.value = -1
+        else:
+            getattr(self, '_' + name).value = value
+
+
+
+class RunParameters(object):
+    """
+        Parameters of a measurement given to the acquisition and treatment
+        processes, read as a dictionary.
+        The static ones come from a RunConfig, the live ones from a RunState.
+        The samplesPerRecord set on the board replaces the configured one
+        once known.
+    """
+
+
+
+    def __init__(self, config, state):
+
+        self.config = config
+        self.state  = state
+
+
+
+    def __getitem__(self, name):
+
+        if name in RunState.names:
+
+            value = self.state[name]
+
+            if name == 'samplesPerRecord' and value == 0:
+                return self.config[name]
+
+            return value
+
+        return self.config[name]
+
+
+
+    def __setitem__(self, name, value):
+
+        if name in RunState.names:
+            self.state[name] = value
+        else:
+            self.config[name] = value
+
+
+
+    def add_message(self, message):
+        """
+            Append message to the information about the measurement.
+        """
+
+        self.state.add_message(message)
+
+
+
+    def add_stage_timer(self, timer):
+        """
+            Add the StageTimer of a process to the stage statistics.
+        """
+
+        self.state.add_stage_timer(timer)
+
+
+
+    def wait_boards(self):
+        """
+            Wait until every board of the measurement is ready to capture.
+        """
+
+        self.state.wait_boards()
@@ -0,0 +1,209 @@
+# This Python file uses the following encoding: utf-8
+# ATS9360_NPT.py driver for The aquisition board Alzar ATS9360
+# Etienne Dumur <etienne.dumur@neel.cnrs.fr> 2015
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import ctypes
+import numpy as np
+import multiprocessing as mp
+from StageTimer import monotonic
+
+
+class SharedRing(object):
+    """
+        Ring of preallocated slots living in shared memory.
+        The acquisition process writes each DMA buffer in a free slot and only
+        the index of the slot travels through the queues. The treatment
+        process reads the slot as a numpy view and releases it once treated.
+        With several readers, the buffers are dealt round-robin by groups of
+        unit_buffers consecutive buffers.
+    """
+
+
+
+    def __init__(self, nb_slots, slot_samples, sample_type=ctypes.c_uint16,
+                 nb_readers=1, unit_buffers=1):
+        """
+            Input:
+                - nb_slots (int): number of slots of the ring.
+                - slot_samples (int): number of samples of a slot, should be
+                  records_per_buffer x samplesPerRecord x channels.
+                - sample_type (ctypes type): type of the samples.
+                - nb_readers (int): number of treatment processes reading the
+                  ring.
+                - unit_buffers (int): number of consecutive buffers given to
+                  the same reader.
+        """
+
+        self.nb_slots     = int(nb_slots)
+        self.slot_samples = int(slot_samples)
+        self.sample_type  = sample_type
+        self.nb_readers   = int(nb_readers)
+        self.unit_buffers = int(unit_buffers)
+
+        # The memory is allocated once and shared by all the processes
+        self.memory = mp.RawArray(sample_type, self.nb_slots*self.slot_samples)
+
+        # Monotonic time at which the buffer of each slot was acquired
+        self.timestamps = mp.RawArray(ctypes.c_double, self.nb_slots)
+
+        # Indexes of the slots available for the acquisition and of the slots
+        # waiting to be treated by each reader
+        self.free_slots   = mp.Queue()
+        self.filled_slots = [mp.Queue() for reader in range(self.nb_readers)]
+
+        for index in range(self.nb_slots):
+            self.free_slots.put(index)
+
+        # The numpy views are built lazily in each process
+        self._slots = None
+
+        # Number of buffers written so far, only used by the acquisition
+        self._written = 0
+
+
+
+    def __getstate__(self):
+
+        state = self.__dict__.copy()
+        state['_slots'] = None
+
+        return state
+
+
+
+    @property
+    def slots(self):
+        """
+            2D numpy view (nb_slots, slot_samples) of the shared memory.
+        """
+
+        if self._slots is None:
+            self._slots = np.frombuffer(self.memory,
+                                        dtype=np.dtype(self.sample_type))\
+                            .reshape(self.nb_slots, self.slot_samples)
+
+        return self._slots
+
+
+
+    def configure(self, nb_readers, unit_buffers):
+        """
+            Set how the buffers of a new measurement are dealt to the readers.
+            Must be called by the acquisition before the first buffer.
+        """
+
+        if nb_readers > len(self.filled_slots):
+            raise ValueError('The ring has been created for %i readers at most'\
+                             % len(self.filled_slots))
+
+        self.nb_readers   = int(nb_readers)
+        self.unit_buffers = int(unit_buffers)
+        self._written     = 0
+
+
+
+    def put(self, data, timestamp=None, timer=None):
+        """
+            Copy data in the next free slot and hand the slot over to the
+            treatment.
+            Block until a slot is released if the ring is full.
+
+            Input:
+                - data (array): buffer to copy.
+                - timestamp (float): monotonic time at which the buffer was
+                  acquired, now if None.
+                - timer (StageTimer): if given, the copy and the queue
+                  operations are timed.
+        """
+
+        start = monotonic()
+        index = self.free_slots.get()
+        copy  = monotonic()
+
+        np.copyto(self.slots[index, :data.size], data)
+
+        self.timestamps[index] = start if timestamp is None else timestamp
+        copied = monotonic()
+
+        reader = (self._written//self.unit_buffers)%self.nb_readers
+        self.filled_slots[reader].put(index)
+
+        self._written += 1
+
+        if timer is not None:
+            timer.add('copy', copied - copy)
+            timer.add('queue_put', copy - start + monotonic() - copied)
+
+
+
+    def end(self):
+        """
+            Inform the readers that no more buffer will be written for the
+            current measurement.
+        """
+
+        for reader in range(self.nb_readers):
+            self.filled_slots[reader].put(None)
+
+
+
+    def get(self, reader=0):
+        """
+            Return the index and a view on the oldest filled slot of a reader.
+            The slot must be given back with the release method once the data
+            have been treated.
+            Return (None, None) once all the buffers of the measurement have
+            been read.
+        """
+
+        index = self.filled_slots[reader].get()
+
+        if index is None:
+            return None, None
+
+        return index, self.slots[index]
+
+
+
+    def timestamp(self, index):
+        """
+            Return the monotonic time at which the buffer of a slot was
+            acquired.
+        """
+
+        return self.timestamps[index]
+
+
+
+    def release(self, index):
+        """
+            Give a slot back to the acquisition.
+        """
+
+        self.free_slots.put(index)
+
+
+
+    def close(self):
+        """
+            Indicate that the current process will not use the ring anymore.
+        """
+
+        self.free_slots.close()
+
+        for filled_slots in self.filled_slots:
+            filled_slots.close()
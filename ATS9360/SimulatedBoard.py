@@ -0,0 +1,393 @@
+# This Python file uses the following encoding: utf-8
+# ATS9360_NPT.py driver for The aquisition board Alzar ATS9360
+# Etienne Dumur <etienne.dumur@neel.cnrs.fr> 2015
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+from __future__ import division
+import collections
+import ctypes
+import time
+import numpy as np
+import atsapi as ats
+
+
+# Samplerates in S/s of the internal clock, from the codes of the ATS-SDK
+_prefixes = {'KSPS' : 1e3, 'MSPS' : 1e6, 'GSPS' : 1e9}
+internal_samplerates = {}
+for _name in dir(ats):
+    for _prefix, _factor in _prefixes.items():
+        if _name.startswith('SAMPLE_RATE_') and _name.endswith(_prefix):
+            internal_samplerates[getattr(ats, _name)] = float(_name[12:-4])*_factor
+
+
+
+class SyntheticSignal(object):
+    """
+        Signal received by the simulated board: a sum of IF tones with a white
+        gaussian noise, the trigger of each record being delayed by a
+        gaussian jitter.
+        A bank of nb_records records is computed when the board is armed and
+        the acquisition cycles through it, so that the generation does not
+        slow down the pipeline under test.
+    """
+
+
+
+    def __init__(self, tones=((50., 0.1, 0.),), noise=0.01, jitter=0.,
+                 trigger_rate=None, channel_b_phase=np.pi/2., nb_records=64,
+                 seed=None):
+        """
+            Input:
+                - tones (tuple): (frequency [MHz], amplitude [V], phase [rad])
+                  of each tone on channel A.
+                - noise (float): rms voltage of the noise in [V].
+                - jitter (float): rms of the trigger time in [ns].
+                - trigger_rate (float): repetition rate of the trigger in
+                  [Hz]. If None, the records are given as fast as they are
+                  read.
+                - channel_b_phase (float): phase added to the tones on
+                  channel B in [rad].
+                - nb_records (int): number of different records.
+                - seed (int): seed of the random generator.
+        """
+
+        self.tones           = tuple(tones)
+        self.noise           = float(noise)
+        self.jitter          = float(jitter)
+        self.trigger_rate    = trigger_rate
+        self.channel_b_phase = float(channel_b_phase)
+        self.nb_records      = int(nb_records)
+        self.seed            = seed
+
+
+
+    def volts(self, samplerate, samplesPerRecord, delay_samples, channels):
+        """
+            Return the records without noise in V, as an array of shape
+            (nb_records, samplesPerRecord, len(channels)).
+
+            Input:
+                - samplerate (float): in [S/s].
+                - samplesPerRecord (int)
+                - delay_samples (int): delay of the records after the trigger.
+                - channels (list): ats.CHANNEL_A or ats.CHANNEL_B of each
+                  channel of a record.
+        """
+
+        random = np.random.RandomState(self.seed)
+
+        # Time of each sample from its trigger
+        jitter = random.normal(0., self.jitter*1e-9, (self.nb_records, 1))
+        t = (np.arange(samplesPerRecord) + delay_samples)/samplerate + jitter
+
+        records = np.zeros((self.nb_records, samplesPerRecord, len(channels)))
+
+        for index, channel in enumerate(channels):
+
+            shift = self.channel_b_phase if channel == ats.CHANNEL_B else 0.
+
+            for frequency, amplitude, phase in self.tones:
+                records[:, :, index] += amplitude*np.cos(2.*np.pi*frequency*1e6*t\
+                                                         + phase + shift)
+
+        return records, random
+
+
+
+    def codes(self, samplerate, samplesPerRecord, delay_samples, channels,
+              records_per_average=1):
+        """
+            Return the records as given by the board, as an array of shape
+            (nb_records, samplesPerRecord*len(channels)), the samples of the
+            channels being interleaved.
+            The 12-bit codes are in the high bits of 16-bit samples, or
+            summed over records_per_average records in 32-bit samples.
+            The noise of the sums is drawn for the sum itself, the records of
+            a sum share their jitter.
+        """
+
+        records, random = self.volts(samplerate, samplesPerRecord,
+                                     delay_samples, channels)
+
+        # Calibration of the AlazarTech digitizers, see VoltConverter
+        codeZero  = (1 << 11) - 0.5
+        codeRange = (1 << 11) - 0.5
+        inputRange_volts = 400e-3
+
+        records  = records*records_per_average
+        records += random.normal(0., self.noise*np.sqrt(records_per_average),
+                                 records.shape)
+
+        codes = np.round(records*codeRange/inputRange_volts\
+                         + codeZero*records_per_average)
+        codes = np.clip(codes, 0, 4095*records_per_average)
+
+        codes = codes.reshape(self.nb_records, -1)
+
+        if records_per_average > 1:
+            return codes.astype(np.uint32)
+
+        return codes.astype(np.uint16) << 4
+
+
+
+class DMABuffer(object):
+    """
+        Buffer of the simulated board, allocated by numpy with the alignment
+        of a page, like the DMA buffers of atsapi.
+    """
+
+    alignment = 4096
+
+
+
+    def __init__(self, c_sample_type, size_bytes):
+
+        self.size_bytes = size_bytes
+
+        sample_type = np.dtype(c_sample_type)
+
+        self._memory = np.zeros(size_bytes + self.alignment, dtype=np.uint8)
+        offset = -self._memory.ctypes.data%self.alignment
+
+        self.buffer = self._memory[offset:offset + size_bytes].view(sample_type)
+        self.addr   = self.buffer.ctypes.data
+
+
+
+class Board(object):
+    """
+        Simulated ATS9360 giving the records of a SyntheticSignal through the
+        API of atsapi.Board used by DataAcquisition.
+        Only the asynchronous NPT acquisition is simulated, with or without
+        the on-board record averaging. The on-FPGA FFT and the record
+        footers need the AlazarTech library.
+    """
+
+
+
+    def __init__(self, systemId=1, boardId=1, signal=None):
+
+        self.systemId = systemId
+        self.boardId  = boardId
+        self.signal   = signal if signal is not None else SyntheticSignal()
+
+        self.samplerate          = 1e9
+        self.delay_samples       = 0
+        self.records_per_average = 1
+
+        self.posted  = collections.deque()
+        self.records = None
+
+
+
+    def inputControl(self, channel, coupling, inputRange, impedance):
+        pass
+
+
+
+    def setCaptureClock(self, source, rate, edge, decimation):
+
+        if source == ats.INTERNAL_CLOCK:
+            self.samplerate = internal_samplerates[rate]
+        else:
+            self.samplerate = float(rate)
+
+
+
+    def setTriggerOperation(self, *args):
+        pass
+
+
+
+    def setExternalTrigger(self, coupling, range):
+        pass
+
+
+
+    def setTriggerDelay(self, delay_samples):
+
+        self.delay_samples = delay_samples
+
+
+
+    def setTriggerTimeOut(self, timeout_clocks):
+        pass
+
+
+
+    def configureAuxIO(self, mode, parameter):
+        pass
+
+
+
+    def getChannelInfo(self):
+
+        return (ctypes.c_uint32(4*2**30), ctypes.c_byte(12))
+
+
+
+    def setRecordSize(self, preTriggerSamples, postTriggerSamples):
+        pass
+
+
+
+    def configureRecordAverage(self, mode, samplesPerRecord, recordsPerAverage,
+                               options):
+
+        if mode == ats.CRA_MODE_ENABLE_FPGA_AVE:
+            self.records_per_average = recordsPerAverage
+        else:
+            self.records_per_average = 1
+
+
+
+    def beforeAsyncRead(self, channels, transferOffset, samplesPerRecord,
+                        recordsPerBuffer, recordsPerAcquisition, flags):
+
+        if flags & (ats.ADMA_DSP | ats.ADMA_ENABLE_RECORD_FOOTERS):
+            raise ValueError('The on-FPGA FFT and the record footers are not '
+                             'simulated')
+
+        channel_list = [channel for channel in (ats.CHANNEL_A, ats.CHANNEL_B)
+                        if channels & channel]
+
+        self.records = self.signal.codes(self.samplerate, samplesPerRecord,
+                                         self.delay_samples, channel_list,
+                                         self.records_per_average)
+
+        self.recordsPerBuffer      = recordsPerBuffer
+        self.recordsPerAcquisition = recordsPerAcquisition
+
+        self.posted.clear()
+        self.views = {}
+
+
+
+    def postAsyncBuffer(self, buffer, bufferLength):
+
+        # We keep a view of the buffer shaped as the records it receives
+        if buffer not in self.views:
+
+            size = bufferLength//self.records.itemsize
+            data = np.ctypeslib.as_array((ctypes.c_char*bufferLength).from_address(buffer))
+            data = data.view(self.records.dtype)[:size]
+
+            self.views[buffer] = data.reshape(self.recordsPerBuffer, -1)
+
+        self.posted.append(buffer)
+
+
+
+    def startCapture(self):
+
+        self.start            = time.time()
+        self.recordsCompleted = 0
+
+
+
+    def waitAsyncBufferComplete(self, buffer, timeout_ms):
+
+        if not self.posted or self.posted[0] != buffer:
+            raise Exception('Error calling function waitAsyncBufferComplete: '
+                            'ApiBufferNotReady')
+
+        if self.recordsCompleted >= self.recordsPerAcquisition:
+            raise Exception('Error calling function waitAsyncBufferComplete: '
+                            'ApiTransferComplete')
+
+        # The buffer is complete once the triggers of its records came
+        if self.signal.trigger_rate is not None:
+
+            triggers = (self.recordsCompleted + self.recordsPerBuffer)\
+                       *self.records_per_average
+            wait     = self.start + triggers/self.signal.trigger_rate - time.time()
+
+            if wait > timeout_ms*1e-3:
+                time.sleep(timeout_ms*1e-3)
+                raise Exception('Error calling function waitAsyncBufferComplete: '
+                                'ApiWaitTimeout')
+            elif wait > 0:
+                time.sleep(wait)
+
+        view    = self.views[buffer]
+        indices = np.arange(self.recordsCompleted,
+                            self.recordsCompleted + self.recordsPerBuffer)\
+                  %len(self.records)
+
+        np.take(self.records, indices, axis=0, out=view)
+
+        self.recordsCompleted += self.recordsPerBuffer
+        self.posted.popleft()
+
+
+
+    def abortAsyncRead(self):
+
+        self.posted.clear()
+
+
+
+    def abortCapture(self):
+
+        self.posted.clear()
+
+
+
+class SimulatedBackend(object):
+    """
+        Backend of DataAcquisition standing for atsapi, whose boards receive
+        the records of a SyntheticSignal.
+        All the boards receive the same signal on the same triggers.
+    """
+
+    DMABuffer = DMABuffer
+
+
+
+    def __init__(self, signal=None, boards=(1,)):
+        """
+            Input:
+                - signal (SyntheticSignal): if None, a 50 MHz tone.
+                - boards (tuple): number of boards of each board system.
+        """
+
+        self.signal = signal if signal is not None else SyntheticSignal()
+        self.boards = tuple(boards)
+
+
+
+    def numOfSystems(self):
+
+        return len(self.boards)
+
+
+
+    def boardsInSystemBySystemID(self, systemId):
+
+        if 1 <= systemId <= len(self.boards):
+            return self.boards[systemId - 1]
+
+        return 0
+
+
+
+    def Board(self, systemId=1, boardId=1):
+
+        if not 1 <= boardId <= self.boardsInSystemBySystemID(systemId):
+            raise Exception("Board %d.%d not found" % (systemId, boardId))
+
+        return Board(systemId, boardId, self.signal)
@@ -0,0 +1,316 @@
+# This Python file uses the following encoding: utf-8
+# ATS9360_NPT.py driver for The aquisition board Alzar ATS9360
+# Etienne Dumur <etienne.dumur@neel.cnrs.fr> 2015
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import bisect
+import ctypes
+import os
+import time
+import numpy as np
+
+
+# Monotonic clock in s, shared by all the processes so that the time of a
+# buffer can be compared from one process to the other.
+# time.clock is the CPU time of the process on Linux and starts at the first
+# call of each process on Windows, time.time may jump.
+if hasattr(time, 'monotonic'):
+
+    monotonic = time.monotonic
+
+elif os.name == 'nt':
+
+    _frequency = ctypes.c_int64()
+    ctypes.windll.kernel32.QueryPerformanceFrequency(ctypes.byref(_frequency))
+    _frequency = float(_frequency.value)
+
+    def monotonic():
+        counter = ctypes.c_int64()
+        ctypes.windll.kernel32.QueryPerformanceCounter(ctypes.byref(counter))
+        return counter.value/_frequency
+
+else:
+
+    class _timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    try:
+        _librt = ctypes.CDLL('librt.so.1')
+    except OSError:
+        _librt = ctypes.CDLL('libc.so.6')
+
+    _clock_gettime = _librt.clock_gettime
+    _CLOCK_MONOTONIC = 1
+
+    # The structure is reused by every call of the process
+    _now     = _timespec()
+    _now_ref = ctypes.byref(_now)
+
+    def monotonic():
+        _clock_gettime(_CLOCK_MONOTONIC, _now_ref)
+        return _now.tv_sec + _now.tv_nsec*1e-9
+
+
+
+class StageTimer(object):
+    """
+        Counters and latency histograms of the stages of the pipeline.
+        Each process keeps its own timer and adds it to the shared one of the
+        RunState at the end of the measurement.
+        A timer is an array of one row per stage: the count, the total,
+        minimum and maximum durations in s, then the histogram of the
+        durations in bins of powers of two.
+
+        Stages:
+            - dma_wait: wait for the board to fill a DMA buffer.
+            - copy: copy of a DMA buffer in a slot of the ring.
+            - queue_put: wait for a free slot and hand it to the treatment.
+            - queue_get: wait for a filled slot in the treatment.
+            - conversion: conversion of the samples in V.
+            - demodulation: projection of the records on the references.
+            - averaging: rest of the treatment of a sequence, mostly the
+              running averages.
+            - result_publish: copy of a result in the result slot, or of the
+              state of the accumulators in a treatment pool.
+            - latency: from the end of the DMA transfer of a buffer to the
+              end of its treatment.
+        The conversion, demodulation, averaging and result_publish stages
+        are timed for each sequence, only when the stage_timing parameter of
+        the measurement is set since it costs about 15 us per sequence.
+    """
+
+    stages = ('dma_wait', 'copy', 'queue_put', 'queue_get', 'conversion',
+              'demodulation', 'averaging', 'result_publish', 'latency')
+
+    # Upper edges of the histogram bins in s, the last bin being open
+    bins = 1e-6*2.**np.arange(24)
+
+    # Columns of a row
+    COUNT, TOTAL, MIN, MAX, HISTOGRAM = range(5)
+
+    width = 4 + len(bins) + 1
+
+
+
+    def __init__(self):
+
+        # The rows are kept in lists while timing, a float operation on a
+        # list being much faster than on a numpy array
+        self._rows  = dict((stage, [0., 0., np.inf, 0.] + [0]*(len(self.bins) + 1))
+                           for stage in self.stages)
+        self._edges = list(self.bins)
+
+
+
+    @property
+    def array(self):
+        """
+            Return the timer as an array of one row per stage.
+        """
+
+        return np.array([self._rows[stage] for stage in self.stages],
+                        dtype=np.float64)
+
+
+
+    @classmethod
+    def reset(cls, array):
+        """
+            Empty the rows of a timer array.
+        """
+
+        array.fill(0.)
+        array[:, cls.MIN] = np.inf
+
+
+
+    def add(self, stage, duration):
+        """
+            Add a duration in s to a stage.
+        """
+
+        row = self._rows[stage]
+
+        row[0] += 1
+        row[1] += duration
+
+        if duration < row[2]:
+            row[2] = duration
+        if duration > row[3]:
+            row[3] = duration
+
+        row[4 + bisect.bisect_left(self._edges, duration)] += 1
+
+
+
+    def lap(self, stage, start):
+        """
+            Add the time elapsed since start to a stage and return the
+            current time.
+        """
+
+        now = monotonic()
+        self.add(stage, now - start)
+
+        return now
+
+
+
+    def total(self, *stages):
+        """
+            Return the total duration of stages in s.
+        """
+
+        rows = self._rows
+
+        return sum(rows[stage][1] for stage in stages)
+
+
+
+    @classmethod
+    def merge(cls, array, other):
+        """
+            Add the rows of the timer array other to the ones of array.
+        """
+
+        array[:, cls.COUNT] += other[:, cls.COUNT]
+        array[:, cls.TOTAL] += other[:, cls.TOTAL]
+        array[:, cls.MIN]    = np.minimum(array[:, cls.MIN], other[:, cls.MIN])
+        array[:, cls.MAX]    = np.maximum(array[:, cls.MAX], other[:, cls.MAX])
+        array[:, cls.HISTOGRAM:] += other[:, cls.HISTOGRAM:]
+
+
+
+    @classmethod
+    def statistics(cls, array):
+        """
+            Return the statistics of a timer array as a dictionary of stages,
+            each one being a dictionary with the count, the total, mean,
+            minimum and maximum durations in s, the rate in events per second
+            the stage could sustain alone, and the histogram of the durations
+            as (upper edges in s, counts).
+        """
+
+        statistics = {}
+
+        for stage, row in zip(cls.stages, array):
+
+            count = int(row[cls.COUNT])
+
+            stage_statistics = {'count'     : count,
+                                'total'     : row[cls.TOTAL],
+                                'mean'      : 0.,
+                                'min'       : 0.,
+                                'max'       : 0.,
+                                'rate'      : 0.,
+                                'histogram' : (np.append(cls.bins, np.inf),
+                                               row[cls.HISTOGRAM:].astype(int))}
+
+            if count:
+                stage_statistics['mean'] = row[cls.TOTAL]/count
+                stage_statistics['min']  = row[cls.MIN]
+                stage_statistics['max']  = row[cls.MAX]
+
+                if row[cls.TOTAL] > 0:
+                    stage_statistics['rate'] = count/row[cls.TOTAL]
+
+            statistics[stage] = stage_statistics
+
+        return statistics
+
+
+
+    # Stages doing work, the other ones wait for another stage
+    work_stages = ('copy', 'conversion', 'demodulation', 'averaging',
+                   'result_publish')
+
+
+
+    @classmethod
+    def limiting_stage(cls, statistics):
+        """
+            Return the working stage spending the most time, which limits the
+            throughput, or None if no stage has been timed.
+        """
+
+        busiest = max(cls.work_stages, key=lambda stage: statistics[stage]['total'])
+
+        if statistics[busiest]['total'] > 0:
+            return busiest
+
+        return None
+
+
+
+    @classmethod
+    def report(cls, statistics):
+        """
+            Return a table of the stage statistics, the limiting stage being
+            marked.
+        """
+
+        limit = cls.limiting_stage(statistics)
+
+        message = '%-15s %9s %11s %11s %11s %11s\n'\
+                  % ('Stage', 'count', 'total s', 'mean s', 'min s', 'max s')
+
+        for stage in cls.stages:
+
+            values = statistics[stage]
+            if not values['count']:
+                continue
+
+            message += '%-15s %9i %11.4e %11.4e %11.4e %11.4e%s\n'\
+                       % (stage, values['count'], values['total'],
+                          values['mean'], values['min'], values['max'],
+                          ' <' if stage == limit else '')
+
+        return message
+
+
+
+class TimedQueue(object):
+    """
+        Stand-in for the treatment queue timing each put as a stage.
+    """
+
+
+
+    def __init__(self, queue, timer, stage='result_publish'):
+
+        self.queue = queue
+        self.timer = timer
+        self.stage = stage
+
+
+
+    def put(self, result, count=1):
+
+        start = monotonic()
+        self.queue.put(result, count)
+        self.timer.lap(self.stage, start)
+
+
+
+    def end(self):
+
+        self.queue.end()
+
+
+
+    def close(self):
+
+        self.queue.close()
@@ -154,6 +154,7 @@ ADMA_FIFO_ONLY_STREAMING = 0x800
 ADMA_INTERLEAVE_SAMPLES = 0x1000
 ADMA_GET_PROCESSED_DATA = 0x2000
 ADMA_DSP = 0x4000
+ADMA_ENABLE_RECORD_FOOTERS = 0x10000
 
 '''Boards'''
 ATS850  = 1
@@ -462,17 +463,56 @@ class DMABuffer:
             raise Exception("Unsupported OS")
 
 
+class MissingFunction:
+    '''Stands for a function of a library which could not be loaded.
+
+    The ctypes attributes (restype, argtypes, errcheck) can be set as
+    on a function of the library, calling it raises the error met when
+    loading the library.
+    '''
+    def __init__(self, name, error):
+        self.__name__ = name
+        self.error = error
+
+    def __call__(self, *args):
+        raise OSError("%s is not available, the AlazarTech library could "
+                      "not be loaded: %s" % (self.__name__, self.error))
+
+class MissingLibrary:
+    '''Stands for a library which could not be loaded.
+
+    The constants, structures and classes of this module stay usable
+    without the AlazarTech library, only the calls to the library
+    fail. This allows to use a simulated board on a computer without
+    the ATS-SDK.
+    '''
+    def __init__(self, error):
+        self.error = error
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return MissingFunction(name, self.error)
+
 # Load libraries
 ats = None
 libc = None
 if os.name == 'nt':
-    ats = CDLL("ATSApi.dll")
+    libraryName = "ATSApi.dll"
 elif os.name == 'posix':
-    ats = CDLL("libATSApi.so")
+    libraryName = "libATSApi.so"
     libc = CDLL("libc.so.6")
 else:
     raise Exception("Unsupported OS")
 
+try:
+    ats = CDLL(libraryName)
+except OSError as error:
+    ats = MissingLibrary(str(error))
+
+# False when the board can only be simulated
+libraryLoaded = not isinstance(ats, MissingLibrary)
+
 U16 = c_uint16
 U32 = c_uint32
 U8  = c_byte
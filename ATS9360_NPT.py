@@ -21,21 +21,43 @@ import numpy as np
 import logging
 import types
 import time
+import ctypes
 import multiprocessing as mp
 
 from ATS9360 import atsapi as ats
 from ATS9360.DataAcquisition import DataAcquisition
+from ATS9360.SharedRing import SharedRing
+from ATS9360.ResultSlot import ResultSlot, MergedResultSlot
+from ATS9360.RunParameters import RunConfig, RunState, RunParameters
+from ATS9360.BufferPlanner import BufferPlanner
+from ATS9360.NPTFooters import FooterMonitor
+from ATS9360.SimulatedBoard import SimulatedBackend
+from ATS9360.StageTimer import StageTimer
 data_acquisition = DataAcquisition()
 
 class ATS9360_NPT(Instrument):
 
 
 
-    def __init__(self, name):
+    def __init__(self, name, simulation=None):
+        """
+            Input:
+                - name (str): name of the instrument.
+                - simulation (SyntheticSignal): if given, the board is
+                  simulated and receives this signal, which allows to run
+                  the measurements without the board nor the ATS-SDK.
+        """
 
         logging.debug(__name__ + ' : Initializing instrument')
         Instrument.__init__(self, name, tags=['measure'])
 
+        # The acquisition process talks either to the board or to a simulated
+        # one
+        if simulation is None:
+            data_acquisition.backend = ats
+        else:
+            data_acquisition.backend = SimulatedBackend(simulation)
+
         self.add_parameter('clock_source',
             type        = types.StringType,
             flags       = Instrument.FLAG_GETSET,
@@ -95,6 +117,13 @@ class ATS9360_NPT(Instrument):
             flags       = Instrument.FLAG_GETSET
             )
 
+        self.add_parameter('buffer_size',
+            type        = types.FloatType,
+            flags       = Instrument.FLAG_GETSET,
+            units       = 'MB',
+            minval      = 0.
+            )
+
         self.add_parameter('completed_acquisition',
             type        = types.FloatType,
             flags       = Instrument.FLAG_GET,
@@ -104,7 +133,37 @@ class ATS9360_NPT(Instrument):
         self.add_parameter('mode',
             type        = types.StringType,
             flags       = Instrument.FLAG_GETSET,
-            option_list = ('CHANNEL_AB','CHANNEL_A','CHANNEL_B','FFT')
+            option_list = ('CHANNEL_AB','CHANNEL_A','CHANNEL_B','FFT',
+                           'FPGA_AVERAGE')
+            )
+
+        self.add_parameter('record_footers',
+            type        = types.BooleanType,
+            flags       = Instrument.FLAG_GETSET
+            )
+
+        self.add_parameter('persistent_acquisition',
+            type        = types.BooleanType,
+            flags       = Instrument.FLAG_GETSET
+            )
+
+        self.add_parameter('treatment_workers',
+            type        = types.IntType,
+            flags       = Instrument.FLAG_GETSET,
+            minval      = 1
+            )
+
+        self.add_parameter('error_target',
+            type        = types.FloatType,
+            flags       = Instrument.FLAG_GETSET,
+            units       = 'V',
+            minval      = 0.
+            )
+
+        self.add_parameter('snr_target',
+            type        = types.FloatType,
+            flags       = Instrument.FLAG_GETSET,
+            minval      = 0.
             )
 
         self.allow_samplerates = {1e-3   : ats.SAMPLE_RATE_1KSPS,
@@ -153,7 +212,8 @@ class ATS9360_NPT(Instrument):
         self.allow_modes = {'CHANNEL_AB',
                             'CHANNEL_A',
                             'CHANNEL_B',
-                            'FFT'}
+                            'FFT',
+                            'FPGA_AVERAGE'}
 
         # Attributes of the clock
         self.samplerate   = 1000. # In [MS/s], float
@@ -169,27 +229,78 @@ class ATS9360_NPT(Instrument):
         # Attributes of the acquisition
         self.samplesPerRecord           = 128*80 # In S. Must be integer
         self.acquisition_time           = self.samplesPerRecord/(self.samplerate*1e-3) # In ns, float
-        self.default_records_per_buffer = 250 # Must be integer and even
 
-        # The current records per buffer is equal to the default one at the
-        # initialization of the board.
-        self.records_per_buffer         = self.default_records_per_buffer
+        # The records per buffer, the buffers per acquisition and the number
+        # of DMA buffers allocated are chosen by the planner each time the
+        # size of a record, the number of sequence or the averaging change.
+        self.buffer_planner             = BufferPlanner()
+        self.buffer_plan                = None
+        self.records_per_buffer         = 250 # Must be integer
         self.nb_buffer_allocated        = 4 # Must be integer
+
+        # Number of records co-added by the board in FPGA_AVERAGE mode
+        self.records_per_average        = 1 # Must be integer
+        self.max_records_per_average    = 1024 # Must be integer
+
+        # The NPT footers give the record number and the trigger timestamp
+        # of each record, to detect the records missed by the acquisition
+        self.record_footers             = False
+        # Sample clock periods per tick of the trigger timestamp counter,
+        # board dependent, see AlazarGetTriggerTimestamp
+        self.samples_per_timestamp      = 8 # Must be integer
+
+        # The treatment times the conversion, demodulation, averaging and
+        # result publication of each sequence, see get_stage_statistics.
+        # It costs about 15 us per sequence, to switch off for the short
+        # sequences.
+        self.stage_timing               = True
+        self.nb_ring_slots              = 32 # Must be integer
+        self.nb_treatment_workers       = 1 # Must be integer
+        self.result_margin_bytes        = 2**20 # In bytes. Must be integer
+
+        # Time allowed to the processes to end a measurement, in s
+        self.close_timeout              = 10.
+
+        # A persistent acquisition process keeps the board configured and the
+        # DMA buffers allocated from one measurement to the other
+        self.persistent_acquisition     = False
+        self.acquisition_server         = None
         self.buffers_per_acquisition    = 200 # Must be integer
         self.averaging                  = 100 # Must be integer
         self.nb_sequence                = 2 # Must be integer and even
 
+        # Boards acquiring the measurements as (systemId, boardId), see
+        # set_boards. The boards share their clock and trigger, each one has
+        # its own acquisition and treatment processes.
+        self.boards                     = [(1, 1)]
+
+        # The acquisition stops before the averaging once the standard error
+        # of the averaged quantities, or their signal to noise ratio, reaches
+        # its target. None means no target, the averaging is then always
+        # complete.
+        self.error_target               = None # In [V]
+        self.snr_target                 = None
+        # Sequences averaged before the targets are checked, for the
+        # standard error to be meaningful
+        self.min_averaging              = 100 # Must be integer
+
         # Keep trace of the number of buffers acquired by the board.
         # If a measurement is well executed, this number becomes equal to the
         # number of sequences times the number of averaging
         self._acquired_sequences = 0.
 
+        # Averaging treated in the current or last measurement, smaller than
+        # the averaging when the acquisition stopped on its targets
+        self._treated_averaging = 0.
+
         # Attributes of the display of the acquisition
         self.T_display = 1
 
         # Mode of the digitizer.
         self.mode = 'CHANNEL_AB'
 
+        self._plan_buffers()
+
         # For the display, we get all parameters at the end of the
         # initialization
         self.get_all()
@@ -216,11 +327,19 @@ class ATS9360_NPT(Instrument):
         self.get_acquisition_time()
         self.get_averaging()
         self.get_nb_sequence()
+        self.get_buffer_size()
 
         self.get_completed_acquisition()
 
         self.get_mode()
 
+        self.get_treatment_workers()
+        self.get_persistent_acquisition()
+        self.get_record_footers()
+
+        self.get_error_target()
+        self.get_snr_target()
+
 
 
     #########################################################################
@@ -233,51 +352,366 @@ class ATS9360_NPT(Instrument):
 
 
 
-    def _get_parameters(self):
+    def _get_parameters(self, state=None, shared=None):
         """
-            Create a Manager for the multiprocessing containing all parameters
-            needed to tune the board.
-            The method returns the manager as pickable variable.
+            Return the parameters of a measurement given to the processes.
+            The parameters needed to tune the board are frozen in a RunConfig
+            read locally by each process. The few values changing during the
+            measurement live in the shared memory of a RunState, a new one
+            unless state is given, sharing its measuring flag with the
+            RunState shared if given.
         """
 
-        manager    = mp.Manager()
-        parameters = manager.dict()
+        config = RunConfig(
+            # Clock parameters
+            samplerate   = self.samplerate,
+            clock_source = self.clock_source,
+            clock_edge   = self.clock_edge,
+
+            # Trigger parameters
+            trigger_range = self.trigger_range,
+            trigger_slope = self.trigger_slope,
+            trigger_level = self.trigger_level,
+            trigger_delay = self.trigger_delay,
+
+            # Acquisition parameters
+            samplesPerRecord        = self.samplesPerRecord,
+            records_per_buffer      = self.records_per_buffer,
+            records_per_average     = self.records_per_average,
+            footer_samples          = self._get_footer_samples(),
+            samples_per_timestamp   = self.samples_per_timestamp,
+            stage_timing            = self.stage_timing,
+            nb_buffer_allocated     = self.nb_buffer_allocated,
+            buffers_per_acquisition = self.buffers_per_acquisition,
+            nb_sequence             = self.nb_sequence,
+
+            # Targets stopping the averaging
+            error_target  = self.error_target,
+            snr_target    = self.snr_target,
+            min_averaging = self.min_averaging,
+
+            # Correspondence between user parameters and board command
+            allow_samplerates    = self.allow_samplerates,
+            allow_clock_edges    = self.allow_clock_edges,
+            allow_clock_sources  = self.allow_clock_sources,
+            allow_trigger_ranges = self.allow_trigger_ranges,
+            allow_trigger_slopes = self.allow_trigger_slopes,
+
+            # Mode of the digitizer
+            mode = self.mode)
 
-        # Clock parameters
-        parameters['samplerate']   = self.samplerate
-        parameters['clock_source'] = self.clock_source
-        parameters['clock_edge']   = self.clock_edge
+        # Communication parameters to end correctly the measurement
+        if state is None:
+            state = RunState(shared)
+        else:
+            state.reset()
 
-        # Trigger parameters
-        parameters['trigger_range'] = self.trigger_range
-        parameters['trigger_slope'] = self.trigger_slope
-        parameters['trigger_level'] = self.trigger_level
-        parameters['trigger_delay'] = self.trigger_delay
+        return RunParameters(config, state)
 
-        # Acquisition parameters
-        parameters['samplesPerRecord']        = self.samplesPerRecord
-        parameters['records_per_buffer']      = self.records_per_buffer
-        parameters['nb_buffer_allocated']     = self.nb_buffer_allocated
-        parameters['buffers_per_acquisition'] = self.buffers_per_acquisition
-        parameters['nb_sequence']             = self.nb_sequence
 
-        # Correspondence between user parameters and board command
-        parameters['allow_samplerates']    = self.allow_samplerates
-        parameters['allow_clock_edges']    = self.allow_clock_edges
-        parameters['allow_clock_sources']  = self.allow_clock_sources
-        parameters['allow_trigger_ranges'] = self.allow_trigger_ranges
-        parameters['allow_trigger_slopes'] = self.allow_trigger_slopes
 
-        # Communication parameters to end correctly the measurement
-        parameters['measuring']        = True # True means measuring
-        parameters['safe_acquisition'] = False # True means the board has been closed properly
-        parameters['safe_treatment']  = [False, False] # True means the treatment is finished
-        parameters['measured_buffers'] = None
+    def _get_record_samples(self):
+        """
+            Return the number of samples of a record per channel and the
+            number of channels of a record.
+        """
+
+        samplesPerRecord = self.samplesPerRecord
+
+        # The record length of the on-FPGA FFT is only known once the board
+        # is set, we take the FFT length as an upper bound.
+        if self.mode == 'FFT':
+            fftLength_samples = 1
+            while fftLength_samples < samplesPerRecord:
+                fftLength_samples *= 2
+
+            samplesPerRecord = fftLength_samples
+
+        # Room for the NPT footer at the end of each record
+        samplesPerRecord += self._get_footer_samples()
+
+        if self.mode == 'CHANNEL_AB':
+            nb_channels = 2
+        else:
+            nb_channels = 1
+
+        return samplesPerRecord, nb_channels
+
+
+
+    def _get_footer_samples(self):
+        """
+            Return the number of samples added to each record to hold its NPT
+            footer, zero when the footers are not used.
+        """
+
+        if self.record_footers:
+            return FooterMonitor.footer_samples
+
+        return 0
+
+
+
+    def _get_slot_samples(self):
+        """
+            Return the number of samples of a slot of the shared memory ring,
+            that is the number of samples of a buffer.
+            In CHANNEL_AB mode a buffer contains the interleaved samples of
+            the two channels.
+        """
+
+        samplesPerRecord, nb_channels = self._get_record_samples()
+
+        return self.records_per_buffer*samplesPerRecord*nb_channels
+
+
+
+    def _get_sample_type(self):
+        """
+            Return the type of the samples of a buffer, the sums of the
+            FPGA_AVERAGE mode being 32 bits integers.
+        """
+
+        if self.mode == 'FPGA_AVERAGE':
+            return ctypes.c_uint32
+
+        return ctypes.c_uint16
+
+
+
+    def _get_result_bytes(self, processor):
+        """
+            Return the size in bytes of the shared memory holding the latest
+            result of the treatment, the largest result of the processor
+            being given by its result_bytes method.
+        """
+
+        samplesPerRecord, nb_channels = self._get_record_samples()
+        nb_records = self.buffers_per_acquisition*self.records_per_buffer
+
+        return processor.result_bytes(samplesPerRecord, nb_channels,
+                                      self.nb_sequence, nb_records)\
+               + self.result_margin_bytes
+
+
+
+    def _plan_buffers(self):
+        """
+            Choose the geometry of the DMA buffers from the size of a record,
+            the number of sequence and the averaging.
+        """
+
+        samplesPerRecord, nb_channels = self._get_record_samples()
+
+        # In FPGA_AVERAGE mode, the board co-adds records and the buffers
+        # only contain the remaining averaging
+        averaging        = self.averaging
+        bytes_per_sample = 2
+        self.records_per_average = 1
+
+        if self.mode == 'FPGA_AVERAGE':
+
+            self.records_per_average = self._get_records_per_average()
+            averaging        = -(-averaging//self.records_per_average)
+            bytes_per_sample = 4
+
+        self.buffer_plan = self.buffer_planner.plan(samplesPerRecord,
+                                                    nb_channels,
+                                                    self.nb_sequence,
+                                                    averaging,
+                                                    bytes_per_sample)
+
+        self.records_per_buffer      = self.buffer_plan.records_per_buffer
+        self.buffers_per_acquisition = self.buffer_plan.buffers_per_acquisition
+        self.nb_buffer_allocated     = self.buffer_plan.nb_buffer_allocated
+
+
+
+    def _check_averaging(self):
+        """
+            Warn when the averaging planned differs from the one requested.
+        """
+
+        averaging = self.do_get_averaging()
+
+        if averaging != self.averaging:
+            logging.warning(__name__ + ' : averaging of %i set instead of %i requested, see get_buffer_plan'\
+                            % (averaging, self.averaging))
+
+
+
+    def _get_records_per_average(self):
+        """
+            Return the number of records co-added by the board in
+            FPGA_AVERAGE mode.
+            It is the largest divisor of the averaging not larger than
+            max_records_per_average, unless the averaging has no large
+            divisor. The averaging is then rounded up, within the tolerance
+            of the buffer planner, to a multiple of more than twice as many
+            records.
+        """
 
-        # Mode of the digitizer
-        parameters['mode'] = self.mode
+        candidates = range(1, self.max_records_per_average + 1)
+        tolerance  = self.buffer_planner.averaging_tolerance*self.averaging
 
-        return parameters
+        divisor = max(n for n in candidates if self.averaging%n == 0)
+        rounded = max(n for n in candidates\
+                      if -(-self.averaging//n)*n - self.averaging <= tolerance)
+
+        if rounded > 2*divisor:
+            return rounded
+
+        return divisor
+
+
+
+    def get_buffer_plan(self, trigger_rate=None):
+        """
+            Return a description of the geometry of the DMA buffers, with the
+            expected memory use and throughput of the measurement.
+
+            Input:
+                - trigger_rate (float): repetition rate of the trigger in
+                  [Hz]. If None, the throughput is an upper bound given by
+                  records following each other without dead time.
+
+            Output:
+                - report (str)
+        """
+
+        return self.buffer_plan.report(self.samplerate, trigger_rate,
+                                       self.nb_ring_slots)
+
+
+
+    def find_boards(self):
+        """
+            Return all the boards of the computer as (systemId, boardId).
+        """
+
+        backend = data_acquisition.backend
+
+        return [(systemId, boardId)
+                for systemId in range(1, backend.numOfSystems() + 1)
+                for boardId in range(1, backend.boardsInSystemBySystemID(systemId) + 1)]
+
+
+
+    def set_boards(self, boards=None):
+        """
+            Set the boards acquiring the measurements.
+            The boards must share their sample clock and trigger, for the
+            records of a measurement to be acquired on the same triggers by
+            all of them. Each board has its own DMA buffers, shared memory
+            ring and treatment processes with treatment_workers workers, and
+            measurement returns one result per board.
+            The persistent acquisition is only available with a single board.
+
+            Input:
+                - boards (list): boards as (systemId, boardId). If None, all
+                  the boards of the computer, see find_boards.
+
+            Output:
+                - None.
+        """
+
+        if boards is None:
+            boards = self.find_boards()
+
+        boards = [(int(systemId), int(boardId)) for systemId, boardId in boards]
+
+        if not boards:
+            raise ValueError('At least one board must acquire the measurements')
+
+        if len(set(boards)) != len(boards):
+            raise ValueError('A board can only be given once')
+
+        if len(boards) > 1 and self.persistent_acquisition:
+            raise ValueError('The persistent acquisition is only available \
+                             with a single board')
+
+        self.boards = boards
+
+
+
+    def get_boards(self):
+        """
+            Return the boards acquiring the measurements as
+            (systemId, boardId).
+        """
+
+        return list(self.boards)
+
+
+
+    def _get_acquisition_server(self, nb_readers):
+        """
+            Return the ring of the persistent acquisition process.
+            The process is started if needed, or started again if its ring is
+            too small for the measurement or of another sample type.
+        """
+
+        slot_samples = self._get_slot_samples()
+        sample_type  = self._get_sample_type()
+        server       = self.acquisition_server
+
+        if server is not None and (not server['process'].is_alive()\
+           or server['board'] != self.boards[0]\
+           or server['ring'].slot_samples < slot_samples\
+           or server['ring'].sample_type != sample_type\
+           or server['ring'].nb_slots != self.nb_ring_slots\
+           or len(server['ring'].filled_slots) < nb_readers):
+
+            self.acquisition_server_close()
+
+        if self.acquisition_server is None:
+
+            ring    = SharedRing(self.nb_ring_slots, slot_samples,
+                                 sample_type, nb_readers=nb_readers)
+            control = mp.Queue()
+            done    = mp.Event() # Set at the end of each measurement
+            state   = RunState() # Shared by all the measurements
+
+            acquisition = data_acquisition.for_board(*self.boards[0])
+
+            process = mp.Process(target = acquisition.serve,
+                                 args   = (ring, control, done, state))
+            process.daemon = True
+            process.start()
+
+            self.acquisition_server = {'process' : process,
+                                       'board'   : self.boards[0],
+                                       'ring'    : ring,
+                                       'control' : control,
+                                       'done'    : done,
+                                       'state'   : state}
+
+        return self.acquisition_server['ring']
+
+
+
+    def acquisition_server_close(self):
+        """
+            Stop the persistent acquisition process, which releases the board.
+        """
+
+        server = self.acquisition_server
+
+        if server is None:
+            return
+
+        if server['process'].is_alive():
+
+            server['control'].put(('stop',))
+            server['process'].join(self.close_timeout)
+
+            if server['process'].is_alive():
+                server['process'].terminate()
+
+        server['control'].close()
+        server['ring'].close()
+
+        self.acquisition_server = None
 
 
 
@@ -291,6 +725,36 @@ class ATS9360_NPT(Instrument):
 
 
 
+    def _get_treatment_workers(self, processor, ring, result_slot, parameters,
+                               nb_workers, unit_buffers):
+        """
+            Return the data treatment processes of a board, either a single
+            process or a pool of nb_workers processes and their reducer.
+        """
+
+        if nb_workers == 1:
+
+            return [mp.Process(target = processor.treat_data,
+                               args   = (ring, result_slot, parameters))]
+
+        queue_partial = mp.Queue() # Contains the states of the workers
+
+        workers = [mp.Process(target = processor.treat_shard,
+                              args   = (ring, reader, nb_workers,
+                                        unit_buffers, queue_partial,
+                                        parameters))
+                   for reader in range(nb_workers)]
+
+        # The reducer merges the states in order and sends the results
+        workers.append(mp.Process(target = processor.reduce_data,
+                                  args   = (queue_partial, result_slot,
+                                            nb_workers, unit_buffers,
+                                            parameters)))
+
+        return workers
+
+
+
     def measurement_initialization(self, processor):
         """
             Initialize the board and launch a measurement.
@@ -302,101 +766,245 @@ class ATS9360_NPT(Instrument):
             Output:
                 - None
         """
-        if self.mode == 'CHANNEL_AB':
 
-            # In case operation mode is 'CHANNEL_AB',
-            # two data treatment processed are required
+        if self.mode not in self.allow_modes:
 
-            queue_data=[None, None]
-            self.queue_treatment=[None, None]
-            self.worker_treat_data=[None, None]
+            raise ValueError('mode of the digitizer must be "CHANNEL_AB" or \
+                             "CHANNEL_A" or "CHANNEL_B" or "FFT" or \
+                             "FPGA_AVERAGE"')
 
-            # We create shared memory to share data between processes
-            queue_data[0]       = mp.Queue() # Contains measured data cha channel
-            queue_data[1]       = mp.Queue() # Contains measured data chb channel
+        if self.record_footers and self.mode in ('FFT', 'FPGA_AVERAGE'):
 
-            self.queue_treatment[0] = mp.Queue() # Contains treated data
-            self.queue_treatment[1] = mp.Queue() # Contains treated data
+            raise ValueError('The record footers are not available in %s mode'\
+                             % self.mode)
 
-            # Obtain all the parameters to set the board
-            self.parameters      = self._get_parameters()
+        nb_workers = int(self.nb_treatment_workers)
 
-            # We create the data treatment process
-            self.worker_treat_data[0] = mp.Process(target = processor.treat_data,
-                                                    args   = (queue_data[0],
-                                                              self.queue_treatment[0],
-                                                              self.parameters))
+        # Workers of a pool send the state of their accumulators, which is
+        # only possible if the processor builds its results from them
+        if nb_workers > 1 and not hasattr(processor, 'result'):
 
-            self.worker_treat_data[1] = mp.Process(target = processor.treat_data,
-                                                    args   = (queue_data[1],
-                                                              self.queue_treatment[1],
-                                                              self.parameters))
+            raise ValueError('The processor %s can not be treated by several \
+                             workers' % processor.__class__.__name__)
 
-            # We create the data acquisition process
-            self.worker_acquire_data = mp.Process(target = data_acquisition.get_data,
-                                                  args   = (queue_data,
-                                                            self.parameters))
+        # The data treatment is done either by a single process or by a pool
+        # of processes whatever the mode.
+        # In case operation mode is 'CHANNEL_AB', the buffers are kept
+        # interleaved and the treatment process treats both channels.
 
-            # At this point the process is started
-            # Consequently, the measurement is launched.
-            self.worker_acquire_data.start()
-            self.worker_treat_data[0].start()
-            self.worker_treat_data[1].start()
+        # In a pool, the buffers are dealt to the workers by units containing
+        # an integer number of sequences
+        unit_buffers = processor.sequence_aligned_buffers(self.records_per_buffer,
+                                                          self.nb_sequence)
 
-            # The share memories are not used anymore in this process
-            queue_data[0].close()
-            queue_data[1].close()
+        nb_boards = len(self.boards)
+
+        if nb_boards > 1 and self.persistent_acquisition:
+
+            raise ValueError('The persistent acquisition is only available \
+                             with a single board')
+
+        # We create shared memory to share data between processes, a ring
+        # per board
+        if self.persistent_acquisition:
 
-            # Initialize the number of acquired sequence to zero
-            self._acquired_sequences = 0.
+            rings = [self._get_acquisition_server(nb_workers)]
+        else:
+
+            rings = [SharedRing(self.nb_ring_slots, self._get_slot_samples(),
+                                self._get_sample_type(),
+                                nb_readers=nb_workers, unit_buffers=unit_buffers) # Contains measured data
+                     for board in self.boards]
+
+        # Contains the latest treated data.
+        # With several boards, the results of the boards are aligned on the
+        # records they come from.
+        if nb_boards == 1:
+
+            self.result_slot = ResultSlot(self._get_result_bytes(processor))
+            result_slots     = [self.result_slot]
+        else:
+
+            self.result_slot = MergedResultSlot(self._get_result_bytes(processor),
+                                                nb_boards)
+            result_slots     = [self.result_slot.writer(board)
+                                for board in range(nb_boards)]
 
-        elif self.mode in {'CHANNEL_A', 'CHANNEL_B', 'FFT'}:
+        # Obtain all the parameters to set the board.
+        # Each board has its own parameters, a stop of the measurement stops
+        # all the boards.
+        if self.persistent_acquisition:
+            self.parameters  = self._get_parameters(self.acquisition_server['state'])
+        else:
+            self.parameters  = self._get_parameters()
+
+        self.board_parameters = [self.parameters]\
+                                + [self._get_parameters(shared=self.parameters.state)
+                                   for board in self.boards[1:]]
+        self.measured_boards  = list(self.boards)
+
+        # The expected memory use and throughput start the information
+        # about the measurement
+        self.parameters.add_message(self.get_buffer_plan())
 
-            # In case operation mode is 'CHANNEL_A' or 'CHANNEL_B' or 'FFT',
-            # only one data treatment process is required
+        # We create the data treatment processes
+        self.workers_treat_data = []
 
-            # We create shared memory to share data between processes
-            queue_data       = mp.Queue() # Contains measured data cha channel
+        for ring, result_slot, parameters in zip(rings, result_slots,
+                                                 self.board_parameters):
 
-            self.queue_treatment = mp.Queue() # Contains treated data
+            self.workers_treat_data += self._get_treatment_workers(processor,
+                                                                   ring,
+                                                                   result_slot,
+                                                                   parameters,
+                                                                   nb_workers,
+                                                                   unit_buffers)
 
+        for worker in self.workers_treat_data:
+            worker.start()
 
-            # Obtain all the parameters to set the board
-            self.parameters      = self._get_parameters()
+        if self.persistent_acquisition:
 
-            # We create the data treatment process
-            self.worker_treat_data = mp.Process(target = processor.treat_data,
-                                                    args   = (queue_data,
-                                                              self.queue_treatment,
-                                                              self.parameters))
+            # The acquisition process is already running, we send it the
+            # measurement
+            self.workers_acquire_data = None
+            self.acquisition_server['done'].clear()
+            self.acquisition_server['control'].put(('run', self.parameters.config,
+                                                    nb_workers, unit_buffers))
+        else:
 
-            # We create the data acquisition process
-            self.worker_acquire_data = mp.Process(target = data_acquisition.get_data,
-                                                  args   = (queue_data,
-                                                            self.parameters))
+            # We create the data acquisition processes, one per board
+            self.workers_acquire_data = [mp.Process(target = data_acquisition.for_board(*board).get_data,
+                                                    args   = (ring, parameters))
+                                         for board, ring, parameters\
+                                         in zip(self.boards, rings,
+                                                self.board_parameters)]
 
-            # At this point the process is started
+            # At this point the processes are started
             # Consequently, the measurement is launched.
-            self.worker_acquire_data.start()
-            self.worker_treat_data.start()
+            for worker in self.workers_acquire_data:
+                worker.start()
 
             # The share memories are not used anymore in this process
-            queue_data.close()
+            # We keep a reference on the rings for the memory to stay
+            # allocated as long as the measurement runs.
+            for ring in rings:
+                ring.close()
+            self.rings = rings
+
+        # Initialize the number of acquired sequence to zero
+        self._acquired_sequences = 0.
+        self._treated_averaging  = 0.
+
+
+
+    def get_trigger_statistics(self):
+        """
+            Return the statistics of the triggers of the current or last
+            measurement, given by the NPT footers when record_footers is
+            set.
+
+            Output:
+                - statistics (dict): number of triggers, of gaps in the record
+                  numbers and of missed records, mean trigger rate in [Hz],
+                  mean, standard deviation, minimum and maximum of the
+                  trigger period in [s].
+                  With several boards, a list of the statistics of each
+                  board.
+        """
+
+        if getattr(self, 'parameters', None) is None:
+            return dict.fromkeys(RunState.trigger_statistics_names, 0.)
+
+        if len(self.board_parameters) == 1:
+            return self.parameters['trigger_statistics']
+
+        return [parameters['trigger_statistics']
+                for parameters in self.board_parameters]
+
+
+
+    def get_stage_statistics(self):
+        """
+            Return the timing of the stages of the pipeline for the current
+            or last measurement, the processes adding their timers once they
+            end. With several boards, the timers of all the boards are added.
+
+            Output:
+                - statistics (dict): for each stage of StageTimer.stages, a
+                  dict with the count, the total, mean, minimum and maximum
+                  durations in [s], the rate in [1/s] the stage could
+                  sustain alone and the histogram of the durations as
+                  (upper edges in [s], counts).
+        """
+
+        array = StageTimer().array
+
+        for parameters in getattr(self, 'board_parameters', []):
+            StageTimer.merge(array, parameters.state.stage_array())
+
+        return StageTimer.statistics(array)
+
+
+
+    def _get_boards_report(self):
+        """
+            Return the information about a measurement of several boards: the
+            one given by the processes of each board, then the records
+            acquired by all the boards and their total throughput.
+        """
+
+        samplesPerRecord, nb_channels = self._get_record_samples()
+
+        message  = ''
+        buffers  = []
+        duration = 0.
+
+        for (systemId, boardId), parameters in zip(self.measured_boards,
+                                                   self.board_parameters):
+
+            message += '--- Board %i.%i ---\n' % (systemId, boardId)
+            message += parameters['message']
+
+            buffers.append(parameters['measured_buffers'] or 0)
+            duration = max(duration, parameters['capture_time'])
+
+        # The samples co-added by the board in FPGA_AVERAGE mode are counted
+        records = sum(buffers)*self.records_per_buffer
+        samples = records*self.records_per_average*samplesPerRecord*nb_channels
+
+        message += '--- %i boards ---\n' % len(self.measured_boards)
+        message += 'Captured %d records\n' % records
+
+        if duration > 0:
+            message += 'Acquired %d samples (%f MS per sec)\n'\
+                       % (samples, samples/duration/1e6)
+
+        # The results are aligned on the records acquired by every board
+        if min(buffers) != max(buffers):
+            message += 'Boards captured from %d to %d buffers, results aligned on the first %d\n'\
+                       % (min(buffers), max(buffers), min(buffers))
+
+        return message
 
-            # Initialize the number of acquired sequence to zero
-            self._acquired_sequences = 0
-        else:
 
-            raise ValueError('mode of the digitizer must be "CHANNEL_AB" or \
-                             "CHANNEL_A" or "CHANNEL_B" or "FFT"')
 
     def measurement(self):
         """
             Return the data treated with the processor given in the
             measurement_initialization method.
+            In case operation mode is 'CHANNEL_AB', the data are returned as
+            (result_channel_a, result_channel_b).
+            With several boards, the data of each board are returned as
+            (result_board_1, result_board_2, ...) in the order of the boards,
+            all of them coming from the same records.
 
             Since plotting is a slow operation, treated data are returned every T_display.
-            The while loop is here to ensure that the treatment queue is emptied as fast as possible.
+            Only the latest result is read, the intermediate ones are
+            overwritten by the treatment.
+            When the averaging stops on its error or signal to noise
+            target, the acquisition is reported as completed with the last
+            result, see get_acquired_averaging.
 
             Input:
                 - None
@@ -404,25 +1012,32 @@ class ATS9360_NPT(Instrument):
                 - None
         """
 
-        start_meas = time.clock() # Keep track of when the measurement started
+        start_meas = time.time() # Keep track of when the measurement started
 
-        while time.clock()-start_meas< self.T_display and self.get_completed_acquisition() != 100.:
-            # Each times the treatment buffer memory is loaded means a  new
-            # averaging has been treated
+        # We wait for a new result
+        # Each version of the result means a new averaging has been treated,
+        # of records_per_average sequences in FPGA_AVERAGE mode
+        version, result = self.result_slot.get(int(self._acquired_sequences)\
+                                               /self.records_per_average + 1)
 
-            if self.mode == 'CHANNEL_AB':
-                # In case operation mode is 'CHANNEL_AB',
-                # two data treatment processed are required
-                result = self.queue_treatment[0].get(), self.queue_treatment[1].get()
-            elif self.mode in {'CHANNEL_A', 'CHANNEL_B', 'FFT'}:
-                # In case operation mode is 'CHANNEL_A' or 'CHANNEL_B' or 'FFT',
-                # only one data treatment process is required
-                result = self.queue_treatment.get()
-            else:
-                raise ValueError('mode of the digitizer must be "CHANNEL_AB" or \
-                                 "CHANNEL_A" or "CHANNEL_B" or "FFT"')
+        self._acquired_sequences = float(version*self.records_per_average)
+
+        # and then for the rest of the display time, unless the whole
+        # averaging is treated before
+        remaining = self.T_display - (time.time() - start_meas)
+        if remaining > 0. and self.get_completed_acquisition() != 100.:
+
+            version, result = self.result_slot.get(int(self.get_averaging())\
+                                                   /self.records_per_average,
+                                                   remaining)
+            self._acquired_sequences = float(version*self.records_per_average)
 
-            self._acquired_sequences += 1.
+        self._treated_averaging = self._acquired_sequences
+
+        # The treatment ended before the whole averaging, its targets being
+        # reached
+        if self.result_slot.ended:
+            self._acquired_sequences = float(self.get_averaging())
 
         # We update the percentage of the measurement
         self.get_completed_acquisition()
@@ -431,7 +1046,18 @@ class ATS9360_NPT(Instrument):
         return result
 
 
-    def measurement_close(self, transfert_info=False):
+
+    def get_acquired_averaging(self):
+        """
+            Return the averaging treated in the current or last measurement,
+            smaller than the averaging if the acquisition stopped on its
+            error or signal to noise target.
+        """
+
+        return self._treated_averaging
+
+
+    def measurement_close(self, transfert_info=False, stage_statistics=False):
         """
             Finish properly the measurement
             First inform the board that the measurement is finished and next
@@ -440,46 +1066,83 @@ class ATS9360_NPT(Instrument):
             Input:
                 - transfert_info (booleen): If True return the transfert rate
                 information
+                - stage_statistics (booleen): If True return the timing of
+                the stages of the pipeline, see get_stage_statistics
             Output:
                 - transfert_info (str): If requested the transfert info
+                - stage_statistics (dict): If requested the stage statistics,
+                returned after the transfert info if both are requested
         """
 
         # We inform child process that the measurement is finished
         self.parameters['measuring'] = False
 
-        # While the child process doesn't "close" properly the board and the
-        # data treatment is finished, we wait
-        while not self.parameters['safe_acquisition'] and not all(self.parameters['safe_treatment']):
+        # The acquisition stops the board and informs the treatment of the
+        # end of the buffers, the processes end by themselves.
+        # We wait for them without polling the shared parameters.
+        end = time.time() + self.close_timeout
 
-            pass
+        if self.workers_acquire_data is None:
+            self.acquisition_server['done'].wait(self.close_timeout)
+        else:
+            for worker in self.workers_acquire_data:
+                worker.join(max(end - time.time(), 0.))
+
+        for worker in self.workers_treat_data:
+            worker.join(max(end - time.time(), 0.))
+
+        # The processes which did not end in time are killed.
+        # A persistent acquisition process is killed as well since the
+        # slots of its ring can not be trusted anymore.
+        stuck = [worker for worker in self.workers_treat_data if worker.is_alive()]
+
+        if self.workers_acquire_data is None:
+            if not self.acquisition_server['done'].is_set():
+                stuck.append(self.acquisition_server['process'])
+            if stuck:
+                self.acquisition_server['process'].terminate()
+        else:
+            stuck += [worker for worker in self.workers_acquire_data
+                      if worker.is_alive()]
 
-        # Once the board is "close" properly, we close the FIFO memory and
-        # we close the child processes and the share memory
+        for worker in stuck:
+            logging.warning(__name__ + ' : %s did not end in time, terminated' % worker.name)
+            worker.terminate()
 
-        if self.mode == 'CHANNEL_AB':
-            # In case operation mode is 'CHANNEL_AB',
-            # two data treatment processed are required
-            self.queue_treatment[0].close()
-            self.queue_treatment[1].close()
-            self.worker_acquire_data.terminate()
-            self.worker_treat_data[0].terminate()
-            self.worker_treat_data[1].terminate()
-        elif self.mode in {'CHANNEL_A', 'CHANNEL_B', 'FFT'}:
-            # In case operation mode is 'CHANNEL_A' or 'CHANNEL_B' or 'FFT',
-            # only one data treatment process is required
-            self.queue_treatment.close()
-            self.worker_acquire_data.terminate()
-            self.worker_treat_data.terminate()
-        else:
-            raise ValueError('mode of the digitizer must be "CHANNEL_AB" or \
-                             "CHANNEL_A" or "CHANNEL_B" or "FFT"')
+        if self.workers_acquire_data is None and stuck:
+            self.acquisition_server_close()
 
+        self.result_slot.close()
+
+        # The records missed by the acquisition have not been averaged
+        if self.record_footers:
+            for (systemId, boardId), parameters in zip(self.measured_boards,
+                                                       self.board_parameters):
+                statistics = parameters['trigger_statistics']
+                if statistics['missed_records']:
+                    logging.warning(__name__ + ' : %i records missed in %i gaps by board %i.%i'\
+                                    % (statistics['missed_records'],
+                                       statistics['gaps'], systemId, boardId))
 
         self._acquired_sequences = 0.
         self.get_completed_acquisition()
 
-        if transfert_info:
-            return self.parameters['message']
+        # The processes have added their timers, the table of the stages
+        # ends the information about the measurement
+        statistics = self.get_stage_statistics()
+
+        if len(self.board_parameters) == 1:
+            self.parameters.add_message(StageTimer.report(statistics))
+            message = self.parameters['message']
+        else:
+            message = self._get_boards_report() + StageTimer.report(statistics)
+
+        if transfert_info and stage_statistics:
+            return message, statistics
+        elif transfert_info:
+            return message
+        elif stage_statistics:
+            return statistics
 
 
 
@@ -522,6 +1185,7 @@ class ATS9360_NPT(Instrument):
             samplesPerRecord      = round(self.samplerate*acquisition_time*1e-3)
             self.samplesPerRecord = int(round(samplesPerRecord/128)*128)
             self.acquisition_time = self.samplesPerRecord/self.samplerate*1e3
+            self._plan_buffers()
 
             # To display the new value of acquired sample of get it
             # self.get_samplesPerRecord()
@@ -550,8 +1214,9 @@ class ATS9360_NPT(Instrument):
         '''
             Set the number of averaging.
             It should be even.
-            When nb_averaging x nb_sequence >100, nb_averaging must be a
-            multiple of 100
+            The buffers being chosen large enough for the DMA to be
+            efficient, the averaging set may be slightly larger than the one
+            asked, see get_buffer_plan.
 
             Input:
                 - nb_averaging (int): number of averaging
@@ -565,11 +1230,9 @@ class ATS9360_NPT(Instrument):
         if nb_averaging%2:
             raise ValueError('The number of averaging should be even')
 
-        if nb_averaging*self.nb_sequence < self.default_records_per_buffer:
-            self.buffers_per_acquisition = 1
-            self.records_per_buffer      = int(nb_averaging*self.nb_sequence)
-        else:
-            self.buffers_per_acquisition = int(np.ceil(float(nb_averaging*self.nb_sequence)/self.records_per_buffer))
+        self.averaging = int(nb_averaging)
+        self._plan_buffers()
+        self._check_averaging()
 
         if output:
             m  = 'buffer per acquisition:', self.buffers_per_acquisition
@@ -591,7 +1254,8 @@ class ATS9360_NPT(Instrument):
                 - number_of_averaging (int): number of averaging
         '''
 
-        return self.buffers_per_acquisition*self.records_per_buffer/self.nb_sequence
+        return self.buffers_per_acquisition*self.records_per_buffer\
+               *self.records_per_average/self.nb_sequence
 
 
     def do_set_nb_sequence(self, nb_sequence, output=False):
@@ -608,12 +1272,9 @@ class ATS9360_NPT(Instrument):
                 - None.
         '''
 
-        if nb_sequence<(self.default_records_per_buffer +1):
-            self.records_per_buffer         = int(nb_sequence)
-            self.nb_sequence = int(nb_sequence)
-        else:
-            self.records_per_buffer         = self.default_records_per_buffer
-            self.nb_sequence = int(nb_sequence)
+        self.nb_sequence = int(nb_sequence)
+        self._plan_buffers()
+        self._check_averaging()
 
         if output:
             m  = 'buffer per acquisition:', self.buffers_per_acquisition
@@ -640,6 +1301,38 @@ class ATS9360_NPT(Instrument):
 
 
 
+    def do_set_buffer_size(self, buffer_size):
+        '''
+            Set the targeted size of the DMA buffers in [MB].
+            The buffers are chosen between a quarter and twice this size.
+
+            Input:
+                - buffer_size (float): targeted size of a buffer in [MB].
+
+            Output:
+                - None.
+        '''
+
+        self.buffer_planner.buffer_bytes = int(buffer_size*2**20)
+        self._plan_buffers()
+
+
+
+    def do_get_buffer_size(self):
+        '''
+            Get the targeted size of the DMA buffers in [MB].
+
+            Input:
+                - None.
+
+            Output:
+                - buffer_size (float): targeted size of a buffer in [MB].
+        '''
+
+        return self.buffer_planner.buffer_bytes/2.**20
+
+
+
     #########################################################################
     #
     #
@@ -992,7 +1685,20 @@ class ATS9360_NPT(Instrument):
 
             Input:
                 - mode (string): Must be "CHANNEL_AB" or
-                                 "CHANNEL_A" or "CHANNEL_B" or "FFT"
+                                 "CHANNEL_A" or "CHANNEL_B" or "FFT" or
+                                 "FPGA_AVERAGE"
+
+                  In "FPGA_AVERAGE" mode, the board co-adds consecutive
+                  records of channel A and only their sums are transferred.
+                  The number of co-added records is the largest divisor of
+                  the averaging not larger than max_records_per_average, the
+                  rest of the averaging is done by the processor. An
+                  averaging without large divisor is rounded up, as
+                  reported by get_buffer_plan. Each record
+                  of a sequence must then be repeated that many times in a
+                  row, with nb_sequence = 1 this is always the case. The
+                  standard deviation given by the processor is the one of the
+                  averaged records.
 
             Output:
                 - None.
@@ -1000,10 +1706,12 @@ class ATS9360_NPT(Instrument):
         if mode in self.allow_modes:
 
             self.mode = mode
+            self._plan_buffers()
         else:
 
             raise ValueError('mode of the digitizer must be "CHANNEL_AB" or \
-                             "CHANNEL_A" or "CHANNEL_B" or "FFT"')
+                             "CHANNEL_A" or "CHANNEL_B" or "FFT" or \
+                             "FPGA_AVERAGE"')
 
 
     def do_get_mode(self):
@@ -1017,3 +1725,188 @@ class ATS9360_NPT(Instrument):
         '''
 
         return self.mode
+
+
+
+    #########################################################################
+    #
+    #
+    #                           Data treatment
+    #
+    #
+    #########################################################################
+
+    def do_set_treatment_workers(self, treatment_workers):
+        '''Set the number of processes treating the data.
+           With more than one worker, the processor must define a "result"
+           method.
+
+            Input:
+                - treatment_workers (int): number of treatment processes
+
+            Output:
+                - None.
+        '''
+
+        self.nb_treatment_workers = int(treatment_workers)
+
+
+
+    def do_get_treatment_workers(self):
+        '''Get the number of processes treating the data.
+
+            Input:
+                -
+
+            Output:
+                - treatment_workers (int)
+        '''
+
+        return self.nb_treatment_workers
+
+
+
+    def do_set_error_target(self, error_target):
+        '''Set the standard error of the averaged quantities at which the
+           acquisition stops, the averaging being then the maximum number of
+           averaging of a measurement.
+           Only the quantities averaged in V are checked, the real and
+           imaginary parts of a demodulation as a vector per channel, the
+           phases and the spectra are not.
+
+            Input:
+                - error_target (float): in [V], 0 for no target
+
+            Output:
+                - None.
+        '''
+
+        if error_target > 0.:
+            self.error_target = float(error_target)
+        else:
+            self.error_target = None
+
+
+
+    def do_get_error_target(self):
+        '''Get the standard error of the averaged quantities at which the
+           acquisition stops.
+
+            Input:
+                -
+
+            Output:
+                - error_target (float): in [V], 0 for no target
+        '''
+
+        if self.error_target is None:
+            return 0.
+
+        return self.error_target
+
+
+
+    def do_set_snr_target(self, snr_target):
+        '''Set the signal to noise ratio of the averaged quantities, their
+           mean over their standard error, at which the acquisition stops,
+           the averaging being then the maximum number of averaging of a
+           measurement.
+
+            Input:
+                - snr_target (float): 0 for no target
+
+            Output:
+                - None.
+        '''
+
+        if snr_target > 0.:
+            self.snr_target = float(snr_target)
+        else:
+            self.snr_target = None
+
+
+
+    def do_get_snr_target(self):
+        '''Get the signal to noise ratio of the averaged quantities at which
+           the acquisition stops.
+
+            Input:
+                -
+
+            Output:
+                - snr_target (float): 0 for no target
+        '''
+
+        if self.snr_target is None:
+            return 0.
+
+        return self.snr_target
+
+
+
+    def do_set_record_footers(self, record_footers):
+        '''Set if the NPT footers of the records are acquired, to follow
+           the trigger timestamps and detect the missed records.
+           Only available in the "CHANNEL_AB", "CHANNEL_A" and "CHANNEL_B"
+           modes.
+
+            Input:
+                - record_footers (bool)
+
+            Output:
+                - None.
+        '''
+
+        self.record_footers = bool(record_footers)
+        self._plan_buffers()
+
+
+
+    def do_get_record_footers(self):
+        '''Get if the NPT footers of the records are acquired.
+
+            Input:
+                -
+
+            Output:
+                - record_footers (bool)
+        '''
+
+        return self.record_footers
+
+
+
+    def do_set_persistent_acquisition(self, persistent_acquisition):
+        '''Set if the acquisition process, with the board configured and the
+           DMA buffers allocated, is kept from one measurement to the other.
+
+            Input:
+                - persistent_acquisition (bool)
+
+            Output:
+                - None.
+        '''
+
+        if persistent_acquisition and len(self.boards) > 1:
+            raise ValueError('The persistent acquisition is only available \
+                             with a single board')
+
+        self.persistent_acquisition = bool(persistent_acquisition)
+
+        if not self.persistent_acquisition:
+            self.acquisition_server_close()
+
+
+
+    def do_get_persistent_acquisition(self):
+        '''Get if the acquisition process is kept from one measurement to
+           the other.
+
+            Input:
+                -
+
+            Output:
+                - persistent_acquisition (bool)
+        '''
+
+        return self.persistent_acquisition